@@ -7,79 +7,95 @@ import os.path
 import traceback
 import argparse
 import curses
-import re
+import tempfile
 from py65emu.cpu import CPU
 from py65emu.mmu import MMU
-from PIL import Image
+from py65emu.snapshot import Snapshot, SnapshotError
+from apple2 import SoftSwitches, CYCLES_PER_FRAME
+from capture import FrameCapture
+from breakpoints import Breakpoints, BreakpointError, Watchpoints, WATCH_KINDS
+from profiler import Profiler, CallProfiler, measure_passes
+from exectrace import TraceRecorder, TraceIndex, Recorders, INDEX_SUFFIX
+from history import History
+from report import cached, Listing, SymbolError, parse_acme, parse_ca65, DEFAULT_PC
+from video import hgr_address, hgr_image, HgrViewer, APPLE_YRES, \
+    render_text, text_image, lores_image, TEXT_COLUMNS, TEXT_ROWS_COUNT
+
+def show_hgr(cpu, page=0x2000, colour=False):
+    img = hgr_image( cpu.mmu.blocks[0]['memory'], page, scale=4, colour=colour)
+    img.show()
 
-class LineInfo:
-    def __init__( self, address, cycles, label, source):
-        self.address, self.cycles, self.label, self.source = address, cycles, label, source
-        self.cycle_mark = False
+def text_page( cpu):
+    # The text (or LORES) page selected by the soft switches
+    return 0x800 if cpu.io.page2 else 0x400
 
-DEFAULT_PC = 0x800
+def show_text(cpu):
+    text_image( cpu.mmu.blocks[0]['memory'], text_page( cpu), scale=4).show()
 
-REVERSED_BYTES = [ [(n//1)&1,  (n//2)&1,
-                    (n//4)&1, (n//8)&1,
-                    (n//16)&1, (n//32)&1,
-                    (n//64)&1 ]  for n in range(256)]
+def show_lores(cpu):
+    lores_image( cpu.mmu.blocks[0]['memory'], text_page( cpu), scale=4).show()
 
-def hgr_address( y, page=0x2000, format=0):
-    #assert page == 0x2000 or page == 0x4000, "I'll work only for legal pages"
-    assert 0 <= y < APPLE_YRES, "You're outside Apple's veritcal resolution"
 
-    if 0 <= y < 64:
-        ofs = 0
-    elif 64 <= y < 128:
-        ofs = 0x28
-    else:
-        ofs = 0x50
+# The live HGR window (see toggle_viewer)
+viewer = None
 
-    i = (y % 64) // 8
-    j = (y % 64) % 8
+def toggle_viewer( cpu, colour=False):
+    """ Open (or close) a window showing the HGR page, updated as the
+    6502 draws.  Returns an error message if the window can't be opened.
+    """
+    global viewer
 
-    if format == 0:
-        return "${:X} + ${:X}".format( page + ofs + 0x80*i, 0x400*j)
-    elif format == 1:
-        return "${:X}".format( page + ofs + 0x80*i + 0x400*j)
-    else:
-        return page + ofs + 0x80*i + 0x400*j
-
-APPLE_YRES = 64*3
+    if viewer and not viewer.closed:
+        viewer.close()
+        viewer = None
+        return None
 
+    page = 0x4000 if cpu.io.page2 else 0x2000
+    try:
+        viewer = HgrViewer( cpu.mmu, page, colour=colour)
+    except Exception as ex:
+        viewer = None
+        return f"Can't open the HGR window : {ex}"
 
+def refresh_viewer():
+    if viewer and not viewer.closed:
+        viewer.refresh()
 
-def show_hgr(cpu, page=0x2000):
 
-    data = []
-    for y in range( APPLE_YRES):
-        ofs = hgr_address( y, page, format=None)
-        for b in cpu.mmu.blocks[0]['memory'][ofs:ofs+40]:
-            data += REVERSED_BYTES[b]
 
-    bdata = []
-    for i in range(0,len(data),8):
-        bits = data[i:i+8]
-        b = bits[0]*128 + bits[1]*64 +bits[2]*32 + bits[3]*16 +bits[4]*8 + bits[5]*4 + bits[6]*2 + bits[7]*1
-        bdata.append( b)
+def init_cpu( mem, pc_value, fast=True, io=True):
 
-    img = Image.frombytes( "1", (280, APPLE_YRES), bytes(bdata))
-    img = img.resize( (280*4,192*4), Image.NEAREST )
+    mmu = MMU([
+        (0x00, len(mem), False, mem) # readonly = False
+        ])
 
-    img.show()
+    c = CPU(mmu, pc_value, fast=fast)
 
+    # $C0xx soft switches (keyboard, speaker, display modes) instead of RAM
+    c.io = SoftSwitches(c)
+    if io:
+        c.io.install(mmu)
 
+    c.watchpoints = Watchpoints(c)
 
+    return c
 
-def init_cpu( mem, pc_value):
+def save_state( cpu, fname):
+    snapshot = cpu.snapshot()
+    snapshot.extra["apple2"] = cpu.io.state()
+    snapshot.save( fname)
 
-    mmu = MMU([
-        (0x00, len(mem), False, mem) # readonly = False
-        ])
 
-    c = CPU(mmu, pc_value)
+def load_state( cpu, fname):
+    """ Raises SnapshotError (or OSError) if the file can't be loaded """
+    snapshot = Snapshot.load( fname)
+    try:
+        cpu.restore( snapshot)
+    except ValueError:
+        raise SnapshotError( f"{fname} is not a state of this debugger's memory")
+    if "apple2" in snapshot.extra:
+        cpu.io.restore_state( snapshot.extra["apple2"])
 
-    return c
 
 def flags6502( cpu):
 
@@ -91,273 +107,489 @@ def flags6502( cpu):
     return ''.join(s)
 
 
-def loop_step( cpu):
-    current_pc = cpu.r.pc
-    cpu.step()
-    while cpu.r.pc != current_pc:
-        cpu.step()
-
-
-def smart_step( cpu, step_over=False):
-    mmu = cpu.mmu
-    pc = cpu.r.pc
-    opcode = mmu.read(pc)
-    if opcode == 0x20 and step_over:
-        # JSR
-        current_s = cpu.r.s
-        cpu.step()
-        while cpu.r.s != current_s:
-            cpu.step()
-    elif opcode == 0:
-        # BRK
-        pass
-    else:
-        cpu.step()
-
-
-def parse_report_ca65( fname, map_name = ""):
-
-
-    BEGIN_RE = re.compile( r"^([0-9A-F]+)r\s+([0-9]+)\s(.{12})(.*)$")
-    SEGMENT_RE = re.compile( r'^\s+.segment\s+"([^"]+)".*$')
-    SEGMENT = re.compile( r"^([^\s]+)\s+([0-9A-F]{6}).*$")
-
-    segments = dict()
-    with open( map_name,"r") as fin:
-        lines = fin.readlines()
+breakpoints = Breakpoints()
 
-        ndx = 0
-        while 'Segment list:' not in lines[ndx]:
-            ndx += 1
+# The execution profiles (None if there's none) and whether we're
+# collecting them (see 'P')
+profiler = None
+call_profiler = None
+profiling = False
 
-        while True:
+# The instruction trace recorder (None if we don't record, see 'R' and
+# --trace)
+tracer = None
+TRACE_LAST = 100000
+# Where the last instructions are saved to be queried (see 'Q')
+TRACE_QUERY_FILE = os.path.join( tempfile.gettempdir(), f"debug6502-{os.getpid()}.trc")
 
-            line = lines[ndx].strip()
+# The undo journal, to go back in time ('u', 'U'), None without --history
+history = None
 
-            m = SEGMENT.match(line)
-            if m:
-                seg_name, seg_address = m.groups()[0], int(m.groups()[1],16)
-                #print( f"{seg_name} {seg_address:X}")
 
-                segments[seg_name] = seg_address
+def recorder():
+    """ What CPU.run records the execution into (its trace parameter),
+    None if nothing.
+    """
+    active = [r for r in (history, tracer) if r]
+    if len( active) > 1:
+        return Recorders( *active)
+    return active[0] if active else None
 
-            elif not line:
-                break
-
-            ndx += 1
-
-
-    seg_addr = 0
-    default_pc = 0
-    lines_addr = dict()
-    lines = []
-
-    with open(fname,"r") as fin:
-        fiter = fin.readlines()[4:]
-        for real_nr, line in enumerate(fiter):
-            line = line.rstrip().replace("\t"," "*8)
-
-
-            m = BEGIN_RE.match(line)
-            if m:
-
-                code = m.groups()[3]
-                hexa = m.groups()[2]
-
-                m2 = SEGMENT_RE.match( code)
-
-                if m2 and m2.groups()[0] in segments:
-                    seg_name = m2.groups()[0]
-                    seg_addr = segments[seg_name]
-                    #print(f"{seg_name} {seg_addr}")
-
-                line_addr = int( m.groups()[0], 16) + seg_addr
-
-                if line_addr and not default_pc:
-                    default_pc = line_addr
-
-                #print( f"{line_addr:X} | {hexa} | {code}")
-
-                if hexa.strip():
-                    lines_addr[line_addr] = len(lines)
-                else:
-                    line_addr = 0
-
-                addr_txt =""
-                if line_addr:
-                    addr_txt = f"{line_addr:04X}"
-                else:
-                    addr_txt = "   -"
-
-                lines.append( LineInfo( line_addr, 0, None, f"{addr_txt} | {hexa} | {code}"))
 
-    return lines, lines_addr, find_locations( lines), default_pc
-
-
-def find_locations( lines):
-    LABEL_RE = re.compile( r"^\s*([^\s]+):.*$")
-    OPCODE_RE = re.compile( r"^.*(ADC|AND|ASL|BCC|BCS|BEQ|BIT|BMI|BNE|BPL|BRK|BVC|BVS|CLC|CLD|CLI|CLV|CMP|CPX|CPY|DEC|DEX|DEY|EOR|INC|INX|INY|JMP|JSR|LDA|LDX|LDY|LSR|NOP|ORA|PHA|PHP|PLA|PLP|ROL|ROR|RTI|RTS|SBC|SEC|SED|SEI|STA|STX|STY|TAX|TAY|TSX|TXA|TXS|TYA)\s.*$")
-    cpu = CPU()
-
-    last_label = None
-    last_data_label = None
-
-    locations = []
-
-    for real_nr, line in enumerate( lines):
-
-        source = line.source
-        if ";" in source:
-            source = source[0:source.index(";")]
-
-        source_label = None
-        cycles = None
-
-
-        #print( source[22:])
-        m = LABEL_RE.match( source[22:].strip())
-        if m:
-            source_label = last_label = m.groups()[0]
-            #print( source_label)
-
-        if ("!word" in source) or (".word" in source):
-            if last_data_label != last_label:
-                last_data_label = last_label
-                #print(f"{last_data_label} at {addr:X}")
-                locations.append( (last_data_label, line.address, 2) )
-
-        elif ("!byte" in source) or (".byte" in source):
-            if last_data_label != last_label:
-                last_data_label = last_label
-                #print(f"{last_data_label} at {addr:X}")
-                locations.append( (last_data_label, line.address, 1) )
+def step( cpu):
+    """ cpu.step(), returns the reason why the CPU was asked to stop
+    (a watchpoint) if it was, else None.
+    """
+    pc = cpu.r.pc
+    rec = recorder()
+    if rec:
+        rec.attach()
+        rec.record( pc)
+    try:
+        if profiling:
+            profiler.step( cpu)
+        else:
+            cpu.step()
+    finally:
+        if rec:
+            rec.detach()
+    return cpu.takeStop( pc)
+
+
+def run( cpu, stop_pcs=frozenset(), **stop):
+    """ cpu.run() but stopping on the breakpoints too ("breakpoint") and,
+    if the HGR window is open, refreshing it every frame.  Runs the
+    translated basic blocks when nothing needs to see every instruction.
+    Returns the stop reason.
+    """
+    if profiling:
+        stop["profile"] = profiler.counters
+    if recorder():
+        stop["trace"] = recorder()
+    # The translated blocks only see the watchpoints at their end
+    stop["blocks"] = not cpu.watchpoints.watchpoints
 
-        # m = OPCODE_RE.match( source.upper())
-        # if m:
-        #     cycles = cpu.opcode_name_cycles[ m.groups()[0]]
-        #     line.cycles = cycles
+    while True:
+        all_pcs = stop_pcs | breakpoints.addresses
 
+        if viewer and not viewer.closed:
+            reason, _, _ = cpu.run( max_cycles=CYCLES_PER_FRAME, stop_pcs=all_pcs, **stop)
+            if reason == "cycles":
+                refresh_viewer()
+                continue
+        else:
+            reason, _, _ = cpu.run( stop_pcs=all_pcs, **stop)
 
-    return locations
+        if reason == "pc" and cpu.r.pc in breakpoints:
+            if breakpoints.hit( cpu):
+                return "breakpoint"
+            elif cpu.r.pc not in stop_pcs:
+                # Condition not met, go on
+                reason = step( cpu)
+                if reason:
+                    return reason
+                continue
 
+        return reason
 
-def parse_report( fname = "report.txt"):
-    # We handle only ACME 0.96.4 reports
 
-    # regex matching the beginning of an interesting line
-    # (ie a line with some binary data attached to it)
-    BEGIN_RE = re.compile( r"^\s+([0-9]+)\s+([0-9a-f]+)\s.*$")
+def loop_step( cpu):
+    current_pc = cpu.r.pc
+    return step( cpu) or run( cpu, stop_pcs={current_pc})
 
-    LABEL_RE = re.compile( r"^\s+([0-9]+)\s+([0-9a-f]+\s+[0-9a-f]+)?\s+([^\s]+):.*$")
 
-    ZP_RE = re.compile( r"^\s+[0-9]+\s+([^\s]+)\s*=\s*(\$?[0-9A-Fa-f]+).*$")
+def reverse_go( cpu):
+    """ Go back to the last breakpoint (whose condition is met), "pc",
+    or to the beginning of the history, "start".
+    """
+    while True:
+        reason = history.reverse_continue( breakpoints.addresses)
+        if reason != "pc" or breakpoints.hit( cpu):
+            return reason
+
+
+def machine_changed( cpu):
+    """ The machine's state was changed behind the MMU's back (reset,
+    time travel), resync what watches it.
+    """
+    cpu.watchpoints.resync()
+    if profiling:
+        call_profiler.restart()
+    if viewer:
+        viewer.renderer.invalidate()
+
+
+def stop_message( reason, cpu):
+    """ What to tell the user about why the CPU stopped (None if there's
+    nothing special to say)
+    """
+    if reason == "halted":
+        return "The 6502 is halted (KIL)" + (", 'H' shows the last instructions" if tracer else "")
+    elif reason == "start":
+        return f"Back at the beginning of the history (cycle {cpu.cc})"
+    elif reason == "brk":
+        return f"BRK at ${cpu.stopPc:04X}, 'H' shows the last instructions"
+    elif reason == "breakpoint":
+        bp = breakpoints.breakpoints[cpu.r.pc]
+        if bp.error:
+            return f"Breakpoint ${bp.address:04X}: {bp.error}"
+        return f"Breakpoint {bp} (hit {bp.hits} times)"
+    elif reason == "watchpoint":
+        hit = cpu.watchpoints.hit
+        old = f"${hit.old:02X}" if hit.old is not None else "?"
+        s = f"Watch {hit.watchpoint}: ${hit.address:04X} {old} -> ${hit.new:02X} by PC=${cpu.stopPc:04X}"
+        if hit.watchpoint.error:
+            s = f"Watch {WATCH_KINDS[hit.watchpoint.kind]} {hit.watchpoint.name}: {hit.watchpoint.error}, by PC=${cpu.stopPc:04X}"
+        return s + source_position( cpu.stopPc)
+    return None
+
+
+def source_position( addr):
+    """ " line N (label+offset)" : where addr is in the source, "" if
+    it's not in the listing.
+    """
+    line, label, offset = line_index.locate( addr)
+    if line is None:
+        return ""
+    s = f" line {line+1}"
+    if label:
+        s += f" ({label}+{offset})" if offset else f" ({label})"
+    return s
+
+
+def go( cpu):
+    """ Run until a breakpoint or a watchpoint (or KIL).
+    """
+    return step( cpu) or run( cpu)
 
-    OPCODE_RE = re.compile( r"^\s+([0-9]+)\s+([0-9a-f]+)\s([0-9a-f]{2}).*$")
-    lines_addr = dict()
-    lines = []
 
-    last_label = None
-    last_data_label = None
+def smart_step( cpu, step_over=False):
+    mmu = cpu.mmu
+    pc = cpu.r.pc
+    opcode = mmu.peek(pc)
+    if opcode == 0x20 and step_over:
+        # JSR, run until the subroutine has returned (ie the return
+        # address is popped)
+        current_s = cpu.r.s
+        return step( cpu) or run( cpu, stop_when_sp_above=(current_s - 1) & 0xFF)
+    elif opcode == 0:
+        # BRK
+        pass
+    else:
+        return step( cpu)
 
-    locations = []
-    default_pc = DEFAULT_PC
-    first_star = False
 
-    cpu = CPU()
+def read_report( parse, *paths):
+    """ The lines of a report (a report.Listing), parse( *paths)
+    (report.parse_acme or report.parse_ca65), parsing only if the files
+    changed since the last time.
+    """
+    return cached( parse, paths, Listing.encode, Listing.decode)
 
-    with open(fname,"r") as fin:
-        fiter = fin.readlines()[2:]
-        for real_nr, line in enumerate(fiter):
-            line = line.rstrip().replace("\t"," "*8)
 
-            line = "{: 6d}{}".format( real_nr+1, line[6:])
+def locate_line( s, lines):
+    """ Line number (0 based) of s : a line number (1 based) or a label
+    (see SymbolIndex.search : exact, else a prefix, else a part of it).
+    Raises SymbolError if the label is unknown or ambiguous.
+    """
+    if s is None:
+        return None
 
-            source = line
-            source_label = None
-            cycles = None
+    try:
+        return int( s) - 1
+    except ValueError as ex:
+        line, addr = lines.symbols.resolve( s)
+        return line
+
+
+def line_address( s, lines):
+    """ Address of a line given like locate_line wants it, or directly
+    as an address ($800).  If the line has no code (a label alone, a
+    comment), the address of the next line with code.
+    """
+    if s.startswith("$") or s.startswith("0x"):
+        return hex_to_int( s)
+
+    i = locate_line( s, lines)
+    if i is not None:
+        for i in range( i, len( lines)):
+            if lines.address( i) is not None:
+                return lines.address( i)
+    return None
+
+
+def symbols_of( lines, locations):
+    """ label -> address, for the breakpoints' conditions (the first
+    definition of the labels defined several times)
+    """
+    symbols = {label: addr for label, addr, width in locations if label and addr is not None}
+    for name in lines.label_names:
+        if name not in symbols:
+            for line, addr in lines.symbols.definitions( name):
+                if addr is not None:
+                    symbols[name] = addr
+                    break
+    return symbols
 
-            if ";" in line:
-                line = line[0:line.index(';')]
 
-            m = BEGIN_RE.match(line)
-            addr = None
+def goto_command( s, lines, current):
+    """ The line to show for "goto" s : a line number or a label ; a label
+    defined several times goes to its first definition after line
+    current (then back to the first one).  Returns (line, message).
+    """
+    s = s.strip()
+    if s.isdigit():
+        return min( max( int( s) - 1, 0), len( lines) - 1), None
 
-            if m:
-                line_n = m.groups()[0]
-                addr = int( m.groups()[1], 16)
-                lines_addr[addr] = len(lines)
+    try:
+        name = lines.symbols.lookup( s)
+    except SymbolError as ex:
+        return None, str( ex)
+    definitions = [line for line, addr in lines.symbols.definitions( name)]
+    after = [line for line in definitions if line > current]
+    line = after[0] if after else definitions[0]
+    if len( definitions) == 1:
+        return line, None
+    return line, f"{name}: definition {definitions.index( line) + 1} of {len( definitions)}"
+
+
+def done_on_enter( char):
+    if char in [10, 13, curses.KEY_ENTER, curses.ascii.BEL]:
+        return curses.ascii.BEL
+    return char
+
+
+def prompt( max_x, text=">", complete=None):
+    """ Read a line in the status line.  complete( word) : the
+    completions of the word being typed, for the Tab key.
+    """
+    from curses.textpad import Textbox
+
+    stdscr.addstr(0,0, text + " "*(max_x-1-len(text)))
+    curses.curs_set(True)
+    stdscr.move(0,len(text)+1)
+    tb = Textbox(stdscr)
+    #tb.stripspaces = True
+
+    def validate( char):
+        if char != 9 or not complete:   # Tab
+            return done_on_enter( char)
+
+        y, x = stdscr.getyx()
+        word = stdscr.instr( 0, len(text)+1, x-len(text)-1).decode( "latin-1")
+        for sep in " ,-":
+            word = word.rsplit( sep, 1)[-1]
+        completions = complete( word) if word else []
+        if not completions:
+            curses.beep()
+            return 0
+
+        # The candidates under the status line, then what they all
+        # start with
+        stdscr.addstr( 1, 0, " ".join( completions)[:max_x-1].ljust( max_x-1), curses.A_BOLD)
+        stdscr.move( y, x)
+        for c in os.path.commonprefix( completions)[len( word):]:
+            tb.do_command( ord( c))
+        return 0
+
+    txt = tb.edit( validate)
+    curses.curs_set(False)
 
-            m = LABEL_RE.match(line)
-            if m:
-                #print("label")
-                source_label = last_label = m.groups()[2]
-                #print( source_label)
+    return txt[len(text)+1:txt.index('\n')] # Tricky curses !
 
-            if "!word" in line:
-                if last_data_label != last_label:
-                    last_data_label = last_label
-                    #print(f"{last_data_label} at {addr:X}")
-                    locations.append( (last_data_label, addr, 2) )
 
-            if "!byte" in line:
-                if last_data_label != last_label:
-                    last_data_label = last_label
-                    #print(f"{last_data_label} at {addr:X}")
-                    locations.append( (last_data_label, addr, 1) )
+def breakpoint_command( s, lines, symbols):
+    """ Toggle a breakpoint : "line", "label" or "$addr", then optionally
+    "if condition".  Returns an error message or None.
+    """
+    where, _, condition = s.partition(" if ")
+    try:
+        addr = line_address( where.strip(), lines)
+    except SymbolError as ex:
+        return str( ex)
+    if addr is None:
+        return f"Don't understand {where}"
 
-            # Heuristic to find EQU's of ZeroPAge addresses
-            m = ZP_RE.match(line)
-            if m:
-                label, value = m.groups()
+    if addr in breakpoints and not condition.strip():
+        breakpoints.remove( addr)
+        return None
 
-                if value.startswith('$'):
-                    value = int( value[1:],16)
-                else:
-                    value = int(value)
+    try:
+        breakpoints.add( addr, condition.strip() or None, symbols)
+    except BreakpointError as ex:
+        return str( ex)
 
-                if label != '*'  and value < 256:
-                    locations.append( (label, value, 1) )
-                elif not first_star:
-                    default_pc = value
-                    first_star = True
 
-            m = OPCODE_RE.match(line)
-            if m:
-                opcode = int(m.groups()[2],16)
-                cycles = cpu.opcode_cycles[ opcode]
+def measure_command( s, cpu, lines):
+    """ Measure the cycles between two points : "start-end [passes]"
+    (lines, labels or addresses).  Returns the message for the status
+    line.
+    """
+    words = s.split()
+    if not words or words[0].count('-') != 1 or len( words) > 2:
+        return f"Don't understand {s}"
 
-            lines.append( LineInfo( addr, cycles, source_label, source) )
+    try:
+        start, end = [line_address( w.strip(), lines) for w in words[0].split('-')]
+    except SymbolError as ex:
+        return str( ex)
+    if start is None or end is None:
+        return f"Don't understand {words[0]}"
+    passes = int( words[1]) if len( words) == 2 and words[1].isdigit() else 100
+
+    result, reason = measure_passes( cpu, start, end, passes,
+                                     run=lambda cpu, stop_pcs: run( cpu, stop_pcs=stop_pcs),
+                                     step=step)
+    s = f"{words[0]}: {result}"
+    if reason != "passes":
+        s += " (" + (stop_message( reason, cpu) or f"stopped: {reason}") + ")"
+    return s
+
+
+def watch_command( s, cpu, lines, locations, symbols):
+    """ Toggle a watchpoint : "[r|w|c] target [if condition]", target being
+    a label of the data panel (watched on its width), a label, a line or an
+    address.  Returns an error message or None.
+    """
+    s, _, condition = s.partition(" if ")
+    words = s.split()
+    kind = "w"
+    if len( words) == 2:
+        kind, target = words
+    elif len( words) == 1:
+        target = words[0]
+    else:
+        return f"Don't understand {s}"
 
-            # def __init__( self, address, cycles, label, source):
+    widths = {label: (addr, width) for label, addr, width in locations}
+    if target in widths:
+        addr, length = widths[target]
+    elif target in symbols:
+        addr, length = symbols[target], 1
+    else:
+        try:
+            addr, length = line_address( target, lines), 1
+        except SymbolError as ex:
+            return str( ex)
+    if addr is None:
+        return f"Don't understand {target}"
+
+    wp = cpu.watchpoints.find( addr, kind)
+    if wp and not condition.strip():
+        cpu.watchpoints.remove( wp)
+        return None
 
-    return lines, lines_addr, locations, default_pc
+    try:
+        cpu.watchpoints.add( addr, length, kind, condition.strip() or None, symbols, name=target)
+    except BreakpointError as ex:
+        return str( ex)
+
+
+def open_trace_index():
+    """ The index of what the recorder recorded so far (to be closed) """
+    if tracer.path:
+        tracer.flush()
+        return TraceIndex( tracer.path)
+    tracer.save( TRACE_QUERY_FILE)
+    return TraceIndex( TRACE_QUERY_FILE)
+
+
+def went_back( cpu):
+    """ The CPU went back in time ('u', 'U', 'L').  A trace's cycles must
+    keep increasing (TraceIndex searches them by bisection) : the last
+    instructions recorded ('R') are forgotten, a trace file (--trace) is
+    closed.  Returns the message for the status line (None if none).
+    """
+    global tracer
+    if not tracer:
+        return None
 
+    try:
+        tracer.close()
+    except OSError as ex:
+        s = str( ex)
+    else:
+        s = f"Trace {tracer.path} stopped after {tracer.count} instructions, the CPU went back in time"
+    if tracer.path:
+        tracer = None
+        return s
+    tracer = TraceRecorder( cpu, records=TRACE_LAST, stop_on_brk=True)
+    remove_query_file()
+    return None
+
+
+def remove_query_file():
+    for path in (TRACE_QUERY_FILE, TRACE_QUERY_FILE + INDEX_SUFFIX):
+        if os.path.exists( path):
+            os.remove( path)
+
+
+def query_command( s, lines, symbols):
+    """ Query the recorded trace : "w target [before cycle]" (the last
+    write to target) or "x target" (when target was executed), target
+    being a label, a line or an address.  Returns the message for the
+    status line.
+    """
+    words = s.split()
+    if len( words) not in (2, 4) or words[0] not in ("w", "x") \
+       or (len( words) == 4 and (words[0] != "w" or words[2] != "before" or not words[3].isdigit())):
+        return f"Don't understand {s}"
+
+    target = words[1]
+    try:
+        addr = symbols[target] if target in symbols else line_address( target, lines)
+    except SymbolError as ex:
+        return str( ex)
+    if addr is None:
+        return f"Don't understand {target}"
+
+    with open_trace_index() as index:
+        if words[0] == "w":
+            before = int( words[3]) if len( words) == 4 else None
+            t = index.last_write( addr, before)
+            if t is None:
+                return f"No write to {target} (${addr:04X}) in the trace"
+            s = f"Last write to {target}: ${t.value_at( addr):02X} at cycle {t.cc} by PC=${t.pc:04X}"
+            s += source_position( t.pc)
+            return s + f" ({len( index.writes( addr, end=before))} writes)"
+
+        runs = index.executions( addr)
+        if not len( runs):
+            return f"{target} (${addr:04X}) not executed in the trace"
+        cycles = [index.cycle( i) for i in runs]
+        s = f"{target} (${addr:04X}) executed {len( cycles)} times, cycles {cycles[0]} to {cycles[-1]}"
+        if len( cycles) > 1:
+            periods = [b - a for a, b in zip( cycles, cycles[1:])]
+            s += f", every {min( periods)}/{sum( periods) / len( periods):.1f}/{max( periods)} (min/mean/max) cycles"
+        return s
+
+
+def display_source( lines, cpu, locations, pc_start, colour=False):
+    global profiler, call_profiler, profiling, tracer
 
-def display_source( lines, cpu, locations, pc_start):
     current_offset = 0
     max_y, max_x = stdscr.getmaxyx()
 
     stepped_cpu = False
     error = None
+    text_panel = False
+    symbols = symbols_of( lines, locations)
+    # For the Tab key in the prompts : the labels, and the data panel's
+    # names which aren't labels (EQU's)
+    others = sorted( set( symbols) - set( lines.name_ids))
+    def complete( word):
+        return sorted( lines.symbols.complete( word) + [name for name in others if name.startswith( word)])
+    names = {addr: label for label, addr in symbols.items()}
+    calls_panel = False
+    history_panel = False
+    goto_line = None
 
     while True:
 
-        #assert cpu.r.pc in lines_addr, f"{cpu.r.pc:X} not in lines"
+        # None if PC is out of the listing (ROM...)
+        highlighted = line_index.line( cpu.r.pc)
 
-        if cpu.r.pc in lines_addr:
-            highlighted = lines_addr[ cpu.r.pc]
-        else:
-            highlighted = 0
-            # Try to find a close line
-            for i in range(5):
-                x = cpu.r.pc - i
-                if x in lines_addr:
-                    highlighted = lines_addr[ x]
-                    break
-
-
-
-        if stepped_cpu:
+        if stepped_cpu and highlighted is not None:
             if highlighted < current_offset or highlighted >= current_offset + max_y - 1:
                 current_offset = max(0, highlighted - max_y // 2)
             stepped_cpu = False
@@ -365,10 +597,16 @@ def display_source( lines, cpu, locations, pc_start):
 
         stdscr.clear()
 
+        bp_lines = set( line_index.line( addr) for addr in breakpoints.addresses)
+        if profiler:
+            total_cycles = profiler.total_cycles() or 1
+
         old_cycle_mark = False
         cycles_count = 0
         for i in range(max_y-1):
             line_nr = i+current_offset
+            if line_nr >= len( lines):
+                break
 
             line = lines[line_nr]
 
@@ -382,7 +620,14 @@ def display_source( lines, cpu, locations, pc_start):
                 ctext = f"{line.cycle_mark:3d}"
             else:
                 ctext = "   "
-            text = "{}|{}|{}".format(line.cycles or " ", ctext, line.source[0:max_x-1])
+            text = "{}{}|{}|{}".format("*" if line_nr in bp_lines else " ", line.cycles or " ", ctext, line.source[0:max_x-1])
+
+            if profiler:
+                # Hot lines : percentage of the cycles spent on each line
+                if line.address and profiler.cycles[line.address]:
+                    text = "{:5.1f}|{}".format( 100 * profiler.cycles[line.address] / total_cycles, text)
+                else:
+                    text = "     |" + text
 
             if not line.cycle_mark:
                 old_cycle_mark = False
@@ -406,9 +651,10 @@ def display_source( lines, cpu, locations, pc_start):
         if not error:
             pc = cpu.r.pc
             c = cpu
-            opcode = cpu.mmu.read( pc)
+            opcode = cpu.mmu.peek( pc)
             cc = cpu.opcode_cycles[opcode]
             status_line = "PC=${:04X} A:${:02X},{:03d} X:${:02X},{:03d} Y:${:02X},{:03d} Flags:{} opcode:{:02X} cycles:{}".format( pc, c.r.a, c.r.a, c.r.x, c.r.x, c.r.y, c.r.y, flags6502( cpu), opcode,cc)
+            status_line += f" {cpu.io.display_mode()}"
             stdscr.addstr(0,0, status_line + " " *(max_x - len(status_line)), curses.color_pair(1))
         else:
             stdscr.addstr(0,0, error + " " *(max_x - len(error)), curses.color_pair(2))
@@ -421,10 +667,10 @@ def display_source( lines, cpu, locations, pc_start):
             for label, addr, width in locations:
 
                 if width == 2:
-                    v_int = cpu.mmu.readWord( addr)
+                    v_int = cpu.mmu.peekWord( addr)
                     v = "${:04X}".format(v_int)
                 else:
-                    v_int = cpu.mmu.read( addr)
+                    v_int = cpu.mmu.peek( addr)
                     v = "${:02X}".format(v_int)
 
                 s = f"{label}: {v} ({v_int:d})"
@@ -441,6 +687,39 @@ def display_source( lines, cpu, locations, pc_start):
                 s = "|" + s
                 stdscr.addstr(y+1, max_x - longest - 1, s, curses.color_pair(1))
 
+        if calls_panel:
+            # The most expensive subroutines
+            top = call_profiler.top( max_y - 2)
+            total = max( [st.inclusive for st in top] + [1])
+            rows = [f"{'subroutine':20} {'calls':>8} {'inclusive':>11} {'exclusive':>11} {'%incl':>6}"]
+            for st in top:
+                rows.append( f"{st.name[:20]:20} {st.calls:8d} {st.inclusive:11d} {st.exclusive:11d} {100*st.inclusive/total:6.1f}")
+            for y, row in enumerate( rows):
+                stdscr.addstr( y+1, 0, row[:max_x-1], curses.color_pair(1))
+
+        if history_panel and tracer:
+            # The last instructions executed, the last one at the bottom
+            rows = [f"{'cycles':>10} {'PC':5} A  X  Y  S  P  {'write':11} where"]
+            for t in tracer.last_records( max_y - 3):
+                # The first write, and how many more (JSR, BRK)
+                write = f"${t.addr:04X}:{t.value:02X}" if t.writes else ""
+                if t.writes > 1:
+                    write += f"+{t.writes - 1}"
+                line = source_position( t.pc)
+                rows.append( f"{t.cc:10d} ${t.pc:04X} {t.a:02X} {t.x:02X} {t.y:02X} {t.s:02X} {t.p:02X} {write:11}{line}")
+            for y, row in enumerate( rows):
+                stdscr.addstr( y+1, 0, row[:max_x-1], curses.color_pair(1))
+
+        if text_panel:
+            if max_y > TEXT_ROWS_COUNT + 1 and max_x > TEXT_COLUMNS + 2:
+                x = max_x - TEXT_COLUMNS - 2
+                for y, s in enumerate( render_text( cpu.mmu.blocks[0]['memory'], text_page( cpu))):
+                    stdscr.addstr(max_y - TEXT_ROWS_COUNT - 1 + y, x, "|" + s + "|", curses.color_pair(1))
+                stdscr.addstr(max_y - 1, x, "+" + "-"*TEXT_COLUMNS + "+", curses.color_pair(1))
+            else:
+                text_panel = False
+                error = "The window is too small for the text page"
+
 
         stdscr.refresh()
         k = stdscr.getch()
@@ -458,45 +737,154 @@ def display_source( lines, cpu, locations, pc_start):
         elif k == curses.KEY_PPAGE:
             current_offset -= step
         elif k == ord(' '):
-            smart_step( cpu)
+            error = stop_message( smart_step( cpu), cpu)
             stepped_cpu = True
         elif k == ord('l'):
-            loop_step( cpu)
+            error = stop_message( loop_step( cpu), cpu)
             stepped_cpu = True
         elif k == ord('p'):
-            smart_step( cpu, True)
+            error = stop_message( smart_step( cpu, True), cpu)
+            stepped_cpu = True
+        elif k == ord('g'):
+            error = stop_message( go( cpu), cpu)
+            stepped_cpu = True
+        elif k == ord('b'):
+            error = breakpoint_command( prompt( max_x, "break>", complete), lines, symbols)
+        elif k == ord('B'):
+            breakpoints.clear()
+        elif k == ord('m'):
+            error = measure_command( prompt( max_x, "measure>", complete), cpu, lines)
             stepped_cpu = True
+        elif k == ord('w'):
+            error = watch_command( prompt( max_x, "watch>", complete), cpu, lines, locations, symbols)
+        elif k == ord('W'):
+            cpu.watchpoints.clear()
+        elif k == ord('P'):
+            profiling = not profiling
+            if profiling:
+                profiler = Profiler()
+                call_profiler = CallProfiler( cpu, names)
+                call_profiler.install()
+            else:
+                call_profiler.uninstall()
+        elif k == ord('T'):
+            if call_profiler:
+                calls_panel = not calls_panel
+            else:
+                error = "No call profile, start profiling with 'P'"
+        elif k == ord('F'):
+            if call_profiler:
+                fname = prompt( max_x, "folded stacks to>").strip()
+                if fname:
+                    try:
+                        call_profiler.export_folded( fname)
+                    except OSError as ex:
+                        error = str( ex)
+            else:
+                error = "No call profile, start profiling with 'P'"
+        elif k == ord('E'):
+            if profiler:
+                fname = prompt( max_x, "export to>").strip()
+                if fname:
+                    try:
+                        profiler.export( fname, lines)
+                    except OSError as ex:
+                        error = str( ex)
+            else:
+                error = "Nothing to export, start profiling with 'P'"
+        elif k == ord('R'):
+            if tracer:
+                try:
+                    tracer.close()
+                except OSError as ex:
+                    error = str( ex)
+                tracer = None
+                history_panel = False
+                remove_query_file()
+            else:
+                tracer = TraceRecorder( cpu, records=TRACE_LAST, stop_on_brk=True)
+                error = f"Recording the last {TRACE_LAST} instructions"
+        elif k == ord('H'):
+            if tracer:
+                history_panel = not history_panel
+            else:
+                error = "No trace, start recording with 'R'"
+        elif k == ord('Q'):
+            if tracer:
+                try:
+                    error = query_command( prompt( max_x, "query>", complete), lines, symbols)
+                except (OSError, ValueError) as ex:
+                    error = str( ex)
+            else:
+                error = "No trace, start recording with 'R'"
         elif k == ord('r'):
             cpu.reset(pc_start)
+            machine_changed( cpu)
+            if history:
+                history.restart()
             stepped_cpu = True
+        elif k == ord('S'):
+            fname = prompt( max_x, "save state to>").strip()
+            if fname:
+                try:
+                    save_state( cpu, fname)
+                except OSError as ex:
+                    error = str( ex)
+        elif k == ord('L'):
+            fname = prompt( max_x, "load state from>").strip()
+            if fname:
+                try:
+                    load_state( cpu, fname)
+                    machine_changed( cpu)
+                    if history:
+                        history.restart()
+                    error = went_back( cpu)
+                except (OSError, SnapshotError) as ex:
+                    error = str( ex)
+                stepped_cpu = True
+        elif k == ord('u'):
+            if history:
+                if not history.back():
+                    error = stop_message( "start", cpu)
+                machine_changed( cpu)
+                error = went_back( cpu) or error
+                stepped_cpu = True
+            else:
+                error = "No history, start with --history"
+        elif k == ord('U'):
+            if history:
+                error = stop_message( reverse_go( cpu), cpu)
+                machine_changed( cpu)
+                error = went_back( cpu) or error
+                stepped_cpu = True
+            else:
+                error = "No history, start with --history"
         elif k == ord('q'):
             return False
         elif k == curses.KEY_F2:
             show_hgr(cpu,page=0x2000)
         elif k == curses.KEY_F4:
             show_hgr(cpu,page=0x4000)
+        elif k == curses.KEY_F3:
+            show_hgr(cpu,page=0x2000,colour=True)
+        elif k == curses.KEY_F5:
+            show_hgr(cpu,page=0x4000,colour=True)
+        elif k == curses.KEY_F6:
+            error = toggle_viewer( cpu, colour)
+        elif k == curses.KEY_F7:
+            show_text(cpu)
+        elif k == curses.KEY_F8:
+            show_lores(cpu)
+        elif k == ord('t'):
+            text_panel = not text_panel
+        elif k == ord('j'):
+            # From the last line we jumped to, if it's still shown
+            if goto_line is None or not current_offset <= goto_line < current_offset + max_y:
+                goto_line = current_offset - 1
+            goto_line, error = goto_command( prompt( max_x, "goto>", complete), lines, goto_line)
+            if goto_line is not None:
+                current_offset = max( 0, goto_line - max_y // 2)
         elif k == ord('c'):
-            from curses.textpad import Textbox
-
-            def locate_line( s, lines):
-                if s is None:
-                    return None
-
-                try:
-                    return int( s) - 1
-                except ValueError as ex:
-                    for i,line in enumerate(lines):
-                        if line.label and s in line.label:
-                            return i
-                    return None
-
-
-            def done_on_enter( char):
-                if char in [10, 13, curses.KEY_ENTER, curses.ascii.BEL]:
-                    return curses.ascii.BEL
-                return char
-
-
             def split_cycles_command( s, lines):
                 pairs = [p.split('-') for p in s.split(',')]
 
@@ -518,31 +906,25 @@ def display_source( lines, cpu, locations, pc_start):
                 return npairs
 
 
-            stdscr.addstr(0,0, ">" + " "*(max_x-2))
-            curses.curs_set(True)
-            stdscr.move(0,2)
-            tb = Textbox(stdscr)
-            #tb.stripspaces = True
-            txt = tb.edit( done_on_enter)
-            curses.curs_set(False)
-
-            input_line = txt[2:txt.index('\n')] # Tricky curses !
+            input_line = prompt( max_x, complete=complete)
 
             #line = "compute_line-y1_smaller"
 
 
-            ranges = split_cycles_command( input_line, lines)
+            try:
+                ranges = split_cycles_command( input_line, lines)
+            except SymbolError as ex:
+                ranges, error = None, str( ex)
             total = 0
             if ranges:
-                for line in lines:
-                    line.cycle_mark = False
+                lines.clear_cycle_marks()
 
                 for p in ranges:
                     for i in range( p[0], p[1]+1):
                         if lines[i].cycles:
                             total += lines[i].cycles
                         lines[i].cycle_mark = total
-            else:
+            elif not error:
                 error = f"Don't understand {input_line}"
 
 
@@ -560,10 +942,12 @@ def display_source( lines, cpu, locations, pc_start):
                 return False
 
 
+        refresh_viewer()
+
+        if current_offset > len(lines) - max_y:
+            current_offset = len(lines) - max_y
         if current_offset < 0:
             current_offset = 0
-        elif current_offset > len(lines) - max_y:
-            current_offset = len(lines) - max_y
 
 
 
@@ -584,22 +968,85 @@ In the program, these keys are available :
 - 'space' to step one instruction (will go inside JSR calls)
 - 'p' to step over
 - 'r' to reset at the beginning of the simulation
+- 'u' to step back one instruction (undo, with --history)
+- 'S' save the state of the machine (registers, memory, soft switches)
+  to a file, 'L' load it back (for example, to skip a long setup)
+- 'U' to go back to the last breakpoint (or as far back as the history
+  goes : the last 16 million instructions or so, with --history)
 - 'c' to define ranges of cycle counting. For example
   to count cycles from line 20 to 30, hit 'c' then type '20-30'
   in the status line (top of screen) then enter. Instead of line
   numbers, you can give labels' names.
   You can also give several ranges separated by ','
+- 'j' jump to a label (or a line number) in the source. A label defined
+  several times : 'j' again goes to the next definition
+- Where a label is expected, Tab completes it (the candidates are shown
+  below the prompt) and a label can be given by its beginning, or a part
+  of it, as long as only one label matches
 - 'l' run until the 6502 PC comes back to the same point (useful for executing loops)
+- 'm' measure the cycles actually taken between two points. Hit 'm' then
+  type 'start-end' (lines, labels or addresses) and, optionally, the
+  number of passes (default 100), for example 'draw_sprite-sprite_done 50'.
+  The code runs until that many passes are done and the min/max/mean
+  cycles per pass are shown in the status line
+- 'b' toggle a breakpoint. Hit 'b' then type a line number, a label or an
+  address ($1234), optionally followed by a condition, for example :
+  'draw_line if X==0 && mem[$FB]>$80'. Conditions can use the registers
+  (A X Y S P PC), the flags (N V B D I Z C), mem[addr], word[addr] and
+  the labels.  Lines with a breakpoint are marked with a '*'.
+- 'B' remove all the breakpoints
+- 'g' run until a breakpoint ('l' and 'p' stop on breakpoints too)
+- 'w' toggle a watchpoint. Hit 'w' then type 'r', 'w' or 'c' (stop when
+  the memory is read, written or changed, default 'w') then a label,
+  a line or an address, optionally followed by a condition (see 'b'),
+  for example 'c ptr if word[ptr] > $4000'.  The labels of the data
+  panel are watched on their width (1 or 2 bytes)
+- 'W' remove all the watchpoints
+- 'P' start (or stop) profiling : the cycles actually spent on each line
+  (as a percentage of the profiled cycles) are shown in a column on the
+  left.  Starting again clears the profile
+- 'E' export the profile (hottest lines first) to a file, as CSV if its
+  name ends with .csv, else as text
+- 'T' show/hide the subroutines which take the most cycles : calls,
+  inclusive and exclusive cycles (a JSR starts a subroutine)
+- 'F' export the call stacks in the "folded" format of the flamegraph
+  tools (flamegraph.pl, inferno, speedscope)
+- 'R' start (or stop) recording the executed instructions : the last
+  100000 are kept (with the registers, the cycle counter and the byte
+  written) and the execution stops after a BRK, for post-mortem.  With
+  --trace, all of them are written to a file and 'R' stops that
+- 'H' show/hide the last instructions recorded, with where they are in
+  the source (line, label+offset)
+- 'Q' query the recorded instructions. Hit 'Q' then type 'w target' for
+  the last write to target (a label or an address), 'w target before
+  cycle' for the last one before that cycle, or 'x target' (a label, a
+  line or an address) to know how many times and when it was executed
 - 'F2'/'F4' show HGR ($2000) or HGR2 ($4000) page in black and white
+- 'F3'/'F5' same thing, in colour (NTSC artifact colours)
+- 'F6' open/close a window showing the HGR page live (the one displayed
+  by the soft switches, HGR or HGR2), updated while the code runs
+  (in colour with --colour)
+- 'F7'/'F8' show the text page ($400, or $800 for page 2) as text or as LORES
+- 't' show/hide the text page in a panel, updated on each step
 - 'Up/Down/PgUp/PgDn' to browse the code
 - 'Esc' to quit.
 - 'Ctrl-C' to quit if the emulation get stuck in a loop :-)
 
+To record what the code draws, without the debugger :
+
+   python debug6502/acmeint.py -d build/CODE 0x800 --capture anim.gif
+
 Watch out !
 
 - The interpreter doesn't look at your source code at all.
 - In particular, the CA65 interpreter don't understand macro's at all (it's still useful though, just step through the macros).
-- It's python everywhere, so running chunks of code can be slow (for example, on my PC, clearing an HGR page takes a second)
+- The $C0xx soft switches (keyboard, speaker, display modes) are emulated,
+  the current display mode is shown at the end of the status line. Use --keys
+  to feed the keyboard.
+- It's python everywhere, so running chunks of code can be slow. Clearing an
+  HGR page with a STA (ptr),Y loop takes about 3 ms when 'g' runs the
+  translated blocks (no watchpoint, no HGR window, no profiling, no trace),
+  14 ms otherwise and 23 ms with --reference-cpu.
 
 This program is super alpha...
 """, formatter_class=argparse.RawTextHelpFormatter)
@@ -608,8 +1055,19 @@ This program is super alpha...
 
 parser.add_argument('--report','-r',help="ACME source report (use ACME's -r option)")
 parser.add_argument('--report-ca65','-ca65',nargs=2,metavar=('source','mapfile'),help="CA65 source report and map file (see ca65 --listing and ld65 --mapfile)")
-parser.add_argument('--default-pc','-l',help=f'PC value on startup (default to ${DEFAULT_PC:X})', default=DEFAULT_PC)
+parser.add_argument('--default-pc','-l',help=f'PC value on startup (default to ${DEFAULT_PC:X})', default=f"${DEFAULT_PC:X}")
 parser.add_argument('--load','-d',action='append',nargs='*',metavar=('path','addr'),help=f'Load binary (code or data) file with path at address addr in 6502 RAM. Address can be decimal or hexa ($ or 0x prefix)')
+parser.add_argument('--reference-cpu',action='store_true',help="Use py65emu's original (slower) CPU core instead of the generated one")
+parser.add_argument('--keys',help="Keys to feed the Apple II keyboard ($C000), one at a time, each time the code clears the strobe ($C010)")
+parser.add_argument('--colour',action='store_true',help="Show the live HGR window (F6) and the captured frames in colour")
+parser.add_argument('--capture',metavar='path',help="Don't debug, run the code and capture the HGR page every --capture-every cycles. path is a .gif file (animated GIF) or a PNG file name pattern (frames/f%%05d.png) or a directory. No report needed.")
+parser.add_argument('--capture-every',metavar='cycles',default=str(CYCLES_PER_FRAME),help=f"Cycles between two captured frames (default {CYCLES_PER_FRAME}, one Apple II frame)")
+parser.add_argument('--capture-frames',metavar='n',default="100",help="Number of frames to capture (default 100)")
+parser.add_argument('--capture-page',metavar='addr',default="$2000",help="HGR page to capture (default $2000)")
+parser.add_argument('--trace',metavar='path',help="Record every executed instruction (registers, cycle counter, byte written) in path, gzip compressed if path ends with .gz. Works with --capture too.")
+parser.add_argument('--load-state',metavar='path',help="Start from a state saved with 'S' (instead of --default-pc and the files loaded with -d)")
+parser.add_argument('--history',action='store_true',help="Record the history needed to go back in time ('u', 'U'), the code runs about twice as slow")
+parser.add_argument('--no-io',action='store_true',help="Treat $C000-$C0FF as plain RAM instead of the Apple II soft switches")
 
 def hex_to_int( s):
     hexa = s.startswith("$") or s.startswith("0x")
@@ -622,7 +1080,7 @@ def hex_to_int( s):
 if __name__ == "__main__":
     args = parser.parse_args()
 
-    if not args.report and not args.report_ca65:
+    if not args.report and not args.report_ca65 and not args.capture:
         print("For ACME, specify an ACME source report.  For CA65 specify a source report and a map file")
         exit()
 
@@ -652,9 +1110,12 @@ if __name__ == "__main__":
 
 
     if args.report_ca65:
-        lines, lines_addr, locations, source_pc = parse_report_ca65( *args.report_ca65)
+        lines = read_report( parse_ca65, *args.report_ca65)
+    elif args.report:
+        lines = read_report( parse_acme, args.report)
     else:
-        lines, lines_addr, locations, source_pc = parse_report( args.report)
+        lines = Listing( "acme", None)
+    line_index, locations, source_pc = lines.index, lines.locations, lines.default_pc
 
     if args.default_pc:
         pc = hex_to_int( args.default_pc)
@@ -665,7 +1126,29 @@ if __name__ == "__main__":
 
     print(f"PC set to ${pc:04X}")
 
-    cpu = init_cpu( mem, pc)
+    cpu = init_cpu( mem, pc, fast=not args.reference_cpu, io=not args.no_io)
+    if args.load_state:
+        load_state( cpu, args.load_state)
+        print(f"State {args.load_state} loaded, PC set to ${cpu.r.pc:04X}")
+    if args.keys:
+        cpu.io.press( args.keys)
+
+    if args.trace:
+        tracer = TraceRecorder( cpu, args.trace, compress=args.trace.endswith( ".gz"), stop_on_brk=not args.capture)
+
+    if args.capture:
+        capture = FrameCapture( cpu.mmu, args.capture, hex_to_int( args.capture_page),
+                                hex_to_int( args.capture_every), args.colour)
+        try:
+            capture.run( cpu, hex_to_int( args.capture_frames), trace=tracer)
+        finally:
+            capture.close()
+            if tracer:
+                tracer.close()
+        print(f"{capture.frames} frames captured in {args.capture} ({cpu.cc} cycles)")
+        if tracer:
+            print(f"{tracer.count} instructions recorded in {args.trace}")
+        exit()
 
 
 
@@ -678,6 +1161,9 @@ if __name__ == "__main__":
     # print( f"{cpu.r.pc:X}")
     # exit()
 
+    if args.history:
+        history = History( cpu)
+
     stdscr = curses.initscr()
     curses.start_color()
     curses.init_pair(1, curses.COLOR_WHITE, curses.COLOR_BLUE)
@@ -690,7 +1176,7 @@ if __name__ == "__main__":
 
     stored_exception = None
     try:
-        display_source( lines, cpu, locations, pc)
+        display_source( lines, cpu, locations, pc, colour=args.colour)
     except Exception as ex:
         stored_exception = traceback.format_exc()
     finally:
@@ -698,6 +1184,10 @@ if __name__ == "__main__":
         stdscr.keypad(False)
         curses.echo()
         curses.endwin()
+        if tracer:
+            tracer.close()
+        remove_query_file()
+        lines.close()
 
     if stored_exception:
         print("Error!")
@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+"""
+The bits of the Apple II hardware the debugger emulates : the $C0xx soft
+switches (keyboard, speaker and display modes).
+"""
+
+from collections import deque
+
+KEYBOARD = 0xC000       # Last key pressed, bit 7 set if not yet read
+KEYBOARD_STROBE = 0xC010  # Any access clears the keyboard strobe
+SPEAKER = 0xC030        # Any access toggles the speaker
+
+CPU_FREQUENCY = 1020484  # Hz (NTSC)
+CYCLES_PER_FRAME = 17030  # 6502 cycles per (NTSC) video frame
+
+# Display soft switches, $C050 to $C057 : (attribute, value)
+DISPLAY_SWITCHES = {
+    0xC050: ("text", False),   # TXTCLR
+    0xC051: ("text", True),    # TXTSET
+    0xC052: ("mixed", False),  # MIXCLR
+    0xC053: ("mixed", True),   # MIXSET
+    0xC054: ("page2", False),  # LOWSCR
+    0xC055: ("page2", True),   # HISCR
+    0xC056: ("hires", False),  # LORES
+    0xC057: ("hires", True),   # HIRES
+}
+
+
+class SoftSwitches:
+    """
+    Soft switches of the $C0xx page.  Once installed, the 6502 code can
+    switch display modes, poll the keyboard and click the speaker; we
+    just record what it did.
+    """
+
+    def __init__(self, cpu):
+        self.cpu = cpu
+
+        self.text = True
+        self.mixed = False
+        self.page2 = False
+        self.hires = False
+
+        self.keys = deque()  # keys waiting to be "typed"
+        self.key = 0         # keyboard latch
+        self.strobe = False
+
+        self.speaker_clicks = 0
+        self.last_click_cycle = None
+
+    def install(self, mmu):
+        mmu.addIOHandlers(KEYBOARD, 0x10, read=self.read_keyboard)
+        mmu.addIOHandlers(KEYBOARD_STROBE, 0x10, read=self.read_strobe, write=self.write_strobe)
+        mmu.addIOHandlers(SPEAKER, 0x10, read=self.read_speaker, write=self.write_speaker)
+        mmu.addIOHandlers(0xC050, 8, read=self.read_display, write=self.write_display)
+
+    STATE = ("text", "mixed", "page2", "hires", "key", "strobe",
+             "speaker_clicks", "last_click_cycle")
+
+    def state(self):
+        """
+        The switches, the keyboard and the speaker as plain values (for
+        the snapshots and the save states).
+        """
+        state = {name: getattr(self, name) for name in self.STATE}
+        state["keys"] = list(self.keys)
+        return state
+
+    def restore_state(self, state):
+        for name in self.STATE:
+            setattr(self, name, state[name])
+        self.keys = deque(state["keys"])
+
+    def press(self, keys):
+        """
+        Queue keys (a string) for the keyboard, they'll be delivered one
+        after the other, each time the 6502 clears the strobe.
+        """
+        self.keys.extend(ord(c) & 0x7F for c in keys)
+        if not self.strobe:
+            self._next_key()
+
+    def _next_key(self):
+        if self.keys:
+            self.key = self.keys.popleft()
+            self.strobe = True
+
+    def read_keyboard(self, addr):
+        return self.key | (0x80 if self.strobe else 0)
+
+    def read_strobe(self, addr):
+        self.write_strobe(addr, 0)
+        return self.key
+
+    def write_strobe(self, addr, value):
+        self.strobe = False
+        self._next_key()
+
+    def read_speaker(self, addr):
+        self.write_speaker(addr, 0)
+        return 0
+
+    def write_speaker(self, addr, value):
+        self.speaker_clicks += 1
+        self.last_click_cycle = self.cpu.cc
+
+    def read_display(self, addr):
+        self.write_display(addr, 0)
+        return 0
+
+    def write_display(self, addr, value):
+        attr, state = DISPLAY_SWITCHES[addr]
+        setattr(self, attr, state)
+
+    def display_mode(self):
+        """
+        Short description of the display mode, for example "HGR2 mixed".
+        """
+        if self.text:
+            mode = "TEXT"
+        else:
+            mode = "HGR" if self.hires else "GR"
+        mode += "2" if self.page2 else "1"
+        if self.mixed and not self.text:
+            mode += " mixed"
+        return mode
@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the report parsers (see report.py) : time and peak memory to
+parse generated ACME and CA65 listings, and to read them back from their
+cache (as the next sessions do).  Given the acmeint.py of an older
+version (the one before report.py, parse_report and parse_report_ca65),
+its parsers are measured too, for the comparison :
+
+    git show 7f83ee6:acmeint.py > /tmp/old_acmeint.py
+    python bench_report.py [number of lines] [/tmp/old_acmeint.py]
+"""
+
+import importlib.util
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from report import Listing, cached, parse_acme, parse_ca65
+
+# (opcode, source) of the instructions the listings are made of
+INSTRUCTIONS = [(0xA9, "lda #${:02x}"), (0x8D, "sta ${:02x}00"), (0xE8, "inx"),
+                (0xD0, "bne loop{}"), (0x20, "jsr sub{}"), (0x60, "rts"),
+                (0xB1, "lda (${:02x}),y"), (0x9D, "sta ${:02x}00,x")]
+SIZES = {0xA9: 2, 0x8D: 3, 0xE8: 1, 0xD0: 2, 0x20: 3, 0x60: 1, 0xB1: 2, 0x9D: 3}
+
+
+def _statements( n):
+    """ (kind, label, opcode, bytes, source) : what each line contains """
+    rnd = random.Random( 6502)
+    for nr in range( n):
+        r = rnd.random()
+        if r < 0.08:
+            yield "label", f"loop{nr}", None, b"", ""
+        elif r < 0.10:
+            yield "word", f"table{nr}", None, bytes( 4), "!word 0,0"
+        elif r < 0.12:
+            yield "byte", f"flag{nr}", None, bytes( 1), "!byte 0"
+        elif r < 0.16:
+            yield "comment", None, None, b"", f"; comment {nr}"
+        else:
+            opcode, source = rnd.choice( INSTRUCTIONS)
+            data = bytes( [opcode] + [rnd.randrange( 256) for _ in range( SIZES[opcode] - 1)])
+            yield "code", None, opcode, data, source.format( rnd.randrange( 256)) + f"\t; step {nr}"
+
+
+def write_acme( path, n):
+    """ n lines of ACME report, plus a "*= $0800" line each time the code
+    would go past $FFFF (it starts again at $0800).
+    """
+    with open( path, "w") as fout:
+        fout.write( "\n; ******** Source: main.s\n")
+        fout.write( "     1                          \t*= $0800\n")
+        fout.write( "     2                          ptr = $fa\n")
+        addr = 0x800
+        nr = 3
+        for kind, label, opcode, data, source in _statements( n - 2):
+            if addr + len( data) > 0x10000:
+                fout.write( f"{nr:6d}                          \t*= $0800\n")
+                addr = 0x800
+                nr += 1
+            if kind in ("label", "comment"):
+                fout.write( f"{nr:6d}                          {label + ':' if label else source}\n")
+            else:
+                if kind in ("word", "byte"):
+                    source = label + ":\t" + source
+                fout.write( f"{nr:6d}  {addr:04x} {data.hex():16s}\t{source}\n")
+                addr += len( data)
+            nr += 1
+
+
+def write_ca65( path, map_path, n):
+    """ n lines (about) of CA65 listing and its map file : the code goes
+    in segments CODE, CODE1, CODE2... of $F800 bytes, all at $0800.
+    """
+    segments = ["CODE"]
+    with open( path, "w") as fout:
+        fout.write( "ca65 V2.18 - Git 1b7c8b5\nMain file   : main.s\nCurrent file: main.s\n\n")
+        fout.write( '000000r 1               .segment "CODE"\n')
+        addr = 0
+        for kind, label, opcode, data, source in _statements( n):
+            if addr + len( data) > 0xF800:
+                segments.append( f"CODE{len( segments)}")
+                fout.write( f'000000r 1               .segment "{segments[-1]}"\n')
+                addr = 0
+            if kind == "comment":
+                fout.write( f"{addr:06X}r 1               {source}\n")
+                continue
+            if kind == "label":
+                source = label + ":"
+            elif kind in ("word", "byte"):
+                source = label + ": ." + kind + " 0"
+            hexa = " ".join( f"{b:02X}" for b in data[:4])
+            fout.write( f"{addr:06X}r 1  {hexa:12s}\t{source}\n")
+            addr += len( data)
+
+    with open( map_path, "w") as fout:
+        fout.write( "Segment list:\n-------------\n"
+                    "Name                   Start     End    Size  Align\n"
+                    "----------------------------------------------------\n")
+        for name in segments:
+            fout.write( f"{name:20s}  000800  00FFFF  00F800  00001\n")
+        fout.write( "\n")
+
+
+def measure( parse, *paths, repeat=3):
+    """ (best time in seconds, peak memory in bytes) of parse( *paths).
+    The memory is measured on its own run, tracemalloc slows everything.
+    """
+    seconds = float( "inf")
+    for _ in range( repeat):
+        t = time.perf_counter()
+        parse( *paths)
+        seconds = min( seconds, time.perf_counter() - t)
+
+    tracemalloc.start()
+    parse( *paths)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return seconds, peak
+
+
+def load_old( path):
+    """ The acmeint module of an older version, from its path """
+    spec = importlib.util.spec_from_file_location( "old_acmeint", path)
+    module = importlib.util.module_from_spec( spec)
+    spec.loader.exec_module( module)
+    return module
+
+
+if __name__ == "__main__":
+    n = int( sys.argv[1]) if len( sys.argv) > 1 else 100000
+    old = load_old( sys.argv[2]) if len( sys.argv) > 2 else None
+
+    with tempfile.TemporaryDirectory() as tmp:
+        acme = os.path.join( tmp, "report.txt")
+        ca65, ca65_map = os.path.join( tmp, "td.txt"), os.path.join( tmp, "td_map.out")
+        write_acme( acme, n)
+        write_ca65( ca65, ca65_map, n)
+
+        for name, parse, old_parse, paths in (
+                ("ACME", parse_acme, old and old.parse_report, (acme,)),
+                ("CA65", parse_ca65, old and old.parse_report_ca65, (ca65, ca65_map))):
+            size = os.path.getsize( paths[0])
+            seconds, peak = measure( parse, *paths)
+            cached( parse, paths, Listing.encode, Listing.decode).close()
+            cache_seconds, _ = measure( lambda: cached( parse, paths, Listing.encode, Listing.decode).close())
+            print( f"{name}: {n} lines ({size / 1e6:.1f} MB) parsed in {seconds:.3f} s, "
+                   f"peak memory {peak / 1e6:.1f} MB, read back from the cache in {cache_seconds:.3f} s")
+            if old_parse:
+                old_seconds, old_peak = measure( old_parse, *paths)
+                print( f"{name}, old parser: {old_seconds:.3f} s, peak memory {old_peak / 1e6:.1f} MB "
+                       f"({old_seconds / seconds:.1f}x the time, {old_peak / peak:.1f}x the memory)")
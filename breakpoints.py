@@ -0,0 +1,323 @@
+# -*- coding: utf-8 -*-
+"""
+Breakpoints and watchpoints, possibly conditional.
+
+The CPU only stops on the breakpoints' addresses (CPU.run's stop_pcs, a
+set membership test per instruction).  The conditions are checked only
+then ; they are compiled once into Python functions.  A condition which
+can't be evaluated (a division by zero, an unmapped address) stops the
+CPU, its `error` says why.
+
+Conditions are written like this :
+
+    X==0 && mem[$FB]>$80
+    word[ptr] >= $4000 || C
+
+- A, X, Y, S, P, PC are the registers, N V B D I Z C the flags (0 or 1)
+- mem[addr] is the byte at addr, word[addr] the (little endian) word,
+  the addresses wrap around at $10000 like on the 6502
+- numbers are decimal, hexadecimal ($FB or 0xFB) or binary (%0101)
+- labels stand for their address
+- operators : == != < <= > >= && || ! + - * / & | ^ ~ << >> ( )
+
+Watchpoints stop the CPU when some memory is read, written or changed.
+They hook the MMU only on the pages they watch (see MMU.observeWrites
+and MMU.observeReads), the other pages are accessed as usual.
+"""
+
+import re
+
+from py65emu.cpu import Registers
+
+
+class BreakpointError(ValueError):
+    pass
+
+
+TOKEN_RE = re.compile( r"""\s*(?:
+    (?P<number>\$[0-9A-Fa-f]+|0x[0-9A-Fa-f]+|%[01]+|[0-9]+)|
+    (?P<name>[A-Za-z_.@][\w.@]*)|
+    (?P<op>&&|\|\||==|!=|<=|>=|<<|>>|[-+*/&|^~<>!()\[\]]))""", re.VERBOSE)
+
+REGISTERS = {"A": "r.a", "X": "r.x", "Y": "r.y", "S": "r.s", "P": "r.p", "PC": "r.pc"}
+
+OPERATORS = {"&&": " and ", "||": " or ", "!": " not ", "/": "//", "[": "(", "]": ")"}
+
+
+def _number( s):
+    if s.startswith( "$"):
+        return int( s[1:], 16)
+    elif s.startswith( "%"):
+        return int( s[1:], 2)
+    return int( s, 0) if s.startswith( "0x") else int( s)
+
+
+def condition_source( text, symbols={}):
+    """
+    Translate a condition into a Python expression over r (the registers),
+    peek and peekWord (the memory).  symbols maps labels to addresses.
+    """
+    code = []
+    pos = 0
+    text = text.strip()
+    while pos < len( text):
+        m = TOKEN_RE.match( text, pos)
+        if not m or m.end() == pos:
+            raise BreakpointError( f"Don't understand '{text[pos:]}'")
+        pos = m.end()
+
+        if m.group( "number"):
+            code.append( str( _number( m.group( "number"))))
+
+        elif m.group( "name"):
+            name = m.group( "name")
+            if name.upper() in REGISTERS:
+                code.append( REGISTERS[name.upper()])
+            elif name.upper() in Registers().flagBit:
+                code.append( f"(r.p >> {Registers().flagBit[name.upper()].bit_length()-1} & 1)")
+            elif name.lower() == "mem":
+                code.append( "peek")
+            elif name.lower() == "word":
+                code.append( "peekWord")
+            elif name in symbols:
+                code.append( str( symbols[name]))
+            else:
+                raise BreakpointError( f"Unknown name '{name}'")
+
+        else:
+            code.append( OPERATORS.get( m.group( "op"), m.group( "op")))
+
+    return "".join( code)
+
+
+def compile_condition( text, symbols={}):
+    """
+    Compile a condition (see the module's documentation) into a function
+    taking the CPU and returning True if the condition is met.  The memory
+    is read with MMU.peek : a condition doesn't trigger the I/O handlers
+    nor the read watchpoints.
+    """
+    expr = condition_source( text, symbols)
+    source = "def condition( cpu):\n" \
+        "    r = cpu.r\n" \
+        "    mmu = cpu.mmu\n" \
+        "    peek = lambda addr: mmu.peek( addr & 0xFFFF)\n" \
+        "    peekWord = lambda addr: mmu.peekWord( addr & 0xFFFF)\n" \
+        f"    return bool( {expr})\n"
+    namespace = {}
+    try:
+        exec( compile( source, f"<condition {text}>", "exec"), namespace)
+    except SyntaxError:
+        raise BreakpointError( f"Syntax error in '{text}'")
+    return namespace["condition"]
+
+
+def condition_met( point, cpu):
+    """
+    True if the condition of a breakpoint (or watchpoint) is met, or if it
+    can't be evaluated : then point.error tells why.
+    """
+    point.error = None
+    if point.test is None:
+        return True
+    try:
+        return point.test( cpu)
+    except Exception as ex:
+        point.error = f"can't evaluate '{point.condition}' ({type( ex).__name__}: {ex})"
+        return True
+
+
+class Breakpoint:
+    def __init__( self, address, condition=None, symbols={}):
+        self.address = address
+        self.condition = condition
+        self.test = compile_condition( condition, symbols) if condition else None
+        self.hits = 0
+        self.error = None  # why the condition couldn't be evaluated
+
+    def __str__( self):
+        s = f"${self.address:04X}"
+        if self.condition:
+            s += f" if {self.condition}"
+        return s
+
+
+class Breakpoints:
+    """
+    The breakpoints, by address.  `addresses` is the set to give to
+    CPU.run as stop_pcs.
+    """
+
+    def __init__( self):
+        self.breakpoints = dict()
+        self.addresses = frozenset()
+
+    def add( self, address, condition=None, symbols={}):
+        bp = Breakpoint( address, condition, symbols)
+        self.breakpoints[address] = bp
+        self.addresses = frozenset( self.breakpoints)
+        return bp
+
+    def remove( self, address):
+        del self.breakpoints[address]
+        self.addresses = frozenset( self.breakpoints)
+
+    def clear( self):
+        self.breakpoints.clear()
+        self.addresses = frozenset()
+
+    def __contains__( self, address):
+        return address in self.breakpoints
+
+    def __len__( self):
+        return len( self.breakpoints)
+
+    def hit( self, cpu):
+        """
+        The breakpoint at PC if there's one and its condition is met (or
+        failed, see condition_met), else None.
+        """
+        bp = self.breakpoints.get( cpu.r.pc)
+        if bp and condition_met( bp, cpu):
+            bp.hits += 1
+            return bp
+        return None
+
+
+WATCH_KINDS = {"r": "read", "w": "write", "c": "change"}
+
+
+class Watchpoint:
+    def __init__( self, address, length=1, kind="w", condition=None, symbols={}, name=None):
+        """
+        kind : "r" (read), "w" (write) or "c" (change, a write of a
+        different value).  The condition (if any) is checked after the
+        access.
+        """
+        if kind not in WATCH_KINDS:
+            raise BreakpointError( f"Unknown watchpoint kind '{kind}'")
+
+        self.address, self.length, self.kind = address, length, kind
+        self.condition = condition
+        self.test = compile_condition( condition, symbols) if condition else None
+        self.name = name or f"${address:04X}"
+        self.hits = 0
+        self.error = None  # why the condition couldn't be evaluated
+
+    def __str__( self):
+        s = f"{WATCH_KINDS[self.kind]} {self.name}"
+        if self.condition:
+            s += f" if {self.condition}"
+        return s
+
+
+class WatchHit:
+    """ What triggered a watchpoint """
+    def __init__( self, watchpoint, address, old, new):
+        self.watchpoint, self.address, self.old, self.new = watchpoint, address, old, new
+
+
+class Watchpoints:
+    """
+    The watchpoints.  On a hit, `hit` is set (see WatchHit) and the CPU is
+    stopped (CPU.stop( "watchpoint")).
+    """
+
+    def __init__( self, cpu):
+        self.cpu = cpu
+        self.watchpoints = []
+        self.hit = None
+
+        # page -> watchpoints on that page, for reads and for writes
+        self.read_pages = dict()
+        self.write_pages = dict()
+
+        # Value of the watched bytes, to know the old value on writes
+        self.shadow = dict()
+
+    def _pages( self, wp):
+        return range( wp.address >> 8, ((wp.address + wp.length - 1) >> 8) + 1)
+
+    def add( self, address, length=1, kind="w", condition=None, symbols={}, name=None):
+        wp = Watchpoint( address, length, kind, condition, symbols, name)
+        self.watchpoints.append( wp)
+
+        mmu = self.cpu.mmu
+        for page in self._pages( wp):
+            if kind == "r":
+                if page not in self.read_pages:
+                    self.read_pages[page] = []
+                    mmu.observeReads( page, self._read)
+                self.read_pages[page].append( wp)
+            else:
+                if page not in self.write_pages:
+                    self.write_pages[page] = []
+                    mmu.observeWrites( page, self._written)
+                self.write_pages[page].append( wp)
+
+        self.resync()
+        return wp
+
+    def remove( self, wp):
+        self.watchpoints.remove( wp)
+
+        mmu = self.cpu.mmu
+        for page in self._pages( wp):
+            if wp.kind == "r":
+                pages, unobserve, f = self.read_pages, mmu.unobserveReads, self._read
+            else:
+                pages, unobserve, f = self.write_pages, mmu.unobserveWrites, self._written
+            pages[page].remove( wp)
+            if not pages[page]:
+                del pages[page]
+                unobserve( page, f)
+
+    def clear( self):
+        for wp in list( self.watchpoints):
+            self.remove( wp)
+
+    def find( self, address, kind):
+        for wp in self.watchpoints:
+            if wp.address == address and wp.kind == kind:
+                return wp
+        return None
+
+    def resync( self):
+        """
+        Take the current value of the watched bytes as their old value
+        (needed if the memory was changed behind the MMU's back, for
+        example after a reset).
+        """
+        mmu = self.cpu.mmu
+        self.shadow.clear()
+        for wp in self.watchpoints:
+            for addr in range( wp.address, wp.address + wp.length):
+                try:
+                    # Not mmu.read, it would trigger the I/O handlers
+                    # and the read watchpoints
+                    self.shadow[addr] = mmu.peek( addr)
+                except IndexError:
+                    self.shadow[addr] = None
+
+    def _trigger( self, wp, addr, old, new):
+        # In the middle of an instruction : a failing condition mustn't
+        # raise, it stops the CPU after the instruction
+        if not condition_met( wp, self.cpu):
+            return
+
+        wp.hits += 1
+        self.hit = WatchHit( wp, addr, old, new)
+        self.cpu.stop( "watchpoint")
+
+    def _read( self, addr, value):
+        for wp in self.read_pages[addr >> 8]:
+            if wp.address <= addr < wp.address + wp.length:
+                self._trigger( wp, addr, value, value)
+
+    def _written( self, addr, value):
+        old = self.shadow.get( addr)
+        for wp in self.write_pages[addr >> 8]:
+            if wp.address <= addr < wp.address + wp.length:
+                self.shadow[addr] = value
+                if wp.kind == "w" or old != value:
+                    self._trigger( wp, addr, old, value)
@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+"""
+Headless frame capture : while the 6502 runs, snapshot an HGR page every
+N cycles and save the frames as a numbered PNG sequence or as an animated
+GIF.
+
+The emulation only renders the frame (incrementally, see HgrRenderer)
+and queues a copy of it.  The PIL encoding happens in a background thread
+(zlib and the GIF encoder release the GIL) so the emulation never waits
+on image compression.
+"""
+
+import os
+import queue
+import threading
+
+from apple2 import CPU_FREQUENCY, CYCLES_PER_FRAME
+from video import HgrRenderer, pixels_image
+
+
+class FrameCapture:
+
+    def __init__( self, mmu, path, page=0x2000, every=CYCLES_PER_FRAME, colour=False, scale=1):
+        """
+        path : a .gif file for an animated GIF, else a PNG file name
+            pattern with a %d (for example "frames/f%05d.png") or a
+            directory (the frames are then frame_00000.png, ...).
+        every : number of 6502 cycles between two frames.
+        """
+        self.every = every
+        self.colour = colour
+        self.scale = scale
+        self.frames = 0
+
+        self.gif = path.lower().endswith( ".gif")
+        if self.gif or "%" in path:
+            self.path = path
+        else:
+            self.path = os.path.join( path, "frame_%05d.png")
+
+        directory = os.path.dirname( self.path)
+        if directory:
+            os.makedirs( directory, exist_ok=True)
+
+        self.renderer = HgrRenderer( mmu, page, colour=colour)
+        self.queue = queue.Queue()
+        self.error = None
+        self.thread = threading.Thread( target=self._encode, daemon=True)
+        self.thread.start()
+
+    def snapshot( self):
+        """
+        Capture the page as it is now.
+        """
+        self.renderer.render()
+        self.queue.put( bytes( self.renderer.pixels))
+        self.frames += 1
+
+    def run( self, cpu, frames, trace=None):
+        """
+        Run the CPU, taking a snapshot every `every` cycles, until `frames`
+        frames are captured or the CPU stops (KIL).  trace : a
+        TraceRecorder to record the execution with (see CPU.run).
+        """
+        next_frame = cpu.cc + self.every
+        while self.frames < frames:
+            reason, _, _ = cpu.run( max_cycles=next_frame - cpu.cc, trace=trace)
+            if reason != "cycles":
+                break
+            self.snapshot()
+            next_frame += self.every
+
+    def close( self):
+        """
+        Wait for the encoding to finish (and write the GIF).
+        """
+        self.renderer.close()
+        self.queue.put( None)
+        self.thread.join()
+        if self.error:
+            raise self.error
+
+    def _encode( self):
+        images = []
+        n = 0
+        done = False
+        try:
+            while True:
+                pixels = self.queue.get()
+                if pixels is None:
+                    done = True
+                    break
+
+                img = pixels_image( pixels, self.colour, self.scale)
+                if self.gif:
+                    images.append( img)
+                else:
+                    img.save( self.path % n)
+                n += 1
+
+            if images:
+                duration = round( 1000 * self.every / CPU_FREQUENCY)
+                images[0].save( self.path, save_all=True, append_images=images[1:],
+                                duration=duration, loop=0)
+        except Exception as ex:
+            self.error = ex
+            # Drop the frames still to come (close raises the error), up
+            # to the end marker unless it's already been taken
+            while not done:
+                done = self.queue.get() is None
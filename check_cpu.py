@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+"""
+Lockstep check of the CPU cores on random programs : the generated core
+(CPU( fast=True), see py65emu/codegen.py) against the reference one, and
+the translated basic blocks (see py65emu/blocks.py, looping or not)
+against stepping.
+
+After every instruction (every block for the blocks), the registers, the
+cycle counter, the memory and the exceptions raised must be the same.
+Run it after changing CPU._ops, codegen.py or blocks.py :
+
+    python check_cpu.py [number of programs] [instructions per program]
+"""
+
+import random
+import sys
+
+from py65emu.cpu import CPU
+from py65emu.mmu import MMU
+
+KIL = {0x02, 0x12, 0x22, 0x32, 0x42, 0x52, 0x62, 0x72, 0x92, 0xB2, 0xD2, 0xF2}
+BRANCHES = [0x10, 0x30, 0x50, 0x70, 0x90, 0xB0, 0xD0, 0xF0]
+
+# Instructions for the loops' bodies (opcode, size) : every addressing
+# mode, reads, writes, stack, flags
+LOOP_BODY = [(0x85, 2), (0x99, 3), (0x91, 2), (0x81, 2), (0x96, 2), (0x9D, 3), (0xB5, 2),
+             (0xB1, 2), (0xA1, 2), (0xAD, 3), (0xBE, 3), (0x69, 2), (0x7D, 3), (0xE5, 2),
+             (0xE6, 2), (0xDE, 3), (0x0A, 1), (0x26, 2), (0x6E, 3), (0x4A, 1), (0x29, 2),
+             (0x51, 2), (0x24, 2), (0xC9, 2), (0xC0, 2), (0xEC, 3), (0xC8, 1), (0x88, 1),
+             (0xE8, 1), (0xCA, 1), (0xAA, 1), (0x98, 1), (0x48, 1), (0x68, 1), (0x08, 1),
+             (0x28, 1), (0x18, 1), (0x38, 1), (0xF8, 1), (0xD8, 1), (0xEA, 1)]
+
+
+def random_memory( rnd):
+    """ 64K of random bytes, the code at $0800 mostly writing (to itself
+    too : self modifying code), branching around and looping.
+    """
+    mem = bytearray( rnd.randrange( 256) for _ in range( 0x10000))
+    # No KIL, it would end the programs too soon
+    mem = mem.translate( bytes( 0xEA if op in KIL else op for op in range( 256)))
+    favourites = [0x85, 0x8D, 0x91, 0x9D, 0x99, 0xE6, 0xEE, 0x20, 0x60, 0x4C, 0xD0, 0xF0, 0x08]
+    for addr in range( 0x800, 0x900):
+        if rnd.random() < 0.3:
+            mem[addr] = rnd.choice( favourites)
+        elif rnd.random() < 0.3:
+            mem[addr] = 0x08    # operands pointing into the code
+        elif rnd.random() < 0.1:
+            # A short loop
+            mem[addr:addr + 2] = bytes( [rnd.choice( BRANCHES), 256 - rnd.randrange( 3, 24)])
+    return mem
+
+
+def loop_memory( rnd):
+    """ Same as random_memory, but the code at $0800 is a run of loops
+    (a few random instructions and a branch back to the first one).
+    """
+    mem = random_memory( rnd)
+    addr = 0x800
+    while addr < 0x900:
+        start = addr
+        for _ in range( rnd.randrange( 1, 8)):
+            op, size = rnd.choice( LOOP_BODY)
+            mem[addr] = op
+            addr += size
+        mem[addr:addr + 2] = bytes( [rnd.choice( BRANCHES), (start - addr - 2) & 0xff])
+        addr += 2
+    return mem
+
+
+def make_cpu( mem, fast):
+    cpu = CPU( MMU( [(0, 0x10000, False, bytes( mem))]), 0x800, fast=fast)
+    cpu.r.p = mem[0] | 0x20
+    return cpu
+
+
+def state( cpu):
+    r = cpu.r
+    return (r.pc, r.a, r.x, r.y, r.s, r.p, cpu.cc, cpu.running)
+
+
+def memory( cpu):
+    return cpu.mmu.blocks[0]['memory']
+
+
+def outcome( f):
+    """ None, or the exception f() raised (type and message) """
+    try:
+        f()
+    except Exception as ex:
+        return type( ex).__name__, str( ex)
+    return None
+
+
+def check_cores( mem, instructions):
+    """ The reference and the generated core, instruction by instruction.
+    Returns the number of instructions checked, raises AssertionError on
+    the first difference.
+    """
+    ref, fast = make_cpu( mem, False), make_cpu( mem, True)
+    for n in range( instructions):
+        before = state( ref)
+        error = outcome( ref.step)
+        assert outcome( fast.step) == error, f"exception after {before}: {error}"
+        assert state( fast) == state( ref), f"registers after {before}: {state( fast)} != {state( ref)}"
+        assert memory( fast) == memory( ref), f"memory after {before}"
+        if error or not ref.running:
+            break
+    return n + 1
+
+
+def check_blocks( mem, instructions):
+    """ stepBlock against step, compared at each block's end (every
+    other block with up to 8 iterations of the loops).  Returns the number
+    of instructions checked.
+    """
+    blocks, stepped = make_cpu( mem, True), make_cpu( mem, True)
+    n = 0
+    loops = 8
+    while n < instructions:
+        before = state( blocks)
+        count = [0]
+        loops = 9 - loops
+
+        def run_block():
+            count[0] = blocks.stepBlock( loops)
+
+        error = outcome( run_block)
+        if error:
+            # The block is left as it was, or it wasn't translated and
+            # failed just like step
+            if state( blocks) != before:
+                assert outcome( stepped.step) == error and state( stepped) == state( blocks), \
+                    f"registers changed by the failing block at {before}"
+            return n
+        for _ in range( count[0]):
+            assert outcome( stepped.step) is None, f"block at {before} ran, step raised"
+        assert state( blocks) == state( stepped), f"registers after the block at {before}"
+        assert memory( blocks) == memory( stepped), f"memory after the block at {before}"
+        n += count[0]
+        if not blocks.running:
+            break
+    return n
+
+
+if __name__ == "__main__":
+    programs = int( sys.argv[1]) if len( sys.argv) > 1 else 100
+    instructions = int( sys.argv[2]) if len( sys.argv) > 2 else 2000
+
+    cores = blocks = 0
+    for seed in range( programs):
+        mem = (loop_memory if seed % 2 else random_memory)( random.Random( seed))
+        try:
+            cores += check_cores( mem, instructions)
+            blocks += check_blocks( mem, instructions)
+        except AssertionError as ex:
+            print( f"Program {seed}: {ex}")
+            sys.exit( 1)
+    print( f"{programs} programs : {cores} instructions in lockstep with the reference core, "
+           f"{blocks} in blocks")
@@ -0,0 +1,268 @@
+# -*- coding: utf-8 -*-
+"""
+Checks of the debugger's parts which are easy to break without noticing :
+the MMU's page tables (against a plain model of the blocks), snapshots
+and save states, the breakpoints' conditions, the report parsers and
+their indexes, the trace recorder, the undo journal.  See check_cpu.py for the CPU cores.
+
+    python check_debugger.py
+"""
+
+import os
+import random
+import sys
+import tempfile
+
+from py65emu.cpu import CPU
+from py65emu.mmu import MMU, ReadOnlyError
+from py65emu.snapshot import Snapshot
+
+import bench_report
+from breakpoints import Breakpoints, BreakpointError, compile_condition
+from exectrace import TraceIndex, TraceRecorder
+from history import History
+from report import Listing, SymbolError, parse_acme, parse_ca65
+
+# RAM, a RAM block ending in the middle of a page, a ROM, a hole
+BLOCKS = [(0x0000, 0x8000, False), (0x8000, 0x80, False), (0x8100, 0x1000, True)]
+
+
+def model_access( blocks, addr, value=None):
+    """ What the MMU should do : the first block holding addr, read (or
+    write) its memory.  Returns the value read or the exception's type.
+    """
+    for start, length, readonly, memory in blocks:
+        if start <= addr < start + length:
+            if value is None:
+                return memory[addr - start]
+            if readonly:
+                return ReadOnlyError
+            memory[addr - start] = value & 0xff
+            return None
+    return IndexError
+
+
+def mmu_access( mmu, addr, value=None):
+    try:
+        if value is None:
+            return mmu.read( addr)
+        mmu.write( addr, value)
+    except (IndexError, ReadOnlyError) as ex:
+        return type( ex)
+    return None
+
+
+def check_mmu():
+    rnd = random.Random( 6502)
+    contents = [bytes( rnd.randrange( 256) for _ in range( length)) for _, length, _ in BLOCKS]
+    mmu = MMU( [(start, length, readonly, data) for (start, length, readonly), data in zip( BLOCKS, contents)])
+    model = [(start, length, readonly, bytearray( data)) for (start, length, readonly), data in zip( BLOCKS, contents)]
+
+    for _ in range( 20000):
+        addr = rnd.randrange( 0xA000)
+        value = rnd.randrange( 256) if rnd.random() < 0.5 else None
+        assert mmu_access( mmu, addr, value) == model_access( model, addr, value), f"access to ${addr:04X}"
+    for block, (_, _, _, memory) in zip( mmu.blocks, model):
+        assert block['memory'].tobytes() == memory, "memory differs from the model"
+
+    # An observer removed by a write (the block cache's, when the code
+    # it translated is written) doesn't hide that write from the others
+    # (the CPU resets the MMU)
+    seen = []
+    cpu = CPU( mmu, 0x800, fast=True)
+    cpu.stepBlock()
+    mmu.observeWrites( 0x08, lambda addr, value: seen.append( (addr, value)))
+    mmu.write( 0x801, 5)
+    assert seen == [(0x801, 5)], seen
+
+    # Observers, I/O handlers : only where they're put, peek sees nothing
+    mmu.observeWrites( 0x12, lambda addr, value: seen.append( (addr, value)))
+    mmu.addIOHandlers( 0x1300, 1, read=lambda addr: 0x42, write=lambda addr, value: seen.append( "io"))
+    mmu.write( 0x1234, 7)
+    mmu.write( 0x1334, 8)
+    mmu.write( 0x1300, 9)
+    assert seen[1:] == [(0x1234, 7), "io"], seen
+    assert mmu.read( 0x1300) == 0x42 and mmu.peek( 0x1300) == model_access( model, 0x1300)
+    assert mmu.peekWord( 0x1234) == mmu.read( 0x1234) + (mmu.read( 0x1235) << 8)
+
+    # Reset restores what was written, in place
+    memory = mmu.blocks[0]['memory']
+    assert {0x08, 0x12} <= set( mmu.dirtyPages())
+    mmu.reset()
+    assert mmu.blocks[0]['memory'] is memory and memory.tobytes() == contents[0]
+    assert mmu.dirtyPages() == []
+
+
+def check_snapshots():
+    mem = bytearray( 0x10000)
+    mem[0x800:0x80A] = bytes( [0xA2, 0x00, 0x8A, 0x9D, 0x00, 0x20, 0xE8, 0xD0, 0xF9, 0x02])
+    cpu = CPU( MMU( [(0, 0x10000, False, mem)]), 0x800, fast=True)
+    cpu.run( max_instructions=300)
+
+    first = cpu.snapshot()
+    cpu.run()
+    second = cpu.snapshot()
+    changed = [i for i, (a, b) in enumerate( zip( first.memory[0][3], second.memory[0][3])) if a is not b]
+    assert changed == [0x20], f"only the page written is copied, not {changed}"
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for compress in (False, True):
+            path = os.path.join( tmp, "state")
+            first.extra = {"apple2": [1, 2]}
+            first.save( path, compress)
+            loaded = Snapshot.load( path)
+            cpu.restore( loaded)
+            assert cpu.snapshot().memory == first.memory and loaded.extra == first.extra
+            assert (cpu.r.pc, cpu.r.a, cpu.r.x, cpu.r.y, cpu.r.s, cpu.r.p) == first.registers
+            assert cpu.cc == first.cc and cpu.running == first.running
+    cpu.run()
+    assert cpu.snapshot().memory == second.memory, "replaying from the snapshot differs"
+
+
+def check_conditions():
+    mem = bytearray( 0x10000)
+    mem[0xFB], mem[0xFFFF], mem[0x0000] = 0x81, 0x34, 0x12
+    cpu = CPU( MMU( [(0, 0x10000, False, mem)]), 0x800)
+    cpu.r.a, cpu.r.x, cpu.r.p = 3, 0, 0x21
+    symbols = {"ptr": 0xFB}
+
+    for text, expected in [("X==0 && mem[$FB]>$80", True), ("mem[ptr] == %10000001", True),
+                           ("word[$FFFF] == $1234", True), ("mem[$10000] == $12", True),
+                           ("C && !Z", True), ("A*2+1 == 7 || PC != $800", True),
+                           ("(A & 1) == 0", False), ("~A & $FF == $FC", True)]:
+        assert compile_condition( text, symbols)( cpu) == expected, text
+
+    for text in ("A ==", "foo > 1", "A $"):
+        try:
+            compile_condition( text, symbols)
+            assert False, f"'{text}' compiled"
+        except BreakpointError:
+            pass
+
+    # A condition which can't be evaluated stops, with the reason
+    breakpoints = Breakpoints()
+    bp = breakpoints.add( 0x800, "A/X")
+    assert breakpoints.hit( cpu) is bp and "ZeroDivisionError" in bp.error
+
+
+def check_parsers():
+    with tempfile.TemporaryDirectory() as tmp:
+        acme = os.path.join( tmp, "report.txt")
+        ca65, ca65_map = os.path.join( tmp, "td.txt"), os.path.join( tmp, "td_map.out")
+        bench_report.write_acme( acme, 5000)
+        bench_report.write_ca65( ca65, ca65_map, 5000)
+
+        for listing in (parse_acme( acme), parse_ca65( ca65, ca65_map)):
+            located = [i for i in range( len( listing)) if listing.address( i) is not None]
+            for i in located[::37]:
+                addr = listing.address( i)
+                line, _, _ = listing.index.locate( addr)
+                assert listing.address( line) == addr, f"{listing.kind}: ${addr:04X} is on line {i}, not {line}"
+            for i in range( 0, len( listing), 101):
+                listing.source( i)
+
+            copy = Listing.decode( listing.encode())
+            for column in ("addresses", "sizes", "cycles", "labels", "starts"):
+                assert getattr( copy, column) == getattr( listing, column), f"{listing.kind}: {column}"
+            assert copy.locations == listing.locations and copy.label_names == listing.label_names
+            copy.close()
+
+            name = listing.label_names[10]
+            line, addr = listing.symbols.resolve( name)
+            assert listing.label( line) == name
+            try:
+                listing.symbols.resolve( "loop")   # the prefix of many labels
+                assert False, "ambiguous label resolved"
+            except SymbolError:
+                pass
+            listing.close()
+
+        # EQUs which look like addresses, line numbers filling their
+        # column, CA65 lines without code
+        with open( acme, "w") as fout:
+            fout.write( "\n; ******** Source: main.s\n"
+                        "     1                          \t*= $0800\n"
+                        "     2                          beef  = $10\n"
+                        "     3                          c  = $02\n"
+                        "     4  0800 a910              \tlda #$10\n"
+                        " 99999  0802 a900              \tlda #$00\n"
+                        "100000  0804 a900              \tlda #$00\n")
+        listing = parse_acme( acme)
+        assert listing.locations == [("beef", 0x10, 1), ("c", 0x02, 1)], listing.locations
+        assert listing.default_pc == 0x800
+        assert [listing.address( i) for i in range( 3, 6)] == [0x800, 0x802, 0x804]
+        assert listing.source( 5).split() == ["6", "0804", "a900", "lda", "#$00"]
+        listing.close()
+
+        with open( ca65, "w") as fout:
+            fout.write( "ca65 V2.18\nMain file   : main.s\nCurrent file: main.s\n\n"
+                        '000000r 1               .segment "CODE"\n'
+                        "000000r 1  01 02 03 04  tab: .byte 1,2,3,4,5,6\n"
+                        "000004r 1  05 06       \n")
+        listing = parse_ca65( ca65, ca65_map)
+        assert [listing.address( i) for i in range( len( listing))] == [None, 0x800, 0x804]
+        assert listing.source( 2).startswith( "0804 |")
+        listing.close()
+
+
+def code_writer():
+    """ A CPU about to write into the block it translated at $0900 (which
+    drops the block and the observer of that page, so the MMU rebinds its
+    accessors), then write $0A00 and $0A01 (which were $11 and $22).
+    """
+    mem = bytearray( 0x10000)
+    mem[0x800:0x80A] = bytes( [0x8D, 0x00, 0x09, 0x8D, 0x00, 0x0A, 0x8D, 0x01, 0x0A, 0x02])
+    mem[0x900:0x902] = bytes( [0xEA, 0x02])     # NOP ; KIL
+    mem[0xA00:0xA02] = bytes( [0x11, 0x22])
+    cpu = CPU( MMU( [(0, 0x10000, False, mem)]), 0x900, fast=True)
+    cpu.stepBlock()
+    cpu.r.pc, cpu.r.a, cpu.running = 0x800, 0x42, True
+    return cpu
+
+
+def check_trace():
+    mem = bytearray( 0x10000)
+    mem[0x800:0x806] = bytes( [0x20, 0x04, 0x08, 0x02, 0x00, 0xEA])  # JSR $804, KIL ; BRK
+    mem[0xFFFE:] = bytes( [0x03, 0x08])
+    cpu = CPU( MMU( [(0, 0x10000, False, mem)]), 0x800, fast=True)
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join( tmp, "trace.bin")
+        recorder = TraceRecorder( cpu, path)
+        cpu.run( trace=recorder)
+        recorder.close()
+        with TraceIndex( path) as index:
+            for addr, pc in ((0x1FF, 0x800), (0x1FE, 0x800), (0x1FD, 0x804), (0x1FC, 0x804), (0x1FB, 0x804)):
+                t = index.last_write( addr)
+                assert t is not None and t.pc == pc, f"last write to ${addr:04X}"
+            assert [index.record( i).pc for i in index.executions( 0x804)] == [0x804]
+
+    # The writes after the one which dropped a block are recorded too
+    cpu = code_writer()
+    recorder = TraceRecorder( cpu)
+    cpu.run( trace=recorder)
+    written = [t.written for t in recorder.last_records()]
+    assert written == [[(0x900, 0x42)], [(0xA00, 0x42)], [(0xA01, 0x42)], []], written
+
+
+def check_history():
+    # Going back across the writes following the one which dropped a
+    # block puts their old values back
+    cpu = code_writer()
+    history = History( cpu)
+    cpu.run( trace=history)
+    history.back( 2)
+    assert cpu.r.pc == 0x806 and cpu.mmu.peek( 0xA00) == 0x42 and cpu.mmu.peek( 0xA01) == 0x22
+    history.back( 2)
+    assert cpu.r.pc == 0x800 and cpu.mmu.peek( 0x900) == 0xEA and cpu.mmu.peek( 0xA00) == 0x11
+
+
+if __name__ == "__main__":
+    failed = 0
+    for check in (check_mmu, check_snapshots, check_conditions, check_parsers, check_trace, check_history):
+        try:
+            check()
+            print( f"{check.__name__}: ok")
+        except AssertionError as ex:
+            failed += 1
+            print( f"{check.__name__}: FAILED {ex}")
+    sys.exit( 1 if failed else 0)
@@ -0,0 +1,568 @@
+# -*- coding: utf-8 -*-
+"""
+Execution traces : one fixed size record per instruction with the
+registers and the cycle counter before the instruction, and the memory
+writes it did (up to MAX_WRITES, BRK pushes 3 bytes).
+
+The records are packed in preallocated chunks.  When recording to a file,
+full chunks are handed to a background thread which writes them
+(optionally gzip compressed) ; there's a fixed number of chunks, so if
+the disk can't keep up the emulation waits instead of eating all the RAM.
+Without a file, the chunk is a ring buffer keeping the last N
+instructions, for post-mortem.
+
+Trace file : HEADER then the records.
+
+To query a trace without going through all of it, TraceIndex builds (once)
+a sidecar index file, trace + ".idx" : for each address the records which
+wrote it and for each PC the records which executed it.  These lists are
+sorted (by record number, so by cycle) and memory mapped, the queries are
+binary searches.  The index is in the machine's byte order.
+"""
+
+import gzip
+import heapq
+import mmap
+import os
+import queue
+import struct
+import sys
+import threading
+import zlib
+from array import array
+from bisect import bisect_left
+from collections import namedtuple, Counter
+from itertools import compress, repeat
+
+TRACE_MAGIC = b"TRC6502\0"
+TRACE_VERSION = 2
+HEADER = struct.Struct( "<8sHH")  # magic, version, record size
+
+# No instruction writes more bytes than BRK (PC and P)
+MAX_WRITES = 3
+
+# cycle counter, pc, a, x, y, s, p, number of writes, then (address,
+# value) of each write in order (the unused ones are 0)
+RECORD = struct.Struct( "<QHBBBBBB" + "HB" * MAX_WRITES)
+WRITE = struct.Struct( "<HB")
+PC_OFFSET = 8
+WRITES_OFFSET = 15
+WRITE_OFFSET = 16
+
+
+class TraceRecord( namedtuple( "TraceRecord", "cc pc a x y s p writes addr value addr2 value2 addr3 value3")):
+    """ A record, addr and value are the first write's (if writes) """
+    __slots__ = ()
+
+    @property
+    def written( self):
+        """ (address, value) of each write, in order """
+        return [(self[8 + 2*i], self[9 + 2*i]) for i in range( self.writes)]
+
+    def value_at( self, addr):
+        """ The (last) value written at addr, None if it wasn't """
+        values = [v for a, v in self.written if a == addr]
+        return values[-1] if values else None
+
+BRK = 0x00
+
+
+class TraceRecorder:
+
+    def __init__( self, cpu, path=None, records=65536, chunks=4, compress=False, stop_on_brk=False):
+        """
+        path : the trace file, or None to keep only the last `records`
+            instructions in memory.
+        records : number of records per chunk.
+        chunks : number of chunks (when writing to a file).
+        stop_on_brk : make CPU.run stop after a BRK (reason "brk").
+        """
+        self.cpu = cpu
+        self.path = path
+        self.records = records
+        self.count = 0  # number of instructions recorded
+        self.wrapped = False
+
+        self.buf = bytearray( RECORD.size * records)
+        self.pos = 0
+        self.end = len( self.buf)
+        self.last = None  # position of the record being executed
+
+        self.attached = None
+        self.brk = None
+        if stop_on_brk:
+            self.brk = cpu.ops[BRK]
+
+            def brk():
+                self.brk()
+                cpu.stop( "brk")
+
+            cpu.ops[BRK] = brk
+
+        if path:
+            if compress:
+                self.file = gzip.open( path, "wb", compresslevel=1)
+            else:
+                self.file = open( path, "wb")
+            self.file.write( HEADER.pack( TRACE_MAGIC, TRACE_VERSION, RECORD.size))
+
+            self.free = queue.Queue()
+            for i in range( chunks - 1):
+                self.free.put( bytearray( len( self.buf)))
+            self.full = queue.Queue()
+            self.error = None
+            self.thread = threading.Thread( target=self._writer, daemon=True)
+            self.thread.start()
+
+    # Recording
+
+    def attach( self):
+        """
+        Start catching the memory writes (see MMU.hookWrites).
+        """
+        def traced_write( addr, value):
+            buf, last = self.buf, self.last
+            n = buf[last + WRITES_OFFSET]
+            if n < MAX_WRITES:
+                WRITE.pack_into( buf, last + WRITE_OFFSET + n * WRITE.size, addr, value & 0xff)
+                buf[last + WRITES_OFFSET] = n + 1
+
+        self.attached = traced_write
+        self.cpu.mmu.hookWrites( traced_write)
+
+    def detach( self):
+        if self.attached:
+            self.cpu.mmu.unhookWrites( self.attached)
+            self.attached = None
+
+    def record( self, pc):
+        """
+        Record the state before executing the instruction at pc.  Must be
+        attached.
+        """
+        pos = self.pos
+        if pos == self.end:
+            pos = self._next_chunk()
+        r = self.cpu.r
+        RECORD.pack_into( self.buf, pos, self.cpu.cc, pc, r.a, r.x, r.y, r.s, r.p, 0, 0, 0, 0, 0, 0, 0)
+        self.last = pos
+        self.pos = pos + RECORD.size
+        self.count += 1
+
+    def step( self, cpu):
+        """ cpu.step(), traced """
+        self.attach()
+        try:
+            self.record( cpu.r.pc)
+            cpu.step()
+        finally:
+            self.detach()
+
+    def _next_chunk( self):
+        if self.path:
+            self.full.put( self.buf)
+            self.buf = self.free.get()
+        else:
+            self.wrapped = True
+        return 0
+
+    # Output
+
+    def _writer( self):
+        while True:
+            buf = self.full.get()
+            if buf is None:
+                self.full.task_done()
+                break
+            try:
+                if not self.error:
+                    self.file.write( buf)
+            except Exception as ex:
+                self.error = ex
+            if isinstance( buf, bytearray) and len( buf) == self.end:
+                self.free.put( buf)
+            self.full.task_done()
+
+    def flush( self):
+        """
+        Make the file contain all the records so far (so that it can be
+        read, or indexed, while the recording goes on).
+        """
+        if self.path and self.file:
+            self.full.put( bytes( self.buf[:self.pos]))
+            self.pos = 0
+            self.full.join()
+            if isinstance( self.file, gzip.GzipFile):
+                self.file.flush( zlib.Z_SYNC_FLUSH)
+            else:
+                self.file.flush()
+            if self.error:
+                raise self.error
+
+    def close( self):
+        """
+        Write what's left and close the file (if any).  Stop catching the
+        BRK's.
+        """
+        if self.brk:
+            self.cpu.ops[BRK] = self.brk
+            self.brk = None
+
+        if self.path and self.file:
+            self.full.put( bytes( self.buf[:self.pos]))
+            self.full.put( None)
+            self.thread.join()
+            self.file.close()
+            self.file = None
+            if self.error:
+                raise self.error
+
+    def last_records( self, n=None):
+        """
+        The last n records (all of them in memory if n is None), oldest
+        first, as TraceRecord's.
+        """
+        size = RECORD.size
+        if self.wrapped and not self.path:
+            data = self.buf[self.pos:] + self.buf[:self.pos]
+        else:
+            data = self.buf[:self.pos]
+        if n is not None:
+            data = data[-n*size:] if n else b""
+        return [TraceRecord._make( t) for t in RECORD.iter_unpack( data)]
+
+    def save( self, path, compress=False):
+        """
+        Write the records in memory as a trace file.
+        """
+        opener = gzip.open if compress else open
+        with opener( path, "wb") as fout:
+            fout.write( HEADER.pack( TRACE_MAGIC, TRACE_VERSION, RECORD.size))
+            if self.wrapped and not self.path:
+                fout.write( self.buf[self.pos:])
+            fout.write( self.buf[:self.pos])
+
+
+class Recorders:
+    """
+    Several recorders (TraceRecorder, History...) as one, for CPU.run's
+    trace parameter.
+    """
+
+    def __init__( self, *recorders):
+        self.recorders = recorders
+
+    def attach( self):
+        for r in self.recorders:
+            r.attach()
+
+    def detach( self):
+        for r in reversed( self.recorders):
+            r.detach()
+
+    def record( self, pc):
+        for r in self.recorders:
+            r.record( pc)
+
+
+def open_trace( path):
+    """
+    Open a trace file (compressed or not) and check its header.  Returns
+    the file, positioned on the first record.
+    """
+    with open( path, "rb") as f:
+        compressed = f.read(2) == b"\x1f\x8b"
+    fin = gzip.open( path, "rb") if compressed else open( path, "rb")
+
+    magic, version, size = HEADER.unpack( fin.read( HEADER.size))
+    if magic != TRACE_MAGIC or version != TRACE_VERSION or size != RECORD.size:
+        fin.close()
+        raise ValueError( f"{path} is not a trace file (or not this version's)")
+    return fin
+
+
+def _chunks( path, chunk_records):
+    """
+    The records of a trace file, as bytes, chunk_records at a time (a
+    trace still being written by a TraceRecorder may end with a partial
+    record or an unfinished gzip stream, that's not an error).
+    """
+    size = RECORD.size * chunk_records
+    with open_trace( path) as fin:
+        data = b""
+        while True:
+            try:
+                more = fin.read1( size - len( data))
+            except EOFError:
+                more = b""
+            data += more
+            if not more or len( data) == size:
+                n = len( data) - len( data) % RECORD.size
+                if n:
+                    yield data[:n]
+                if not more:
+                    break
+                data = b""
+
+
+def read_trace( path, chunk_records=65536):
+    """
+    Iterate over the records (TraceRecord's) of a trace file.
+    """
+    for data in _chunks( path, chunk_records):
+        for t in RECORD.iter_unpack( data):
+            yield TraceRecord._make( t)
+
+
+# Trace index file : INDEX_HEADER (padded to INDEX_STARTS), then
+#
+# - the start of each address' writes in the write list, then the start of
+#   each PC's executions in the execution list (0x10001 64 bits integers
+#   each, the last one is the end of the list)
+# - if the trace is compressed (it can't be mapped), the records
+# - the write list and the execution list (record numbers, 32 bits)
+
+INDEX_SUFFIX = ".idx"
+INDEX_MAGIC = b"TRCIDX1\0"
+INDEX_VERSION = 2
+# magic, version, records inside, number of records, number of writes,
+# trace size, trace modification time (ns)
+INDEX_HEADER = struct.Struct( "<8sHHQQQQ")
+INDEX_STARTS = 64
+INDEX_RECORDS = INDEX_STARTS + 2 * 0x10001 * 8
+
+CC = struct.Struct( "<Q")
+
+
+def _column( data, offset, size):
+    """ Field at offset (size : 1 or 2 bytes) of each record of data """
+    if size == 1:
+        return data[offset::RECORD.size]
+    col = bytearray( len( data) // RECORD.size * 2)
+    col[0::2] = data[offset::RECORD.size]
+    col[1::2] = data[offset+1::RECORD.size]
+    col = array( 'H', col)
+    if sys.byteorder == "big":
+        col.byteswap()
+    return col
+
+
+# For each write slot, count of writes -> 1 if the slot is used
+_SLOT_USED = [bytes( int( n > slot) for n in range( 256)) for slot in range( MAX_WRITES)]
+
+
+def _writes( data, base):
+    """ (record number, slot, address) of each write of the records in
+    data (the first one being record number base), in order.
+    """
+    counts = bytes( _column( data, WRITES_OFFSET, 1))
+    records = range( base, base + len( counts))
+    return heapq.merge( *[
+        compress( zip( records, repeat( slot), _column( data, WRITE_OFFSET + slot * WRITE.size, 2)),
+                  counts.translate( _SLOT_USED[slot]))
+        for slot in range( MAX_WRITES)])
+
+
+def _index_header( index_path):
+    try:
+        with open( index_path, "rb") as fin:
+            header = INDEX_HEADER.unpack( fin.read( INDEX_HEADER.size))
+    except (OSError, struct.error):
+        return None
+    if header[0] != INDEX_MAGIC or header[1] != INDEX_VERSION:
+        return None
+    return header
+
+
+def build_index( trace_path, index_path=None, chunk_records=65536):
+    """
+    Write the index of a trace file (see TraceIndex).  Two passes over the
+    trace : one to count the writes and executions of each address, the
+    other to put the record numbers in place, directly in the (mapped)
+    index file.
+    """
+    index_path = index_path or trace_path + INDEX_SUFFIX
+    st = os.stat( trace_path)
+    with open_trace( trace_path) as fin:
+        inside = isinstance( fin, gzip.GzipFile)
+
+    write_counts = Counter()
+    exec_counts = Counter()
+    count = 0
+    with open( index_path, "w+b") as fout:
+        fout.write( bytes( INDEX_RECORDS))
+        for data in _chunks( trace_path, chunk_records):
+            if inside:
+                fout.write( data)
+            count += len( data) // RECORD.size
+            exec_counts.update( _column( data, PC_OFFSET, 2))
+            counts = bytes( _column( data, WRITES_OFFSET, 1))
+            for slot in range( MAX_WRITES):
+                write_counts.update( compress( _column( data, WRITE_OFFSET + slot * WRITE.size, 2),
+                                               counts.translate( _SLOT_USED[slot])))
+
+        nwrites = sum( write_counts.values())
+        records_end = INDEX_RECORDS + (count * RECORD.size if inside else 0)
+        write_list = (records_end + 7) & ~7
+        exec_list = write_list + nwrites * 4
+        fout.truncate( max( exec_list + count * 4, 1))
+
+        fout.seek( 0)
+        fout.write( INDEX_HEADER.pack( INDEX_MAGIC, INDEX_VERSION, inside, count, nwrites, st.st_size, st.st_mtime_ns))
+
+        with mmap.mmap( fout.fileno(), 0) as m:
+            view = memoryview( m)
+            starts = view[INDEX_STARTS:INDEX_RECORDS].cast( 'Q')
+            writes = view[write_list:exec_list].cast( 'I')
+            execs = view[exec_list:exec_list + count * 4].cast( 'I')
+
+            write_fill, exec_fill = [], []
+            total = 0
+            for addr in range( 0x10000):
+                write_fill.append( total)
+                starts[addr] = total
+                total += write_counts[addr]
+            starts[0x10000] = total
+            total = 0
+            for pc in range( 0x10000):
+                exec_fill.append( total)
+                starts[0x10001 + pc] = total
+                total += exec_counts[pc]
+            starts[0x10001 + 0x10000] = total
+
+            if inside:
+                chunk = RECORD.size * chunk_records
+                chunks = (view[i:min( i + chunk, records_end)] for i in range( INDEX_RECORDS, records_end, chunk))
+            else:
+                chunks = _chunks( trace_path, chunk_records)
+
+            base = 0
+            for data in chunks:
+                n = len( data) // RECORD.size
+                for i, pc in enumerate( _column( data, PC_OFFSET, 2), base):
+                    p = exec_fill[pc]
+                    execs[p] = i
+                    exec_fill[pc] = p + 1
+                for i, _, addr in _writes( data, base):
+                    p = write_fill[addr]
+                    writes[p] = i
+                    write_fill[addr] = p + 1
+                base += n
+                if inside:
+                    data.release()
+
+            for v in (starts, writes, execs, view):
+                v.release()
+    return index_path
+
+
+class _Cycles:
+    """ The cycle counters of the records, as a sequence (for bisect) """
+    def __init__( self, index):
+        self.index = index
+
+    def __len__( self):
+        return len( self.index)
+
+    def __getitem__( self, i):
+        return self.index.cycle( i)
+
+
+class TraceIndex:
+    """
+    Queries over a trace file.  The records are designated by their number
+    in the trace, cycles are the cycle counter before the instruction ;
+    start/end select the records with start <= cycle < end.
+
+    The index file is built if it doesn't exist or if the trace changed.
+    All the writes of an instruction are indexed (JSR and BRK push
+    several bytes).
+    """
+
+    def __init__( self, trace_path, index_path=None, rebuild=False):
+        self.trace_path = trace_path
+        self.index_path = index_path or trace_path + INDEX_SUFFIX
+
+        st = os.stat( trace_path)
+        header = _index_header( self.index_path)
+        if rebuild or not header or header[5:] != (st.st_size, st.st_mtime_ns):
+            build_index( trace_path, self.index_path)
+            header = _index_header( self.index_path)
+        _, _, inside, self.count, nwrites, _, _ = header
+
+        self.files, self.maps, self.views = [], [], []
+        index = self._map( self.index_path)
+        self.starts = self._view( index[INDEX_STARTS:INDEX_RECORDS].cast( 'Q'))
+        records_end = INDEX_RECORDS + (self.count * RECORD.size if inside else 0)
+        write_list = (records_end + 7) & ~7
+        exec_list = write_list + nwrites * 4
+        self.write_list = self._view( index[write_list:exec_list].cast( 'I'))
+        self.exec_list = self._view( index[exec_list:exec_list + self.count * 4].cast( 'I'))
+        if inside:
+            self.records = self._view( index[INDEX_RECORDS:records_end])
+        else:
+            trace = self._map( trace_path)
+            self.records = self._view( trace[HEADER.size:HEADER.size + self.count * RECORD.size])
+
+    def _map( self, path):
+        f = open( path, "rb")
+        self.files.append( f)
+        self.maps.append( mmap.mmap( f.fileno(), 0, access=mmap.ACCESS_READ))
+        return self._view( memoryview( self.maps[-1]))
+
+    def _view( self, view):
+        self.views.append( view)
+        return view
+
+    def close( self):
+        for v in reversed( self.views):
+            v.release()
+        for m in self.maps:
+            m.close()
+        for f in self.files:
+            f.close()
+        self.views, self.maps, self.files = [], [], []
+
+    def __enter__( self):
+        return self
+
+    def __exit__( self, *exc):
+        self.close()
+
+    def __len__( self):
+        return self.count
+
+    def record( self, i):
+        return TraceRecord._make( RECORD.unpack_from( self.records, i * RECORD.size))
+
+    def cycle( self, i):
+        return CC.unpack_from( self.records, i * RECORD.size)[0]
+
+    def at_cycle( self, cycle):
+        """ Number of the first record at or after cycle """
+        return bisect_left( _Cycles( self), cycle)
+
+    def _select( self, lst, a, b, start, end):
+        if start is not None:
+            a = bisect_left( lst, self.at_cycle( start), a, b)
+        if end is not None:
+            b = bisect_left( lst, self.at_cycle( end), a, b)
+        # A copy, the views would prevent closing the map
+        selected = array( 'I')
+        selected.frombytes( lst[a:b].tobytes())
+        return selected
+
+    def executions( self, pc, start=None, end=None):
+        """ Numbers of the records which executed the instruction at pc """
+        return self._select( self.exec_list, self.starts[0x10001 + pc], self.starts[0x10002 + pc], start, end)
+
+    def writes( self, addr, start=None, end=None):
+        """ Numbers of the records which wrote at addr """
+        return self._select( self.write_list, self.starts[addr], self.starts[addr + 1], start, end)
+
+    def last_write( self, addr, before=None):
+        """ The last record which wrote at addr before the cycle `before`
+        (or at all), None if there's none.
+        """
+        w = self.writes( addr, end=before)
+        return self.record( w[-1]) if len( w) else None
@@ -0,0 +1,269 @@
+# -*- coding: utf-8 -*-
+"""
+Time travel : going back in the execution, instruction by instruction or
+up to a breakpoint.
+
+The history is an undo journal with one fixed size entry per executed
+instruction : the registers and the cycle counter before the instruction
+and the old value of the bytes it wrote (a 6502 instruction writes at most
+3 bytes, BRK).  The journal is a ring buffer, so it only covers the last
+instructions ; to go back further, snapshots of the machine are taken
+every `snapshot_every` instructions (CPU.snapshot, which only copies the
+memory pages written since the previous one) and we restore the closest
+one and replay from there.  Going back N instructions costs at most a snapshot
+restore and `snapshot_every` instructions, whatever N is.
+
+The instructions are numbered from the beginning of the history (seq).
+History follows the same protocol as TraceRecorder (attach, record,
+detach) so that CPU.run can record it (its trace parameter).
+
+The soft switches (display mode, keyboard) are part of the snapshots but
+not of the journal : undoing an instruction which used them doesn't
+restore them.
+"""
+
+import struct
+from collections import deque
+
+# cycle counter, pc, a, x, y, s, p, running, number of writes, then
+# (address, old value) for each write
+JOURNAL = struct.Struct( "<QHBBBBBBB")
+UNDO = struct.Struct( "<HB")
+MAX_WRITES = 3
+ENTRY_SIZE = JOURNAL.size + MAX_WRITES * UNDO.size
+WRITES_OFFSET = JOURNAL.size - 1
+
+
+class _Snapshot:
+    """ The whole machine : CPU.snapshot() and the soft switches """
+    __slots__ = ("seq", "state", "io")
+
+    def __init__( self, cpu, seq):
+        self.seq = seq
+        self.state = cpu.snapshot()
+        io = getattr( cpu, "io", None)
+        self.io = io.state() if io else None
+
+    def restore( self, cpu):
+        cpu.restore( self.state)
+        if self.io is not None:
+            cpu.io.restore_state( self.io)
+
+
+class History:
+
+    def __init__( self, cpu, journal=262144, snapshot_every=65536, snapshots=256):
+        """
+        journal : number of instructions the journal covers.
+        snapshot_every : number of instructions between two snapshots.
+        snapshots : number of snapshots kept (so, with the defaults, we
+            can go back 16 million instructions).
+        """
+        self.cpu = cpu
+        self.size = journal
+        self.every = snapshot_every
+        self.journal = bytearray( ENTRY_SIZE * journal)
+        self.snapshots = deque( maxlen=snapshots)
+        self.attached = None
+        self.restart()
+
+    def restart( self):
+        """
+        Forget everything, the history starts now (for example after a
+        reset).
+        """
+        self.seq = 0          # number of the next instruction
+        self.oldest = 0       # oldest instruction the journal can undo
+        self.last = None      # journal position of the instruction being executed
+        self.snapshots.clear()
+        self.snapshots.append( _Snapshot( self.cpu, 0))
+        self.next_snapshot = self.every
+
+    @property
+    def earliest( self):
+        """ The instruction number we can go back to """
+        return min( self.oldest, self.snapshots[0].seq)
+
+    # Recording
+
+    def attach( self):
+        """
+        Start journaling the memory writes (see MMU.hookWrites, called
+        before the write : the old value is still there).
+        """
+        journal = self.journal
+        peek = self._peek
+
+        def journaled_write( addr, value):
+            last = self.last
+            n = journal[last + WRITES_OFFSET]
+            if n < MAX_WRITES:
+                UNDO.pack_into( journal, last + JOURNAL.size + n * UNDO.size, addr, peek( addr))
+                journal[last + WRITES_OFFSET] = n + 1
+
+        self.attached = journaled_write
+        self.cpu.mmu.hookWrites( journaled_write)
+
+    def detach( self):
+        if self.attached:
+            self.cpu.mmu.unhookWrites( self.attached)
+            self.attached = None
+
+    def record( self, pc):
+        """
+        Journal the state before executing the instruction at pc.  Must be
+        attached.
+        """
+        seq = self.seq
+        if seq == self.next_snapshot:
+            self.snapshots.append( _Snapshot( self.cpu, seq))
+            self.next_snapshot = seq + self.every
+        cpu = self.cpu
+        r = cpu.r
+        pos = (seq % self.size) * ENTRY_SIZE
+        JOURNAL.pack_into( self.journal, pos, cpu.cc, pc, r.a, r.x, r.y, r.s, r.p, cpu.running, 0)
+        self.last = pos
+        self.seq = seq + 1
+        if seq - self.oldest >= self.size:
+            self.oldest = seq + 1 - self.size
+
+    def step( self, cpu):
+        """ cpu.step(), journaled """
+        self.attach()
+        try:
+            self.record( cpu.r.pc)
+            cpu.step()
+        finally:
+            self.detach()
+
+    # The memory, behind the MMU's back (no I/O handler, no observer)
+
+    def _block( self, addr):
+        return self.cpu.mmu.getBlock( addr)
+
+    def _peek( self, addr):
+        try:
+            b = self._block( addr)
+        except IndexError:
+            return 0
+        return b['memory'][addr - b['start']]
+
+    def _poke( self, addr, value):
+        try:
+            b = self._block( addr)
+        except IndexError:
+            return
+        b['memory'][addr - b['start']] = value
+        self.cpu.mmu.dirty[addr >> 8] = 1
+        if self.cpu.block_cache:
+            self.cpu.block_cache.invalidate( addr)
+
+    # Going back
+
+    def _undo( self):
+        """ Undo the last instruction (which must be in the journal) """
+        self.seq -= 1
+        pos = (self.seq % self.size) * ENTRY_SIZE
+        cc, pc, a, x, y, s, p, running, n = JOURNAL.unpack_from( self.journal, pos)
+        for i in reversed( range( n)):
+            addr, old = UNDO.unpack_from( self.journal, pos + JOURNAL.size + i * UNDO.size)
+            self._poke( addr, old)
+        cpu = self.cpu
+        r = cpu.r
+        r.pc, r.a, r.x, r.y, r.s, r.p = pc, a, x, y, s, p
+        cpu.cc = cc
+        cpu.running = bool( running)
+
+    def _replay( self, seq):
+        """ Run (journaling) up to instruction seq """
+        cpu = self.cpu
+        while self.seq < seq:
+            reason, _, _ = cpu.run( max_instructions=seq - self.seq, trace=self)
+            # A watchpoint may stop the CPU on the way
+            cpu.takeStop( cpu.r.pc)
+            if reason == "halted":
+                break
+
+    def goto( self, seq):
+        """
+        Go back to the state before instruction seq (not before
+        self.earliest).  Returns the instruction number we went to.
+        """
+        seq = max( min( seq, self.seq), self.earliest)
+
+        # The snapshot to replay from
+        snapshot = None
+        for snap in self.snapshots:
+            if snap.seq <= seq:
+                snapshot = snap
+
+        if seq >= self.oldest and (snapshot is None or self.seq - seq <= seq - snapshot.seq):
+            while self.seq > seq:
+                self._undo()
+            # The snapshots after that are the future, they'll be taken
+            # again
+            while self.snapshots and self.snapshots[-1].seq > seq:
+                self.snapshots.pop()
+            if not self.snapshots:
+                self.snapshots.append( _Snapshot( self.cpu, seq))
+        else:
+            while self.snapshots[-1] is not snapshot:
+                self.snapshots.pop()
+            snapshot.restore( self.cpu)
+            self.seq = snapshot.seq
+            self.oldest = min( self.oldest, snapshot.seq)
+        self.next_snapshot = self.snapshots[-1].seq + self.every
+        self._replay( seq)
+        self.last = None
+        return self.seq
+
+    def back( self, n=1):
+        """
+        Go back n instructions (less if the history doesn't go that far).
+        Returns the number of instructions we went back.
+        """
+        seq = self.seq
+        return seq - self.goto( seq - n)
+
+    def _pc( self, seq):
+        return struct.unpack_from( "<H", self.journal, (seq % self.size) * ENTRY_SIZE + 8)[0]
+
+    def reverse_continue( self, stop_pcs):
+        """
+        Go back to the last time PC was in stop_pcs (the current PC
+        excluded).  Returns "pc", or "start" if that's not in the history
+        (we're then at its beginning).
+        """
+        # In the journal
+        for seq in range( self.seq - 1, self.oldest - 1, -1):
+            if self._pc( seq) in stop_pcs:
+                self.goto( seq)
+                return "pc"
+
+        # Before the journal : replay each period between two snapshots,
+        # the most recent first, noting when PC was in stop_pcs
+        end = self.oldest
+        for snap in reversed( list( self.snapshots)):
+            if snap.seq >= end:
+                continue
+            self.goto( snap.seq)
+            found = None
+            cpu = self.cpu
+            while self.seq < end:
+                if cpu.r.pc in stop_pcs:
+                    found = self.seq
+                self.step( cpu)
+                cpu.takeStop( cpu.r.pc)
+                if not cpu.running:
+                    break
+                reason, _, _ = cpu.run( max_instructions=end - self.seq, stop_pcs=stop_pcs, trace=self)
+                cpu.takeStop( cpu.r.pc)
+                if reason == "halted":
+                    break
+            if found is not None:
+                self.goto( found)
+                return "pc"
+            end = snap.seq
+
+        self.goto( self.earliest)
+        return "start"
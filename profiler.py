@@ -0,0 +1,285 @@
+# -*- coding: utf-8 -*-
+"""
+Execution profiler : for each PC, the number of times the instruction was
+executed and the cycles it actually took (with the page crossing and
+taken branch penalties), measured on cpu.cc.
+
+The counters are two 64K arrays indexed by PC, CPU.run updates them
+directly (see its profile parameter).  They're joined with the source
+lines only when the results are shown.
+"""
+
+import csv
+from array import array
+
+
+class LineProfile:
+    def __init__( self, line_nr, label, address, hits, cycles, source):
+        self.line_nr, self.label, self.address = line_nr, label, address
+        self.hits, self.cycles, self.source = hits, cycles, source
+
+
+class Profiler:
+
+    def __init__( self):
+        self.hits = array( 'L', [0]) * 0x10000
+        self.cycles = array( 'L', [0]) * 0x10000
+
+    @property
+    def counters( self):
+        """ What CPU.run wants as its profile parameter """
+        return self.hits, self.cycles
+
+    def clear( self):
+        self.hits[:] = array( 'L', [0]) * 0x10000
+        self.cycles[:] = array( 'L', [0]) * 0x10000
+
+    def step( self, cpu):
+        """ cpu.step(), profiled """
+        pc, cc = cpu.r.pc, cpu.cc
+        cpu.step()
+        self.hits[pc] += 1
+        self.cycles[pc] += cpu.cc - cc
+
+    def total_cycles( self):
+        return sum( self.cycles)
+
+    def line_profiles( self, lines):
+        """
+        The profile of the executed source lines (LineProfile's), the
+        hottest first.  lines is a report.Listing ; its index gives the
+        line and the label of each address.  The addresses which are not
+        in it (code without source) are reported on their own, line_nr is
+        None.
+        """
+        hits, cycles = self.hits, self.cycles
+        index = lines.index
+
+        profiles = []
+        for addr in range( 0x10000):
+            if hits[addr]:
+                i, label, offset = index.locate( addr)
+                if i is not None:
+                    profiles.append( LineProfile( i+1, label, addr, hits[addr], cycles[addr], lines.source( i)))
+                else:
+                    profiles.append( LineProfile( None, None, addr, hits[addr], cycles[addr], ""))
+
+        profiles.sort( key=lambda p: p.cycles, reverse=True)
+        return profiles
+
+    def export( self, fname, lines):
+        """
+        Write the profile, hottest lines first, as CSV if fname ends with
+        .csv, else as text.
+        """
+        profiles = self.line_profiles( lines)
+        total = sum( p.cycles for p in profiles) or 1
+
+        with open( fname, "w", newline="") as fout:
+            if fname.lower().endswith( ".csv"):
+                writer = csv.writer( fout)
+                writer.writerow( ["line", "label", "address", "hits", "cycles", "percent", "source"])
+                for p in profiles:
+                    writer.writerow( [p.line_nr or "", p.label or "", f"${p.address:04X}", p.hits, p.cycles,
+                                      f"{100*p.cycles/total:.2f}", p.source.strip()])
+            else:
+                fout.write( f"{'line':>6} {'address':7} {'hits':>10} {'cycles':>12} {'%':>6}  label / source\n")
+                for p in profiles:
+                    fout.write( f"{p.line_nr or '-':>6} ${p.address:04X}   {p.hits:10d} {p.cycles:12d} {100*p.cycles/total:6.2f}  {p.label or ''}")
+                    if p.source:
+                        fout.write( f" | {p.source.strip()}")
+                    fout.write( "\n")
+
+
+JSR, RTS = 0x20, 0x60
+
+
+class _Frame:
+    __slots__ = ("entry", "path", "start", "s", "children")
+
+    def __init__( self, entry, path, start, s):
+        self.entry, self.path, self.start, self.s = entry, path, start, s
+        self.children = 0  # inclusive cycles of the callees
+
+
+class CallStats:
+    def __init__( self, entry, name):
+        self.entry, self.name = entry, name
+        self.calls = self.inclusive = self.exclusive = 0
+
+
+class CallProfiler:
+    """
+    Call graph profiler : a shadow call stack follows the JSR's and RTS's
+    and, for each subroutine, we count the calls and the inclusive and
+    exclusive cycles (measured on cpu.cc).
+
+    It works by wrapping the JSR and RTS handlers of cpu.ops, so the other
+    instructions are not slowed down at all.  Code that drops its return
+    address (PLA PLA) or jumps with an RTS (address pushed on the stack)
+    is handled by matching the frames on the stack pointer.
+    """
+
+    def __init__( self, cpu, names={}):
+        """
+        names : address -> label, to name the subroutines.
+        """
+        self.cpu = cpu
+        self.names = names
+        self.stats = dict()   # entry address -> CallStats
+        self.folded = dict()  # call path (entry addresses) -> exclusive cycles
+        self.stack = []
+        self.restart()
+        self.installed = None
+
+    def name( self, addr):
+        return self.names.get( addr) or f"${addr:04X}"
+
+    def restart( self):
+        """
+        Forget the calls in progress (for example, after a CPU reset).
+        """
+        pc = self.cpu.r.pc
+        self.stack[:] = [_Frame( pc, (pc,), self.cpu.cc, 0x100)]
+
+    def install( self):
+        cpu = self.cpu
+        r = cpu.r
+        jsr, rts = cpu.ops[JSR], cpu.ops[RTS]
+        stack = self.stack
+
+        def profiled_jsr():
+            jsr()
+            top = stack[-1]
+            stack.append( _Frame( r.pc, top.path + (r.pc,), cpu.cc, r.s))
+
+        def profiled_rts():
+            s = r.s
+            rts()
+            # Return from the frames whose return address was at (or
+            # below) S.  An RTS with S below the top frame is an RTS
+            # used as a jump, not a return.
+            while len( stack) > 1 and stack[-1].s <= s:
+                self._close( stack.pop())
+
+        cpu.ops[JSR], cpu.ops[RTS] = profiled_jsr, profiled_rts
+        self.installed = (jsr, rts)
+
+    def uninstall( self):
+        if self.installed:
+            self.cpu.ops[JSR], self.cpu.ops[RTS] = self.installed
+            self.installed = None
+
+    def _account( self, stats, folded, frame, inclusive):
+        exclusive = inclusive - frame.children
+        st = stats.get( frame.entry)
+        if st is None:
+            st = stats[frame.entry] = CallStats( frame.entry, self.name( frame.entry))
+        st.inclusive += inclusive
+        st.exclusive += exclusive
+        folded[frame.path] = folded.get( frame.path, 0) + exclusive
+
+    def _close( self, frame):
+        inclusive = self.cpu.cc - frame.start
+        self._account( self.stats, self.folded, frame, inclusive)
+        self.stats[frame.entry].calls += 1
+        self.stack[-1].children += inclusive
+
+    def results( self):
+        """
+        (stats, folded) like self.stats and self.folded, but with the
+        subroutines still running counted up to now.
+        """
+        stats = dict()
+        for entry, st in self.stats.items():
+            stats[entry] = CallStats( entry, st.name)
+            stats[entry].calls, stats[entry].inclusive, stats[entry].exclusive = st.calls, st.inclusive, st.exclusive
+        folded = dict( self.folded)
+
+        callee = 0
+        for frame in reversed( self.stack):
+            inclusive = self.cpu.cc - frame.start
+            frame_children = frame.children
+            frame.children += callee
+            self._account( stats, folded, frame, inclusive)
+            frame.children = frame_children
+            callee = inclusive
+        return stats, folded
+
+    def top( self, n=None):
+        """
+        The subroutines, the most expensive (inclusive cycles) first.
+        """
+        stats, _ = self.results()
+        return sorted( stats.values(), key=lambda st: st.inclusive, reverse=True)[:n]
+
+    def export_folded( self, fname):
+        """
+        Write the folded stacks ("main;draw;plot 1234", exclusive cycles),
+        as flamegraph.pl, inferno or speedscope want them.
+        """
+        _, folded = self.results()
+        with open( fname, "w") as fout:
+            for path, cycles in sorted( folded.items()):
+                if cycles:
+                    fout.write( ";".join( self.name( addr) for addr in path) + f" {cycles}\n")
+
+
+class PassCycles:
+    """ The cycles taken by each pass between two addresses """
+
+    def __init__( self, start, end):
+        self.start, self.end = start, end
+        self.passes = []
+
+    def __str__( self):
+        if not self.passes:
+            return "no complete pass"
+        return f"{len( self.passes)} passes, min {min( self.passes)}, max {max( self.passes)}, " \
+            f"mean {sum( self.passes) / len( self.passes):.1f} cycles"
+
+
+def _plain_run( cpu, stop_pcs):
+    reason, _, _ = cpu.run( stop_pcs=stop_pcs)
+    return reason
+
+
+def _plain_step( cpu):
+    pc = cpu.r.pc
+    cpu.step()
+    return cpu.takeStop( pc)
+
+
+def measure_passes( cpu, start, end, passes=100, run=_plain_run, step=_plain_step):
+    """
+    Run the CPU and measure, on cpu.cc, the cycles of each pass from start
+    to end : from the moment PC reaches start (the instruction at start is
+    counted) to the moment it then reaches end (the instruction at end is
+    not).  Going through start again during a pass (start being a loop
+    head) doesn't restart the pass.  If start == end, that's the cycles
+    between two visits of start.
+
+    Stops after `passes` passes or when the CPU stops for another reason.
+    run( cpu, stop_pcs) and step( cpu) run the CPU and return why it
+    stopped (or None for step).  Returns (PassCycles, reason).
+    """
+    result = PassCycles( start, end)
+    stop_pcs = {start, end}
+    started = None
+
+    while len( result.passes) < passes:
+        reason = run( cpu, stop_pcs)
+        if reason != "pc" or cpu.r.pc not in stop_pcs:
+            return result, reason
+
+        if cpu.r.pc == end and started is not None:
+            result.passes.append( cpu.cc - started)
+            started = None
+        if cpu.r.pc == start and started is None:
+            started = cpu.cc
+
+        reason = step( cpu)
+        if reason:
+            return result, reason
+
+    return result, "passes"
@@ -0,0 +1,382 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Basic block translation cache.
+
+A basic block is a straight run of instructions ending with a flow
+instruction (branch, JMP, JSR, RTS, RTI, BRK).  Each block is decoded once,
+turned into a single Python function (using the code snippets of
+codegen.py, with the operands as constants) and cached by start address.
+
+The operands being known, the addressing modes are specialized (constant
+addresses, page crossing tested against a constant), the memory is read
+and written through the MMU's page tables without calling its accessors
+and the registers stay in local variables for the whole block.  A block
+ending with a branch back to its start (a loop) runs several iterations
+per call.  Not going through MMU.write, the blocks don't call its write
+hooks (the recorders need to see every instruction anyway).
+
+Writes into the bytes of a cached block invalidate it (Apple II code
+modifies itself all the time).  If a block modifies itself, it stops right
+after the write and the next block is decoded from the patched code.
+"""
+import re
+
+from .codegen import (
+    FLAG_BITS, FLOW_OPERATIONS, ILLEGAL_OPERATIONS, OPERATIONS, REGISTERS,
+    REGISTER_SET_RE, _indent, _needs_load, operand_size, operation_lines)
+
+# The memory accesses of the codegen.py snippets
+READ_RE = re.compile(r"\bread\((addr|SB \+ s)\)")
+WRITE_RE = re.compile(r"^(\s*)write\((addr|SB \+ s), (.*)\)$")
+
+
+def mnemonic(name, mode):
+    """
+    Rebuild the mnemonic from a `CPU._ops` line (ie "B", "NE" -> "BNE").
+    """
+    if name in ("B", "CL", "SE", "T"):
+        return name + mode
+    elif name == "P":
+        return mode
+    return name
+
+
+def _entry(table, addr, page=None):
+    """
+    The page table entry of addr (rp, the read pages, or wp), addr being
+    a constant or an expression (in the given page, if known).
+    """
+    if isinstance(addr, int):
+        return "{}[0x{:02x}][0x{:02x}]".format(table, addr >> 8, addr & 0xff)
+    elif page is not None:
+        return "{}[0x{:02x}][{}]".format(table, page, addr)
+    return "{0}[{1} >> 8][{1} & 0xff]".format(table, addr)
+
+
+def _write(indent, addr, value, page=None):
+    """
+    The lines writing value at addr (see _entry) and marking its page as
+    dirty (see MMU.write).
+    """
+    if isinstance(addr, int):
+        page = addr >> 8
+    if page is not None:
+        return [indent + _entry("wp", addr, page) + " = " + value,
+                indent + "dirty[0x{:02x}] = 1".format(page)]
+    return [indent + "h = {} >> 8".format(addr),
+            indent + "wp[h][{} & 0xff] = {}".format(addr, value),
+            indent + "dirty[h] = 1"]
+
+
+def _addressing(mode, operand):
+    """
+    The effective address computation (codegen.ADDRESSING) of an
+    instruction whose operand is known.  Returns (lines, address), the
+    address being a constant when it is one, else "addr".  The page
+    crossing test o // 0xff != (o + index) // 0xff is o % 0xff + index >=
+    0xff.
+    """
+    if mode in ("z", "a"):
+        return [], operand
+    elif mode in ("zx", "zy"):
+        return ["addr = (0x{:02x} + {}) & 0xff".format(operand, mode[1])], "addr"
+    elif mode in ("ax", "ay"):
+        lines = ["addr = 0x{:04x} + {}".format(operand, mode[1]),
+                 "if {} >= {}:".format(mode[1], 0xff - operand % 0xff),
+                 "    cc += 1"]
+        if operand + 0xff > 0xffff:
+            lines.append("addr &= 0xffff")
+        return lines, "addr"
+    elif mode == "i":
+        j = operand - 0xff if operand & 0xff == 0xff else operand + 1
+        return ["addr = ({} << 8) + {}".format(_entry("rp", j), _entry("rp", operand))], "addr"
+    elif mode == "ix":
+        return ["i = (0x{:02x} + x) & 0xff".format(operand),
+                "addr = ({} << 8) + {}".format(_entry("rp", "(i + 1) & 0xff", 0),
+                                               _entry("rp", "i", 0))], "addr"
+    elif mode == "iy":
+        return ["o = ({} << 8) + {}".format(_entry("rp", (operand + 1) & 0xff), _entry("rp", operand)),
+                "addr = o + y",
+                "if o % 0xff + y >= 0xff:",
+                "    cc += 1",
+                "addr &= 0xffff"], "addr"
+    raise ValueError("Unknown addressing mode " + mode)
+
+
+def _instruction_lines(name, atype, mode, target, operand, stack_page):
+    """
+    The code of an instruction (not a branch, see _source) whose operand
+    is known, the memory being accessed through the page tables.
+    """
+    if target is not None:
+        lines, addr = operation_lines(name, atype, mode, target), None
+    elif mode == "im":
+        const = "0x{:02x}".format(operand)
+        lines, addr = [re.sub(r"\bv\b", const, l) for l in OPERATIONS[name]], None
+    else:
+        lines, addr = _addressing(mode, operand)
+        if atype == "v":
+            lines = lines + ["v = read(addr)"]
+        lines = lines + OPERATIONS[name]
+
+    def page_of(where):
+        return (addr, None) if where == "addr" else ("s", stack_page)
+
+    code = []
+    for l in lines:
+        m = WRITE_RE.match(l)
+        if m:
+            where, page = page_of(m.group(2))
+            code += _write(m.group(1), where, m.group(3), page)
+            continue
+        l = READ_RE.sub(lambda m: _entry("rp", *page_of(m.group(1))), l)
+        if isinstance(addr, int):
+            l = re.sub(r"\baddr\b", "0x{:04x}".format(addr), l)
+        code.append(l)
+    return code
+
+
+class BlockCache:
+
+    def __init__(self, cpu, max_length=32, max_invalidations=4):
+        """
+        Parameters
+        ----------
+        cpu: The CPU executing the blocks
+        max_length: Maximum number of instructions in a block.
+        max_invalidations: Code which is modified more often than that is
+            not translated anymore (translating is much more expensive
+            than interpreting, so code patched on each loop iteration is
+            better stepped).
+        """
+        self.cpu = cpu
+        self.max_length = max_length
+        self.max_invalidations = max_invalidations
+
+        # opcode -> (name, atype, mode, cycles, target)
+        self.decoder = [None] * 0x100
+        for name, atype, addrs in cpu._ops:
+            for mode, cycles, opcodes, target in addrs:
+                for opcode in opcodes:
+                    self.decoder[opcode] = (name, atype, mode, cycles, target)
+
+        self.namespace = {"cpu": cpu, "r": cpu.r, "mmu": cpu.mmu, "cache": self,
+                          "RP": cpu.mmu.readPages, "WP": cpu.mmu.writePages,
+                          "DIRTY": cpu.mmu.dirty}
+
+        self.blocks = {}  # start address -> block function
+        self.ends = {}  # start address -> end address (excluded) of the block
+        self.ranges = {}  # page -> list of (start, end) of the blocks in that page
+        self.invalidations = {}  # start address -> number of invalidations
+
+        # Set when a block is invalidated, tells the running block to stop
+        self.stale = False
+
+    def clear(self):
+        """
+        Forget all the blocks (for example, when the memory is reset).
+        """
+        for page in self.ranges:
+            self.cpu.mmu.unobserveWrites(page, self._codeWritten)
+        self.blocks.clear()
+        self.ends.clear()
+        self.ranges.clear()
+        self.invalidations.clear()
+
+    def get(self, pc):
+        """
+        Return the block function starting at pc, translate it if needed.
+        Calling the function executes the block and returns the number of
+        instructions executed.  Its argument, loops (1 by default), is the
+        maximum number of iterations of a block looping to its start.
+        """
+        f = self.blocks.get(pc)
+        if f is None:
+            f = self.blocks[pc] = self._translate(pc)
+        return f
+
+    def holds(self, pc, addresses):
+        """
+        True if one of the addresses is in the block starting at pc (which
+        must be translated), after its first instruction.
+        """
+        end = self.ends[pc]
+        return any(pc < a < end for a in addresses)
+
+    def _codeWritten(self, addr, value):
+        self.invalidate(addr)
+
+    def invalidate(self, addr):
+        """
+        Drop the blocks holding addr.  Writes through the MMU do it, this
+        is for the writes done behind its back.
+        """
+        ranges = self.ranges.get(addr >> 8)
+        if not ranges:
+            return
+
+        for start, end in [r for r in ranges if r[0] <= addr < r[1]]:
+            self.blocks.pop(start, None)
+            self.ends.pop(start, None)
+            self.invalidations[start] = self.invalidations.get(start, 0) + 1
+            for p in range(start >> 8, ((end - 1) >> 8) + 1):
+                self.ranges[p].remove((start, end))
+                if not self.ranges[p]:
+                    del self.ranges[p]
+                    self.cpu.mmu.unobserveWrites(p, self._codeWritten)
+            self.stale = True
+
+    def _decode(self, pc):
+        """
+        Decode the block starting at pc.  Returns a list of
+        (address, size, decoded opcode, operand).
+        """
+        read = self.cpu.mmu.read
+        instructions = []
+
+        while len(instructions) < self.max_length:
+            d = self.decoder[read(pc)]
+            if d is None or d[0] in ILLEGAL_OPERATIONS:
+                break
+
+            size = 1 + operand_size(d[0], d[2], d[4])
+            if pc + size > 0x10000:
+                break
+
+            if size == 2:
+                operand = read(pc + 1)
+            elif size == 3:
+                operand = read(pc + 1) + (read(pc + 2) << 8)
+            else:
+                operand = None
+
+            instructions.append((pc, size, d, operand))
+            pc += size
+
+            if d[0] in FLOW_OPERATIONS:
+                break
+
+        return instructions
+
+    def _translate(self, pc):
+        if self.invalidations.get(pc, 0) < self.max_invalidations:
+            instructions = self._decode(pc)
+        else:
+            instructions = []
+
+        if instructions:
+            start = instructions[0][0]
+            end = instructions[-1][0] + instructions[-1][1]
+            fname = "block_{:04x}".format(start)
+            ns = dict(self.namespace)
+            exec(compile(self._source(fname, instructions), "<block ${:04X}>".format(start), "exec"), ns)
+            f = ns[fname]
+        else:
+            # Nothing we can translate (illegal opcode, code modified
+            # too often), so we fall back to the regular step.
+            start, end = pc, pc + 1
+            cpu = self.cpu
+
+            def f(loops=1):
+                cpu.step()
+                return 1
+
+        for p in range(start >> 8, ((end - 1) >> 8) + 1):
+            if p not in self.ranges:
+                self.ranges[p] = []
+                self.cpu.mmu.observeWrites(p, self._codeWritten)
+            self.ranges[p].append((start, end))
+
+        self.ends[pc] = end
+        return f
+
+    def _source(self, fname, instructions):
+
+        start = instructions[0][0]
+        pc, size, (name, _, _, _, target), operand = instructions[-1]
+        branch = None
+        if name == "B":
+            # Taken or not, the target and the extra cycles are known (same
+            # quirks as codegen.operation_lines)
+            flag, value = target
+            test = "p & {}".format(FLAG_BITS[flag])
+            t = pc + size + (operand & 0x7f) - (operand & 0x80)
+            branch = (test if value else "not " + test, "not " + test if value else test,
+                      t, 1 if (pc + size) // 0xff == t // 0xff else 2)
+        # A loop : the iterations are run in a row, up to `loops`
+        loop = branch is not None and branch[2] == start
+
+        codes = []
+        for pc, size, (name, atype, mode, cc, target), operand in instructions:
+            codes.append([] if name == "B" else
+                         _instruction_lines(name, atype, mode, target, operand, self.cpu.stack_page))
+
+        body = []
+        cycles = 0
+        changed = set()
+        if loop:
+            # Any exit may follow a previous iteration
+            changed.update(reg for reg in REGISTERS
+                           if any(REGISTER_SET_RE[reg].search("\n".join(c)) for c in codes))
+
+        def store():
+            return ["r.{0} = {0}".format(reg) for reg in REGISTERS if reg in changed]
+
+        def exit_code(n, pc_code):
+            return store() + \
+                ["r.pc = {}".format(pc_code),
+                 "cpu.cc += {} + cc".format(cycles),
+                 "return {}".format(n) + (" + count" if loop else "")]
+
+        for n, ((pc, size, (name, atype, mode, cc, target), operand), lines) in \
+                enumerate(zip(instructions, codes)):
+            code = "\n".join(lines)
+            cycles += cc
+            changed.update(reg for reg in REGISTERS if REGISTER_SET_RE[reg].search(code))
+
+            body.append("# ${:04X} {}".format(pc, mnemonic(name, mode)))
+            if name == "B":
+                # Always the last instruction of the block
+                taken, not_taken, t, extra = branch
+                if loop:
+                    body.append("if {}:".format(not_taken))
+                    body += _indent(exit_code(n + 1, "0x{:04x}".format(pc + size)))
+                    body += ["cc += {}".format(cycles + extra),
+                             "count += {}".format(n + 1)]
+                else:
+                    body += ["pc = 0x{:04x}".format(pc + size),
+                             "if {}:".format(taken),
+                             "    cc += {}".format(extra),
+                             "    pc = {:#06x}".format(t)]
+                    body += exit_code(n + 1, "pc")
+            elif name in FLOW_OPERATIONS:
+                body.append("pc = 0x{:04x}".format(pc + size))
+                body += lines
+                body += exit_code(n + 1, "pc")
+            else:
+                body += lines
+                if "wp[" in code and n < len(instructions) - 1:
+                    # Did we just modify our own code ?
+                    body.append("if cache.stale:")
+                    body += _indent(exit_code(n + 1, "0x{:04x}".format(pc + size)))
+
+        if instructions[-1][2][0] not in FLOW_OPERATIONS:
+            pc, size = instructions[-1][0:2]
+            body += exit_code(len(instructions), "0x{:04x}".format(pc + size))
+
+        code = "\n".join(body)
+        prologue = ["{} = {}".format(l, g) for l, g in [("rp", "RP"), ("wp", "WP"), ("dirty", "DIRTY")]
+                    if l + "[" in code]
+        prologue.append("cc = 0")
+        prologue += ["{0} = r.{0}".format(reg) for reg in REGISTERS
+                     if _needs_load(reg, body) or loop and reg in changed]
+        if loop:
+            prologue.append("count = 0")
+            if "rp[" in code or "wp[" in code:
+                # An I/O handler (or an observer) may have stopped the CPU
+                body += ["if not cpu.running:", "    break"]
+            body = ["for _ in range(loops):"] + _indent(body) + store() + \
+                ["r.pc = 0x{:04x}".format(start), "cpu.cc += cc", "return count"]
+
+        return "\n".join(["def {}(loops=1):".format(fname)] + _indent(prologue + body))
@@ -0,0 +1,327 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Code generation for the fast CPU core.
+
+The reference core in `CPU` dispatches every instruction through a
+`functools.partial` that calls an addressing mode method, which calls
+`nextByte`, which calls the MMU, and so on.  Here we generate, from the very
+same `CPU._ops` table, one flat Python function per opcode where the operand
+fetch, the addressing mode, the operation, the flag update and the cycle
+count are all inlined.
+
+The generated code mimics the reference core exactly, quirks included
+(page crossing is detected with a division by 0xff, branches don't wrap the
+PC, etc.) so that both cores can be used interchangeably.
+
+Conventions used in the code snippets below :
+
+- a, x, y, s, p are the registers (as local variables),
+- pc is the address of the next instruction,
+- v is the operand value (for "v" operations), addr the effective
+  address (for "a" operations),
+- cc accumulates the extra cycles (page crossing, taken branches),
+- OPND8/OPND16 stand for the operand byte/word,
+- read/write are the MMU accessors, SB is the stack base address.
+"""
+import re
+
+# Operand size in bytes for each addressing mode.
+OPERAND_SIZE = {
+    "im": 1, "z": 1, "zx": 1, "zy": 1, "ix": 1, "iy": 1,
+    "a": 2, "ax": 2, "ay": 2, "i": 2,
+}
+
+# Effective address computation for each addressing mode.  The page
+# crossing test reproduces CPU.ax_a & co.
+ADDRESSING = {
+    "z":  ["addr = OPND8"],
+    "zx": ["addr = (OPND8 + x) & 0xff"],
+    "zy": ["addr = (OPND8 + y) & 0xff"],
+    "a":  ["addr = OPND16"],
+    "ax": ["o = OPND16",
+           "addr = o + x",
+           "if o // 0xff != addr // 0xff:",
+           "    cc += 1",
+           "addr &= 0xffff"],
+    "ay": ["o = OPND16",
+           "addr = o + y",
+           "if o // 0xff != addr // 0xff:",
+           "    cc += 1",
+           "addr &= 0xffff"],
+    "i":  ["i = OPND16",
+           "j = i - 0xff if i & 0xff == 0xff else i + 1",
+           "addr = ((read(j) << 8) + read(i)) & 0xffff"],
+    "ix": ["i = (OPND8 + x) & 0xff",
+           "addr = ((read((i + 1) & 0xff) << 8) + read(i)) & 0xffff"],
+    "iy": ["i = OPND8",
+           "o = (read((i + 1) & 0xff) << 8) + read(i)",
+           "addr = o + y",
+           "if o // 0xff != addr // 0xff:",
+           "    cc += 1",
+           "addr &= 0xffff"],
+}
+
+
+def _zn(r):
+    return f"p = (p & 0x7d) | ({r} & 0x80) | (0 if {r} else 2)"
+
+
+def _push(r):
+    return [f"write(SB + s, {r})", "s = (s - 1) & 0xff"]
+
+
+def _pop(r):
+    return ["s = (s + 1) & 0xff", f"{r} = read(SB + s)"]
+
+
+def _cmp(r):
+    return [f"t = ({r} - v) & 0xff",
+            f"p = (p & 0x7c) | (v <= {r}) | (t & 0x80) | (0 if t else 2)"]
+
+
+def _decimal(plain, decimal, tail):
+    return (["if p & 8:"] + ["    " + l for l in decimal] +
+            ["else:"] + ["    " + l for l in plain] + tail)
+
+
+# Documented operations.  Operations working on the accumulator (ASL A...)
+# are keyed by (name, "a").
+OPERATIONS = {
+    "ADC": _decimal(
+        ["t = a + v + (p & 1)", "n = t & 0xff", "c = t > 0xff"],
+        ["t = cpu.fromBCD(a) + cpu.fromBCD(v) + (p & 1)",
+         "n = cpu.toBCD(t % 100)", "c = t > 99"],
+        ["p = (p & 0x3c) | c | (n & 0x80) | (0 if n else 2)"
+         " | (0x40 if ~(a ^ v) & (a ^ t) & 0x80 else 0)",
+         "a = n"]),
+    "SBC": _decimal(
+        ["t = a - v - (1 - (p & 1))", "n = t & 0xff"],
+        ["t = cpu.fromBCD(a) - cpu.fromBCD(v) - (1 - (p & 1))",
+         "n = cpu.toBCD(t % 100)"],
+        ["p = (p & 0x3c) | (t >= 0) | (n & 0x80) | (0 if n else 2)"
+         " | (0x40 if (a ^ v) & (a ^ t) & 0x80 else 0)",
+         "a = n"]),
+    "AND": ["a = a & v & 0xff", _zn("a")],
+    "ORA": ["a = a | v", _zn("a")],
+    "EOR": ["a = a ^ v", _zn("a")],
+    "BIT": ["p = (p & 0x3d) | (v & 0xc0) | (0 if a & v else 2)"],
+    "CMP": _cmp("a"),
+    "CPX": _cmp("x"),
+    "CPY": _cmp("y"),
+    "LDA": ["a = v", _zn("a")],
+    "LDX": ["x = v", _zn("x")],
+    "LDY": ["y = v", _zn("y")],
+    "STA": ["write(addr, a)"],
+    "STX": ["write(addr, x)"],
+    "STY": ["write(addr, y)"],
+    "INC": ["n = (read(addr) + 1) & 0xff", "write(addr, n)", _zn("n")],
+    "DEC": ["n = (read(addr) - 1) & 0xff", "write(addr, n)", _zn("n")],
+    "INX": ["x = (x + 1) & 0xff", _zn("x")],
+    "INY": ["y = (y + 1) & 0xff", _zn("y")],
+    "DEX": ["x = (x - 1) & 0xff", _zn("x")],
+    "DEY": ["y = (y - 1) & 0xff", _zn("y")],
+    "ASL": ["t = read(addr) << 1", "n = t & 0xff", "write(addr, n)",
+            "p = (p & 0x7c) | (t > 0xff) | (n & 0x80) | (0 if n else 2)"],
+    ("ASL", "a"): ["t = a << 1", "a = t & 0xff",
+                   "p = (p & 0x7c) | (t > 0xff) | (a & 0x80) | (0 if a else 2)"],
+    "LSR": ["t = read(addr)", "n = t >> 1", "write(addr, n)",
+            "p = (p & 0x7c) | (t & 1) | (n & 0x80) | (0 if n else 2)"],
+    ("LSR", "a"): ["t = a & 1", "a = a >> 1",
+                   "p = (p & 0x7c) | t | (a & 0x80) | (0 if a else 2)"],
+    "ROL": ["t = read(addr)", "n = ((t << 1) + (p & 1)) & 0xff",
+            "write(addr, n)",
+            "p = (p & 0x7c) | ((t & 0x80) >> 7) | (n & 0x80) | (0 if n else 2)"],
+    ("ROL", "a"): ["t = a", "a = ((t << 1) + (p & 1)) & 0xff",
+                   "p = (p & 0x7c) | ((t & 0x80) >> 7) | (a & 0x80) | (0 if a else 2)"],
+    "ROR": ["t = read(addr)", "n = ((t >> 1) + (p & 1) * 0x80) & 0xff",
+            "write(addr, n)",
+            "p = (p & 0x7c) | (t & 1) | (n & 0x80) | (0 if n else 2)"],
+    ("ROR", "a"): ["t = a", "a = ((t >> 1) + (p & 1) * 0x80) & 0xff",
+                   "p = (p & 0x7c) | (t & 1) | (a & 0x80) | (0 if a else 2)"],
+    "JMP": ["pc = addr"],
+    "JSR": ["t = pc - 1"] + _push("t >> 8 & 0xff") + _push("t & 0xff") +
+           ["pc = addr"],
+    "RTS": _pop("lo") + _pop("hi") + ["pc = (lo + (hi << 8) + 1) & 0xffff"],
+    "RTI": _pop("p") + _pop("lo") + _pop("hi") + ["pc = lo + (hi << 8)"],
+    "BRK": ["p |= 0x10", "t = pc + 1"] + _push("t >> 8 & 0xff") +
+           _push("t & 0xff") + _push("p") +
+           ["p |= 4", "pc = mmu.readWord(0xfffe)"],
+    "NOP": [],
+    ("P", "PH", "a"): _push("a"),
+    ("P", "PH", "p"): _push("p"),
+    ("P", "PL", "a"): _pop("a") + [_zn("a")],
+    ("P", "PL", "p"): _pop("p") + ["p = p | 0x20"],
+}
+
+# Opcodes which change the flow of the program (ie they end a basic block).
+FLOW_OPERATIONS = {"B", "JMP", "JSR", "RTS", "RTI", "BRK"}
+
+# Undocumented opcodes are not inlined, the generated code computes the
+# operand and delegates to the CPU method.
+ILLEGAL_OPERATIONS = {
+    "AAC", "AAX", "ARR", "ASR", "ATX", "AXA", "AXS", "DCP", "ISC", "KIL",
+    "LAR", "LAX", "RLA", "RRA", "SLO", "SRE", "SXA", "SYA", "XAA", "XAS"}
+
+FLAG_BITS = {'N': 128, 'V': 64, 'B': 16, 'D': 8, 'I': 4, 'Z': 2, 'C': 1}
+
+REGISTERS = ("a", "x", "y", "s", "p")
+REGISTER_USE_RE = {r: re.compile(r"\b{}\b".format(r)) for r in REGISTERS + ("pc", "cc")}
+REGISTER_SET_RE = {r: re.compile(r"^\s*{}\s*[-+&|]?=[^=]".format(r), re.M)
+                   for r in REGISTERS + ("pc",)}
+
+
+def _needs_load(reg, lines):
+    """
+    Tell if the register is read before being written (in which case
+    it must be loaded in a local variable).
+    """
+
+    for l in lines:
+        m = re.match(r"^{}\s*=([^=].*)$".format(reg), l)
+        if m and not REGISTER_USE_RE[reg].search(m.groups()[0]):
+            return False
+        elif REGISTER_USE_RE[reg].search(l):
+            return True
+
+    return False
+
+
+def operation_lines(name, atype, mode, target):
+    """
+    Return the code of an operation (without the operand fetch), for the
+    given line of the `CPU._ops` table, as a list of lines.
+    """
+
+    if target is not None:
+        if name == "B":
+            flag, value = target
+            test = "p & {}".format(FLAG_BITS[flag]) if value else \
+                "not p & {}".format(FLAG_BITS[flag])
+            return ["d = OPND8",
+                    "if {}:".format(test),
+                    "    t = pc + (d & 0x7f) - (d & 0x80)",
+                    "    cc += 1 if pc // 0xff == t // 0xff else 2",
+                    "    pc = t"]
+        elif name == "CL":
+            return ["p &= {}".format(255 - FLAG_BITS[target])]
+        elif name == "SE":
+            return ["p |= {}".format(FLAG_BITS[target])]
+        elif name == "T":
+            src, dst = target
+            lines = ["{} = {}".format(dst, src)]
+            if dst != 's':
+                lines.append(_zn(dst))
+            return lines
+        elif name == "P":
+            return OPERATIONS[(name,) + target]
+        elif target == "a":
+            return OPERATIONS[(name, "a")]
+        elif name in ILLEGAL_OPERATIONS:
+            return ["cpu.{}({!r})".format(name, target)]
+        else:
+            return OPERATIONS[name]
+
+    if atype == "v":
+        lines = ["v = OPND8"] if mode == "im" else \
+            ADDRESSING[mode] + ["v = read(addr)"]
+        arg = "v"
+    else:
+        lines = ADDRESSING[mode]
+        arg = "addr"
+
+    if name in ILLEGAL_OPERATIONS:
+        return lines + ["cpu.{}({})".format(name, arg)]
+    else:
+        return lines + OPERATIONS[name]
+
+
+def operand_size(name, mode, target):
+    if name == "B":
+        return 1
+    elif target is not None:
+        return 0
+    return OPERAND_SIZE[mode]
+
+
+def _indent(lines, n=1):
+    return ["    " * n + l for l in lines]
+
+
+def handler_source(fname, name, atype, mode, cycles, target):
+    """
+    Python source of the function handling one opcode.  The function
+    is called with the PC already past the opcode (just like the ops built
+    by `CPU._create_ops`).
+    """
+
+    body = operation_lines(name, atype, mode, target)
+    size = operand_size(name, mode, target)
+
+    code = "\n".join(body)
+    lines = ["def {}():".format(fname)]
+
+    if size:
+        lines.append("pc = r.pc")
+        if size == 1:
+            lines.append("o8 = read(pc)")
+        else:
+            lines.append("o16 = read(pc) + (read(pc + 1) << 8)")
+        lines += ["pc += {}".format(size), "r.pc = pc"]
+        code = code.replace("OPND8", "o8").replace("OPND16", "o16")
+    elif _needs_load("pc", body):
+        lines.append("pc = r.pc")
+
+    prologue = []
+    if "read(" in "\n".join(lines) + code:
+        prologue.append("read = mmu.read")
+    if "write(" in code:
+        prologue.append("write = mmu.write")
+    if REGISTER_USE_RE["cc"].search(code):
+        prologue.append("cc = 0")
+
+    # Don't load registers which are written before being read
+    used = [reg for reg in REGISTERS if _needs_load(reg, code.split("\n"))]
+    changed = [reg for reg in REGISTERS if REGISTER_SET_RE[reg].search(code)]
+    prologue += ["{0} = r.{0}".format(reg) for reg in used]
+
+    epilogue = ["r.{0} = {0}".format(reg) for reg in changed]
+    if REGISTER_SET_RE["pc"].search(code):
+        epilogue.append("r.pc = pc")
+    if REGISTER_USE_RE["cc"].search(code):
+        epilogue.append("cpu.cc += {} + cc".format(cycles))
+    elif cycles:
+        epilogue.append("cpu.cc += {}".format(cycles))
+
+    body = lines[1:] + [code] if code else lines[1:]
+    body = prologue + "\n".join(body).split("\n") + epilogue
+    return "\n".join([lines[0]] + _indent(body or ["pass"]))
+
+
+def create_fast_ops(cpu):
+    """
+    Build the 256 entries opcode table of `cpu` with generated functions.
+    The functions are bound to `cpu` (and its MMU and registers).
+    """
+
+    namespace = {
+        "cpu": cpu,
+        "r": cpu.r,
+        "mmu": cpu.mmu,
+        "SB": cpu.stack_page * 0x100,
+    }
+
+    ops = [None] * 0x100
+    sources = []
+    for name, atype, addrs in cpu._ops:
+        for mode, cycles, opcodes, target in addrs:
+            for opcode in opcodes:
+                fname = "op_{:02x}".format(opcode)
+                sources.append(handler_source(fname, name, atype, mode, cycles, target))
+
+    exec(compile("\n\n".join(sources), "<py65emu fast ops>", "exec"), namespace)
+
+    for opcode in range(0x100):
+        ops[opcode] = namespace.get("op_{:02x}".format(opcode))
+
+    return ops
@@ -3,6 +3,13 @@
 import math
 import functools
 
+from .codegen import create_fast_ops
+from .blocks import BlockCache
+from .snapshot import Snapshot
+
+# Iterations of a loop run() executes in a row (see stepBlock)
+BLOCK_LOOPS = 256
+
 
 class Registers:
     """ An object to hold the CPU registers. """
@@ -58,7 +65,7 @@ class Registers:
 
 class CPU:
 
-    def __init__(self, mmu=None, pc=None, stack_page=0x1, magic=0xee):
+    def __init__(self, mmu=None, pc=None, stack_page=0x1, magic=0xee, fast=False):
         """
         Parameters
         ----------
@@ -69,6 +76,8 @@ class CPU:
             stack page may be elsewhere.
         magic: A value needed for the illegal opcodes, XAA.  This value differs
             between different versions, even of the same CPU.  The default is 0xee.
+        fast: Use the generated opcode handlers (see codegen.py) instead of
+            the functools.partial based ones.  Both behave the same.
         """
         self.mmu = mmu
         self.r = Registers()
@@ -78,6 +87,12 @@ class CPU:
         # for other 65* varients.
         self.stack_page = stack_page
         self.magic = magic
+        # Translated basic blocks, see stepBlock
+        self.block_cache = None
+        # Why run() must stop and the address of the instruction which
+        # asked for it (see stop)
+        self.stopReason = None
+        self.stopPc = None
         self.reset()
 
         if pc:
@@ -87,6 +102,8 @@ class CPU:
             pass
 
         self._create_ops()
+        if fast:
+            self.ops = create_fast_ops(self)
 
     def reset(self, pc = 0):
         self.r.reset( pc)
@@ -94,14 +111,218 @@ class CPU:
         if self.mmu:
             self.mmu.reset()
 
+        if self.block_cache:
+            self.block_cache.clear()
+
         self.running = True
+        self.stopReason = None
 
     def step(self):
-        #self.cc = 0
-        # pc = self.r.pc
-        opcode = self.nextByte()
+        # Same as self.nextByte(), one call less
+        r = self.r
+        pc = r.pc
+        opcode = self.mmu.read(pc)
+        r.pc = pc + 1
         self.ops[opcode]()
 
+    def stepBlock(self, loops=1):
+        """
+        Execute the basic block starting at PC (see blocks.py) in one go.
+        Blocks are translated the first time they're executed and then
+        cached.  A block ending with a branch back to its start is
+        executed up to `loops` times.  Returns the number of instructions
+        executed.
+
+        If an instruction fails (for example, writing to read only
+        memory), the registers are left as they were at the beginning
+        of the block.
+        """
+        cache = self._blockCache()
+        cache.stale = False
+        return cache.get(self.r.pc)(loops)
+
+    def _blockCache(self):
+        if self.block_cache is None:
+            self.block_cache = BlockCache(self)
+        return self.block_cache
+
+    def run(self, max_cycles=None, max_instructions=None, stop_pcs=frozenset(),
+            stop_when_sp_above=None, profile=None, trace=None, blocks=False):
+        """
+        Execute instructions until (checked before each instruction) :
+
+        - PC is in stop_pcs : "pc"
+        - S is above stop_when_sp_above (for example, to run until the
+          current subroutine returns) : "sp".  The stack wraps around,
+          "above" is modulo 256 : up to 128 bytes above.
+        - max_cycles cycles were executed : "cycles"
+        - max_instructions instructions were executed : "instructions"
+        - the CPU is halted (KIL) : "halted"
+        - stop() was called (by an I/O handler, a write observer...) :
+          the reason given to stop().  stopPc is then the address of the
+          instruction during which stop() was called.
+
+        profile: None or a pair of 64K arrays (hits, cycles), indexed by
+            PC, incremented for each executed instruction.
+        trace: None or a TraceRecorder (see exectrace.py), which records
+            each executed instruction.
+        blocks: Execute the translated basic blocks (see stepBlock)
+            rather than one instruction at a time, when there's no
+            other stop condition than stop_pcs.  A block with a stop_pcs
+            address after its first instruction is stepped.  stop() is
+            only seen at the end of a block (or of a loop's iteration),
+            stopPc is then the block's start : don't use blocks with
+            watchpoints.
+
+        Returns (reason, number of cycles, number of instructions).
+        """
+        r = self.r
+        mmu = self.mmu
+        ops = self.ops
+        start_cc = self.cc
+        n = 0
+        reason = None
+        pc = r.pc
+
+        if max_cycles is None and max_instructions is None and stop_when_sp_above is None \
+                and profile is None and trace is None:
+            # The common case (breakpoints only), with as few checks as
+            # possible
+            if blocks:
+                cache = self._blockCache()
+                while self.running:
+                    pc = r.pc
+                    if pc in stop_pcs:
+                        reason = "pc"
+                        break
+                    f = cache.get(pc)
+                    if stop_pcs and cache.holds(pc, stop_pcs):
+                        opcode = mmu.read(pc)
+                        r.pc = pc + 1
+                        ops[opcode]()
+                        n += 1
+                    else:
+                        cache.stale = False
+                        n += f(BLOCK_LOOPS)
+            else:
+                while self.running:
+                    pc = r.pc
+                    if pc in stop_pcs:
+                        reason = "pc"
+                        break
+                    # Same as step()
+                    opcode = mmu.read(pc)
+                    r.pc = pc + 1
+                    ops[opcode]()
+                    n += 1
+        else:
+            end_cc = start_cc + max_cycles if max_cycles is not None else math.inf
+            end_n = max_instructions if max_instructions is not None else math.inf
+            # For each value of S, whether it's above stop_when_sp_above
+            if stop_when_sp_above is None:
+                sp_above = bytes(256)
+            else:
+                sp_above = bytes(0 < (s - stop_when_sp_above) & 0xff <= 0x80 for s in range(256))
+            if profile is not None:
+                hits, cycles = profile
+            if trace is not None:
+                record = trace.record
+                trace.attach()
+
+            try:
+                while self.running:
+                    pc = r.pc
+                    if pc in stop_pcs:
+                        reason = "pc"
+                    elif sp_above[r.s]:
+                        reason = "sp"
+                    elif self.cc >= end_cc:
+                        reason = "cycles"
+                    elif n >= end_n:
+                        reason = "instructions"
+                    elif trace is not None:
+                        record(pc)
+                        cc = self.cc
+                        opcode = mmu.read(pc)
+                        r.pc = pc + 1
+                        ops[opcode]()
+                        n += 1
+                        if profile is not None:
+                            hits[pc] += 1
+                            cycles[pc] += self.cc - cc
+                        continue
+                    elif profile is not None:
+                        cc = self.cc
+                        opcode = mmu.read(pc)
+                        r.pc = pc + 1
+                        ops[opcode]()
+                        n += 1
+                        hits[pc] += 1
+                        cycles[pc] += self.cc - cc
+                        continue
+                    else:
+                        opcode = mmu.read(pc)
+                        r.pc = pc + 1
+                        ops[opcode]()
+                        n += 1
+                        continue
+                    break
+            finally:
+                if trace is not None:
+                    trace.detach()
+
+        if reason is None:
+            reason = self.takeStop(pc) or "halted"
+
+        return reason, self.cc - start_cc, n
+
+    def snapshot(self):
+        """
+        Return the state of the CPU (a Snapshot) : registers, cycle counter
+        and memory.  The memory pages which were not written since the
+        previous snapshot are shared with it, so it's cheap to take one
+        often.
+        """
+        r = self.r
+        return Snapshot((r.pc, r.a, r.x, r.y, r.s, r.p), self.cc, self.running,
+                        self.mmu.snapshot())
+
+    def restore(self, snapshot):
+        """
+        Go back to a snapshot (see snapshot()).  The memory is restored
+        behind the MMU's back (see MMU.restore).
+        """
+        self.mmu.restore(snapshot.memory)
+        r = self.r
+        r.pc, r.a, r.x, r.y, r.s, r.p = snapshot.registers
+        self.cc = snapshot.cc
+        self.running = snapshot.running
+        self.stopReason = None
+
+        if self.block_cache:
+            self.block_cache.clear()
+
+    def stop(self, reason="stopped"):
+        """
+        Make run() stop before the next instruction.  reason is returned
+        by run().
+        """
+        self.stopReason = reason
+        self.running = False
+
+    def takeStop(self, pc):
+        """
+        If stop() was called, return its reason and let the CPU run again
+        (pc being the address of the instruction which was executed),
+        else None.  For those who call step() themselves.
+        """
+        reason = self.stopReason
+        if reason:
+            self.stopReason = None
+            self.stopPc = pc
+            self.running = True
+        return reason
+
     def execute(self, instruction):
         """
         Execute a single instruction independent of the program in memory.
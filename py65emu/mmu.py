@@ -9,6 +9,112 @@ class ReadOnlyError(TypeError):
     pass
 
 
+class _UnmappedPage:
+    """
+    Page table entry for a page which is not in any block.
+    """
+    def __init__(self, page):
+        self.base = page << 8
+
+    def __getitem__(self, i):
+        raise IndexError(f"Index error on addr : {self.base + i:04X}")
+
+    def __setitem__(self, i, value):
+        raise IndexError(f"Index error on addr : {self.base + i:04X}")
+
+
+class _ReadOnlyPage:
+    """
+    Write page table entry of a read only page.
+    """
+    def __init__(self, page):
+        self.base = page << 8
+
+    def __setitem__(self, i, value):
+        raise ReadOnlyError(f"Read only : addr:{self.base + i:04X}")
+
+
+class _SplitPage:
+    """
+    Page table entry of a page shared by several blocks (or partially
+    mapped).  `cells` gives, for each byte of the page, the block and the
+    index in that block (or None if the byte is not mapped).
+    """
+    def __init__(self, page, cells):
+        self.base = page << 8
+        self.cells = cells
+
+    def __getitem__(self, i):
+        c = self.cells[i]
+        if c is None:
+            raise IndexError(f"Index error on addr : {self.base + i:04X}")
+        return c[0]['memory'][c[1]]
+
+    def __setitem__(self, i, value):
+        c = self.cells[i]
+        if c is None:
+            raise IndexError(f"Index error on addr : {self.base + i:04X}")
+        elif c[0]['readonly']:
+            raise ReadOnlyError(f"Read only : addr:{self.base + i:04X}")
+        c[0]['memory'][c[1]] = value
+
+
+class _ObservedPage:
+    """
+    Write page table entry of a page with write observers.
+    """
+    def __init__(self, page, target, observers):
+        self.base = page << 8
+        self.target = target
+        self.observers = observers
+
+    def __setitem__(self, i, value):
+        self.target[i] = value
+        for f in self.observers:
+            f(self.base + i, value)
+
+
+class _ObservedReadPage:
+    """
+    Read page table entry of a page with read observers.
+    """
+    def __init__(self, page, target, observers):
+        self.base = page << 8
+        self.target = target
+        self.observers = observers
+
+    def __getitem__(self, i):
+        value = self.target[i]
+        for f in self.observers:
+            f(self.base + i, value)
+        return value
+
+
+class _IOPage:
+    """
+    Page table entry of a page with memory mapped I/O.  `handlers` gives,
+    for each byte of the page, the read (or write) handler or None if that
+    byte is regular memory (`target`).
+    """
+    def __init__(self, page, target, handlers):
+        self.base = page << 8
+        self.target = target
+        self.handlers = handlers
+
+    def __getitem__(self, i):
+        f = self.handlers[i]
+        if f is None:
+            return self.target[i]
+        return f(self.base + i)
+
+    def __setitem__(self, i, value):
+        f = self.handlers[i]
+        if f is None:
+            self.target[i] = value
+        else:
+            f(self.base + i, value)
+
+
 class MMU:
     def __init__(self, blocks):
         """
@@ -23,16 +129,143 @@ class MMU:
         # "readonly" and "memory"
         self.blocks = []
 
+        # Callbacks called after each write in a given page (see
+        # observeWrites), None for pages nobody observes.  They're tuples,
+        # replaced rather than changed : an observer may (un)observe
+        # while a write is calling the observers.
+        self.observers = [None] * 256
+        self.readObservers = [None] * 256  # same thing, for reads
+
+        # Callbacks called before each write, whatever the page (see
+        # hookWrites)
+        self.writeHooks = ()
+
+        # Memory mapped I/O handlers (see addIOHandlers). For each page,
+        # None if the page has no handler, else a list of 256 handlers
+        # (or None for bytes without handler).
+        self.ioReaders = [None] * 256
+        self.ioWriters = [None] * 256
+
+        # The page tables : for each page (an address' high byte), an
+        # object which, indexed by the address' low byte, reads or writes
+        # the memory.  Most of the time it's a memoryview over the
+        # block's memory.
+        self.readPages = [None] * 256
+        self.writePages = [None] * 256
+
+        # One byte per page, set when the page is written to.  It's
+        # folded (see _foldDirty) into the pages to restore on reset (see
+        # dirtyPages) and the pages changed since the last snapshot (see
+        # snapshot).
+        self.dirty = bytearray(256)
+        self.resetDirty = bytearray(256)
+        self.snapshotDirty = bytearray(256)
+
+        # The last snapshot taken or restored, its pages are shared with
+        # the next one.
+        self.lastSnapshot = None
+
         for b in blocks:
             self.addBlock(*b)
 
+        self._updatePages()
+
     def reset(self):
         """
-        Reset everything.
+        Reset everything.  Only the pages written since the last reset are
+        restored (writes done behind the MMU's back, directly in a block's
+        memory, are not tracked).
         """
 
-        for b in self.blocks:
-            b['memory'] = b['backupMemory'][:]
+        # In place, the page tables point into the memory
+        pages = self.dirtyPages()
+        for page in pages:
+            lo, hi = page << 8, (page + 1) << 8
+            for b in self.blocks:
+                i = max(lo, b['start']) - b['start']
+                j = min(hi, b['start'] + b['length']) - b['start']
+                if i < j:
+                    b['memory'][i:j] = b['backupMemory'][i:j]
+
+        self.clearDirty()
+        for page in pages:
+            self.snapshotDirty[page] = 1
+
+    def _foldDirty(self):
+        dirty = int.from_bytes(self.dirty, 'little')
+        if dirty:
+            for flags in (self.resetDirty, self.snapshotDirty):
+                flags[:] = (int.from_bytes(flags, 'little') | dirty).to_bytes(256, 'little')
+            self.dirty[:] = bytes(256)
+
+    def dirtyPages(self):
+        """
+        Return the list of the pages (address' high byte) written to since
+        the last reset (or clearDirty).
+        """
+        self._foldDirty()
+        return [page for page, d in enumerate(self.resetDirty) if d]
+
+    def clearDirty(self):
+        """
+        Forget about the pages written so far (reset won't restore them).
+        """
+        self._foldDirty()
+        self.resetDirty[:] = bytes(256)
+
+    def snapshot(self):
+        """
+        Return the content of the memory : for each block, (start, length,
+        readonly, pages), pages being a tuple of the block's 256 bytes
+        chunks (bytes).
+
+        The chunks which were not written since the previous snapshot (or
+        restore) are shared with it : a snapshot only copies the pages
+        written in between.  Writes done behind the MMU's back (directly
+        in a block's memory) are not seen.
+        """
+        self._foldDirty()
+        written = [page for page, d in enumerate(self.snapshotDirty) if d]
+        self.snapshotDirty[:] = bytes(256)
+
+        base = self.lastSnapshot
+        snapshot = []
+        for n, b in enumerate(self.blocks):
+            start, length, memory = b['start'], b['length'], b['memory']
+            if base is None:
+                pages = [memory[i:i+256].tobytes() for i in range(0, length, 256)]
+            else:
+                pages = list(base[n][3])
+                for page in written:
+                    lo = max(page << 8, start) - start
+                    hi = min((page + 1) << 8, start + length) - start
+                    if lo < hi:
+                        for chunk in range(lo >> 8, (hi + 255) >> 8):
+                            pages[chunk] = memory[chunk << 8:(chunk + 1) << 8].tobytes()
+            snapshot.append((start, length, b['readonly'], tuple(pages)))
+
+        self.lastSnapshot = snapshot
+        return snapshot
+
+    def restore(self, snapshot):
+        """
+        Put back the memory of a snapshot (see snapshot), which must have
+        the same blocks as the MMU.  Writes behind the MMU's back : the
+        I/O handlers and the observers are not called.
+        """
+        if [(b['start'], b['length'], b['readonly']) for b in self.blocks] != \
+                [block[:3] for block in snapshot]:
+            raise MemoryRangeError("The snapshot doesn't have the MMU's blocks")
+
+        for b, block in zip(self.blocks, snapshot):
+            memoryview(b['memory'])[:] = b"".join(block[3])
+
+        # reset must restore everything, the next snapshot only what will
+        # be written
+        self._foldDirty()
+        self.resetDirty[:] = b"\x01" * 256
+        self.snapshotDirty[:] = bytes(256)
+        self.lastSnapshot = snapshot
 
     def addBlock(self, start, length, readonly=False, value=None, valueOffset=0):
         """
@@ -66,7 +299,7 @@ class MMU:
 
         newBlock = {
             'start': start, 'length': length, 'readonly': readonly,
-            'memory': array.array('B', [0]*length)
+            'memory': array.array('B', bytes(length))
         }
 
         # TODO: implement initialization value
@@ -84,11 +317,97 @@ class MMU:
                 a = array.array('B')
                 a.fromstring(value.read())
 
-            for i in range(len(a)):
-                newBlock['memory'][i+valueOffset] = a[i]
+            newBlock['memory'][valueOffset:valueOffset+len(a)] = array.array('B', a)
 
         newBlock['backupMemory'] = newBlock['memory'][:]
         self.blocks.append(newBlock)
+        self.lastSnapshot = None
+
+        self._updatePages()
+
+    def _updatePages(self):
+        """
+        Rebuild the page tables after the blocks have changed.
+        """
+        for page in range(256):
+            self._updatePage(page)
+        self._bindAccessors()
+
+    def _updatePage(self, page):
+        lo, hi = page << 8, (page + 1) << 8
+        covering = [b for b in self.blocks
+                    if b['start'] < hi and b['start'] + b['length'] > lo]
+
+        if not covering:
+            self.readPages[page] = self.writePages[page] = _UnmappedPage(page)
+
+        elif covering[0]['start'] <= lo and covering[0]['start'] + covering[0]['length'] >= hi:
+            b = covering[0]
+            ofs = lo - b['start']
+            self.readPages[page] = memoryview(b['memory'])[ofs:ofs+256]
+            if b['readonly']:
+                self.writePages[page] = _ReadOnlyPage(page)
+            else:
+                self.writePages[page] = self.readPages[page]
+
+        else:
+            # Same rule as getBlock : the first block wins
+            cells = [None] * 256
+            for b in reversed(covering):
+                for addr in range(max(lo, b['start']), min(hi, b['start'] + b['length'])):
+                    cells[addr - lo] = (b, addr - b['start'])
+            self.readPages[page] = self.writePages[page] = _SplitPage(page, cells)
+
+        if self.ioReaders[page]:
+            self.readPages[page] = _IOPage(page, self.readPages[page], self.ioReaders[page])
+        if self.ioWriters[page]:
+            self.writePages[page] = _IOPage(page, self.writePages[page], self.ioWriters[page])
+
+        if self.observers[page]:
+            self.writePages[page] = _ObservedPage(page, self.writePages[page], self.observers[page])
+        if self.readObservers[page]:
+            self.readPages[page] = _ObservedReadPage(page, self.readPages[page], self.readObservers[page])
+
+    def _bindAccessors(self):
+        # The accessors are bound to the instance so that the common
+        # case of a single 64K RAM block can read and write the memory
+        # directly (unless there are handlers or observers).
+        readPages, writePages, dirty = self.readPages, self.writePages, self.dirty
+
+        def read(addr):
+            return readPages[addr >> 8][addr & 0xff]
+
+        def write(addr, value):
+            page = addr >> 8
+            writePages[page][addr & 0xff] = value & 0xff
+            dirty[page] = 1
+
+        if len(self.blocks) == 1 and self.blocks[0]['start'] == 0 and \
+                self.blocks[0]['length'] == 0x10000 and not self.blocks[0]['readonly']:
+            memory = self.blocks[0]['memory']
+
+            def flatWrite(addr, value):
+                memory[addr] = value & 0xff
+                dirty[addr >> 8] = 1
+
+            self.read = read if any(self.ioReaders) or any(self.readObservers) else memory.__getitem__
+            self.write = write if any(self.observers) or any(self.ioWriters) else flatWrite
+        else:
+            self.read = read
+            self.write = write
+
+        # The hooks wrap whichever accessor was chosen, so they survive
+        # the rebinding (when a page gets or loses its observers...)
+        hooks = self.writeHooks
+        if hooks:
+            unhooked = self.write
+
+            def hookedWrite(addr, value):
+                for f in hooks:
+                    f(addr, value)
+                unhooked(addr, value)
+
+            self.write = hookedWrite
 
     def getBlock(self, addr):
         """
@@ -110,14 +429,110 @@ class MMU:
     def write(self, addr, value):
         """
         Write a value to the given address if it is writeable.
+        (replaced by an accessor in _bindAccessors)
         """
-        b = self.getBlock(addr)
-        if b['readonly']:
-            raise ReadOnlyError( f"Read only : addr:{addr:04X}")
+        self.writePages[addr >> 8][addr & 0xff] = value & 0xff
+        self.dirty[addr >> 8] = 1
+
+    def observeWrites(self, page, f):
+        """
+        Call f(addr, value) after each write in the given page (the page
+        being the address' high byte).
+        """
+        self._setObservers(self.observers, page, (self.observers[page] or ()) + (f,))
+
+    def unobserveWrites(self, page, f):
+        """
+        Undo observeWrites.
+        """
+        self._setObservers(self.observers, page, self._without(self.observers[page], f))
+
+    def hookWrites(self, f):
+        """
+        Call f(addr, value) before each write, in any page (for the
+        recorders : a trace, an undo journal).  Unlike an observer, f can
+        read the value being overwritten.  Slows down all the writes.  The
+        CPU's translated blocks write through the page tables, not this
+        accessor : they don't call the hooks.
+        """
+        self.writeHooks += (f,)
+        self._bindAccessors()
+
+    def unhookWrites(self, f):
+        """
+        Undo hookWrites.
+        """
+        self.writeHooks = self._without(self.writeHooks, f) or ()
+        self._bindAccessors()
+
+    def observeReads(self, page, f):
+        """
+        Call f(addr, value) after each read in the given page.
+        """
+        self._setObservers(self.readObservers, page, (self.readObservers[page] or ()) + (f,))
+
+    def unobserveReads(self, page, f):
+        """
+        Undo observeReads.
+        """
+        self._setObservers(self.readObservers, page, self._without(self.readObservers[page], f))
 
-        i = self.getIndex(b, addr)
+    @staticmethod
+    def _without(observers, f):
+        observers = list(observers)
+        observers.remove(f)
+        return tuple(observers) or None
 
-        b['memory'][i] = value & 0xff
+    def _setObservers(self, observers, page, value):
+        # A new tuple, the one a write (or read) may be iterating over is
+        # left as is
+        bind = (observers[page] is None) != (value is None)
+        observers[page] = value
+        self._updatePage(page)
+        if bind:
+            self._bindAccessors()
+
+    def addIOHandlers(self, start, length, read=None, write=None):
+        """
+        Map I/O handlers over the addresses start to start+length-1.
+        Reading one of these addresses returns read(addr) instead of the
+        memory content, writing calls write(addr, value).  If read (or
+        write) is None, reads (or writes) go to memory as usual.
+
+        Only the pages with handlers are slowed down, the others are
+        accessed as before.  The range doesn't need to be mapped by a
+        block.
+        """
+
+        for handlers, f in ((self.ioReaders, read), (self.ioWriters, write)):
+            if f is None:
+                continue
+            for addr in range(start, start + length):
+                page = addr >> 8
+                if handlers[page] is None:
+                    handlers[page] = [None] * 256
+                handlers[page][addr & 0xff] = f
+
+        for page in range(start >> 8, ((start + length - 1) >> 8) + 1):
+            self._updatePage(page)
+        self._bindAccessors()
+
+    def removeIOHandlers(self, start, length):
+        """
+        Undo addIOHandlers over the given range (reads and writes).
+        """
+
+        for handlers in (self.ioReaders, self.ioWriters):
+            for addr in range(start, start + length):
+                page = addr >> 8
+                if handlers[page] is not None:
+                    handlers[page][addr & 0xff] = None
+                    if not any(handlers[page]):
+                        handlers[page] = None
+
+        for page in range(start >> 8, ((start + length - 1) >> 8) + 1):
+            self._updatePage(page)
+        self._bindAccessors()
 
     def writeWord(self, addr, value):
         """
@@ -130,12 +545,24 @@ class MMU:
     def read(self, addr):
         """
         Return the value at the address.
+        (replaced by an accessor in _bindAccessors)
         """
-        b = self.getBlock(addr)
-        i = self.getIndex(b, addr)
-
-        #print(f"read({addr}) : block:{b['start']} ({b['memory'][0:10]}), i:{i}")
-        return b['memory'][i]
+        return self.readPages[addr >> 8][addr & 0xff]
 
     def readWord(self, addr):
         return (self.read(addr+1) << 8) + self.read(addr)
+
+    def peek(self, addr):
+        """
+        Return the value at the address without any side effect : the I/O
+        handlers and the read observers are not called (for debuggers).
+        """
+        b = self.getBlock(addr)
+        return b['memory'][addr - b['start']]
+
+    def peekWord(self, addr):
+        """
+        Same as peek, for a word (the high byte wraps around to $0000 like
+        on the 6502).
+        """
+        return (self.peek((addr + 1) & 0xffff) << 8) + self.peek(addr)
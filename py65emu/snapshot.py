@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Machine state snapshots (see CPU.snapshot) and the save state file format.
+
+Save state file : HEADER, then the body, zlib compressed if the flag
+COMPRESSED is set :
+
+- STATE : registers, cycle counter, running, number of blocks
+- for each block, BLOCK (start, length, readonly) then its memory
+- EXTRA then `extra` as JSON (UTF-8)
+"""
+import json
+import struct
+import zlib
+
+MAGIC = b"PY65SNAP"
+VERSION = 1
+COMPRESSED = 1
+
+HEADER = struct.Struct("<8sHH")      # magic, version, flags
+STATE = struct.Struct("<HBBBBBQBH")  # pc, a, x, y, s, p, cc, running, blocks
+BLOCK = struct.Struct("<IIB")        # start, length, readonly
+EXTRA = struct.Struct("<I")          # length of the JSON
+
+
+class SnapshotError(ValueError):
+    pass
+
+
+class Snapshot:
+    """
+    The state of a CPU : registers (pc, a, x, y, s, p), cycle counter,
+    running and memory (see MMU.snapshot).  extra is a dict for the
+    application (anything JSON can store), for example the state of the
+    hardware around the CPU.
+    """
+
+    def __init__(self, registers, cc, running, memory, extra=None):
+        self.registers = registers
+        self.cc = cc
+        self.running = running
+        self.memory = memory
+        self.extra = extra if extra is not None else {}
+
+    def save(self, path, compress=True):
+        """
+        Write the snapshot in a save state file.
+        """
+        parts = [STATE.pack(*self.registers, self.cc, self.running, len(self.memory))]
+        for start, length, readonly, pages in self.memory:
+            parts.append(BLOCK.pack(start, length, readonly))
+            parts.extend(pages)
+        extra = json.dumps(self.extra).encode("utf-8")
+        parts.append(EXTRA.pack(len(extra)))
+        parts.append(extra)
+
+        body = b"".join(parts)
+        if compress:
+            body = zlib.compress(body)
+
+        with open(path, "wb") as fout:
+            fout.write(HEADER.pack(MAGIC, VERSION, COMPRESSED if compress else 0))
+            fout.write(body)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Read a save state file.
+        """
+        with open(path, "rb") as fin:
+            data = fin.read()
+
+        try:
+            magic, version, flags = HEADER.unpack_from(data)
+        except struct.error:
+            raise SnapshotError(f"{path} is not a save state")
+        if magic != MAGIC:
+            raise SnapshotError(f"{path} is not a save state")
+        if version != VERSION:
+            raise SnapshotError(f"{path} is a version {version} save state, only version {VERSION} is supported")
+
+        try:
+            body = memoryview(data)[HEADER.size:]
+            if flags & COMPRESSED:
+                body = memoryview(zlib.decompress(body))
+
+            *registers, cc, running, blocks = STATE.unpack_from(body)
+            pos = STATE.size
+            memory = []
+            for _ in range(blocks):
+                start, length, readonly = BLOCK.unpack_from(body, pos)
+                pos += BLOCK.size
+                if pos + length > len(body):
+                    raise SnapshotError(f"{path} is truncated")
+                pages = tuple(body[i:min(i + 256, pos + length)].tobytes()
+                              for i in range(pos, pos + length, 256))
+                memory.append((start, length, bool(readonly), pages))
+                pos += length
+            size, = EXTRA.unpack_from(body, pos)
+            pos += EXTRA.size
+            extra = json.loads(body[pos:pos + size].tobytes().decode("utf-8"))
+        except SnapshotError:
+            raise
+        except (struct.error, zlib.error, ValueError) as ex:
+            raise SnapshotError(f"{path} is damaged ({ex})")
+
+        return cls(tuple(registers), cc, bool(running), memory, extra)
@@ -0,0 +1,678 @@
+# -*- coding: utf-8 -*-
+"""
+Assembler reports (listings), parsed once.
+
+The parsers read the report in chunks and classify each line with a
+single regular expression (one per assembler) run over the whole chunk.
+What they find goes in columns (see Listing) : the address, cycles and
+label of each line and where it starts in the report.  The text of a line
+is only decoded when it's shown (Listing.source), from a memory mapped
+copy of the report.
+
+Parsing a long listing takes time, so the result is saved next to the
+report (report + CACHE_SUFFIX) with what it was computed from : the path,
+size, modification time and content hash of the report (and of the map
+file for CA65).  The next time, if all of them match, the result is read
+back in one go instead of parsing again.  The hash catches the changes
+which keep the size and the modification time.
+"""
+
+import hashlib
+import marshal
+import mmap
+import os
+import re
+import shutil
+import struct
+import tempfile
+from array import array
+from bisect import bisect_left, bisect_right
+
+from py65emu.cpu import CPU
+
+DEFAULT_PC = 0x800
+
+NO_ADDRESS = -1
+NO_LABEL = -1
+MORE_BYTES = 0xFF
+
+CHUNK_SIZE = 1 << 20
+
+CACHE_SUFFIX = ".cache"
+CACHE_MAGIC = b"D6502RPT"
+CACHE_VERSION = 7
+
+CACHE_HEADER = struct.Struct( "<8sHI")  # magic, version, fingerprint size
+
+
+def fingerprint( paths):
+    """
+    What identifies the content of the files : for each one, its absolute
+    path, size, modification time and SHA-1.
+    """
+    prints = []
+    for path in paths:
+        st = os.stat( path)
+        with open( path, "rb") as fin:
+            digest = hashlib.sha1( fin.read()).digest()
+        prints.append( (os.path.abspath( path), st.st_size, st.st_mtime_ns, digest))
+    return tuple( prints)
+
+
+def load_cache( paths, prints=None):
+    """
+    The data saved by save_cache for these files, None if there's none or
+    if the files changed since.
+    """
+    prints = prints or fingerprint( paths)
+    try:
+        with open( paths[0] + CACHE_SUFFIX, "rb") as fin:
+            data = fin.read()
+        magic, version, size = CACHE_HEADER.unpack_from( data)
+        if magic != CACHE_MAGIC or version != CACHE_VERSION:
+            return None
+        cached_prints = marshal.loads( data[CACHE_HEADER.size:CACHE_HEADER.size + size])
+        if cached_prints != prints:
+            return None
+        return marshal.loads( data[CACHE_HEADER.size + size:])
+    except (OSError, struct.error, ValueError, EOFError, TypeError):
+        return None
+
+
+def save_cache( paths, data, prints=None):
+    """
+    Save data (made of what marshal supports : numbers, strings, lists,
+    tuples, dicts...) for these files.  If the cache can't be written (a
+    read only directory), never mind.
+    """
+    prints = prints or fingerprint( paths)
+    header = marshal.dumps( prints)
+    try:
+        with open( paths[0] + CACHE_SUFFIX, "wb") as fout:
+            fout.write( CACHE_HEADER.pack( CACHE_MAGIC, CACHE_VERSION, len( header)))
+            fout.write( header)
+            fout.write( marshal.dumps( data))
+    except OSError:
+        pass
+
+
+def cached( parse, paths, encode, decode):
+    """
+    parse( *paths), or its result saved the last time if the files didn't
+    change.  encode turns the result into what save_cache wants, decode
+    turns it back.
+    """
+    prints = fingerprint( paths)
+    data = load_cache( paths, prints)
+    if data is not None:
+        return decode( data)
+
+    result = parse( *paths)
+    save_cache( paths, encode( result), prints)
+    return result
+
+
+# ACME 0.96.4 : every line, "  line  addr bytes  source" (line numbers
+# right aligned on 6 characters, so from 100000 on there's no space
+# before them).  Either an EQU ("name = value",
+# "*= $800", no address ; tried first, "beef  = $10" is not an address),
+# or : addr when the line has an address, its bytes (8 at most, then
+# "..." : more), opcode (the first byte) when it has code, then a label
+# ("label:"), then !word or !byte (data).
+# The comments (after ";") are left out.
+ACME_RE = re.compile( rb"""(?m)^
+    (?:[ \t]*[0-9]+[ \t]+
+        (?:(?P<equ>[^ \t;=\n]+)[ \t]*=[ \t]*(?P<value>\$?[0-9A-Fa-f]+)
+          |(?:(?P<addr>[0-9a-f]+)[ \t](?P<bytes>(?P<opcode>[0-9a-f]{2})?[0-9a-f]*)(?P<more>\.\.\.)?(?:[ \t]+|$))?
+           (?:(?P<label>[^ \t;:\n]+):)?)
+        (?:[^;\n]*?!(?P<data>word|byte))?
+    )?
+    [^\n]*\n""", re.VERBOSE)
+
+# CA65 : only the lines "addr r include_level hexa source" (addr relative
+# to the segment, hexa is 12 characters wide once the tabs are expanded).
+# In the source : a .segment directive, a label, .word or .byte.  The
+# lines with a tab before the source are matched as `tabbed`, to expand
+# the tabs and match again.
+CA65_RE = re.compile( rb"""(?m)^
+    (?:(?P<addr>[0-9A-F]+)r[ ]+[0-9]+[ ](?P<hexa>[^\t\n]{12})
+       (?P<code>
+           (?:[ \t]+.segment[ \t]+"(?P<segment>[^"\n]+)")?
+           [ \t]*(?:(?P<label>[^ \t;:\n]+):)?
+           (?:[^;\n]*?[.!](?P<data>word|byte))?
+           [^\n]*)
+      |(?P<tabbed>[0-9A-F]+r[ \t]+[0-9]+[ \t][^\n]*))""", re.VERBOSE)
+
+SEGMENT_RE = re.compile( r"^([^\s]+)\s+([0-9A-F]{6}).*$")
+
+DATA_WIDTH = {b"word": 2, b"byte": 1}
+
+
+class Line:
+    """
+    A line of a Listing : a view on its columns, made when the line is
+    needed (the listing doesn't keep an object per line).
+    """
+    __slots__ = ("listing", "nr")
+
+    def __init__( self, listing, nr):
+        self.listing = listing
+        self.nr = nr
+
+    @property
+    def address( self):
+        return self.listing.address( self.nr)
+
+    @property
+    def cycles( self):
+        return self.listing.cycles[self.nr]
+
+    @property
+    def label( self):
+        return self.listing.label( self.nr)
+
+    @property
+    def source( self):
+        return self.listing.source( self.nr)
+
+    @property
+    def cycle_mark( self):
+        return self.listing.cycle_marks[self.nr]
+
+    @cycle_mark.setter
+    def cycle_mark( self, total):
+        self.listing.cycle_marks[self.nr] = total or 0
+
+
+class Listing:
+    """
+    A parsed report, one entry per line in each column :
+
+    addresses : address of the line, NO_ADDRESS if it has no code or data.
+    sizes : number of bytes of the line, MORE_BYTES if the report doesn't
+        show them all (they go up to the next line then).
+    cycles : cycles of the instruction on the line, 0 if none.
+    cycle_marks : for the cycle counting, cycles counted up to this line
+        (0 if it's not counted).
+    labels : index in label_names of the label defined on the line,
+        NO_LABEL if none.
+    starts : where the line starts in the report (bytes).
+
+    And for the whole report : index (an AddressIndex, to go from an
+    address to its line), symbols (a SymbolIndex, to find the labels by
+    name), locations ((label, address, width) of the data and zero page
+    variables) and default_pc.
+
+    The text of the lines stays in a memory mapped copy of the report
+    (text) and is only decoded for the lines shown (source).  A copy
+    because the report may be rewritten (assembled again) while we run.
+
+    listing[i] is line i (a Line).
+    """
+
+    def __init__( self, kind, path):
+        self.kind = kind      # "acme" or "ca65"
+        self.path = path
+        self.addresses = array( 'i')
+        self.sizes = array( 'B')
+        self.cycles = array( 'B')
+        self.cycle_marks = array( 'i')
+        self.labels = array( 'i')
+        self.starts = array( 'I')       # reports up to 4 GB
+        self.label_names = []
+        self.name_ids = dict()          # label name -> index in label_names
+        self.index = AddressIndex( self)
+        self.symbols = SymbolIndex( self)
+        self.locations = []
+        self.default_pc = DEFAULT_PC
+        self.text = b""
+
+    def map_text( self):
+        """ Map a copy of the report (self.path) as self.text """
+        copy = tempfile.TemporaryFile()
+        with open( self.path, "rb") as fin:
+            shutil.copyfileobj( fin, copy)
+        copy.flush()
+        if copy.tell():
+            self.text = mmap.mmap( copy.fileno(), 0, access=mmap.ACCESS_READ)
+        copy.close()
+
+    def close( self):
+        if isinstance( self.text, mmap.mmap):
+            self.text.close()
+        self.text = b""
+
+    def __len__( self):
+        return len( self.starts)
+
+    def __getitem__( self, i):
+        if not -len( self) <= i < len( self):
+            raise IndexError( i)
+        return Line( self, i % len( self))
+
+    def __iter__( self):
+        return (Line( self, i) for i in range( len( self)))
+
+    def label_id( self, name):
+        """ The index of a label in label_names (added if new) """
+        i = self.name_ids.get( name)
+        if i is None:
+            i = self.name_ids[name] = len( self.label_names)
+            self.label_names.append( name)
+        return i
+
+    def label( self, i):
+        """ The label defined on line i, None if none """
+        ndx = self.labels[i]
+        return self.label_names[ndx] if ndx != NO_LABEL else None
+
+    def address( self, i):
+        """ The address of line i, None if none """
+        addr = self.addresses[i]
+        return addr if addr != NO_ADDRESS else None
+
+    def build_indexes( self):
+        """ Make index and symbols, once all the lines are parsed """
+        addresses = self.addresses
+        located = array( 'i', (i for i in range( len( self)) if addresses[i] != NO_ADDRESS))
+        self.symbols.build( located)
+        self.index.build( located)
+
+    def clear_cycle_marks( self):
+        self.cycle_marks = array( 'i', bytes( 4 * len( self)))
+
+    def _line( self, i):
+        text = self.text
+        start = self.starts[i]
+        end = text.find( b"\n", start)
+        return text[start:end if end >= 0 else len( text)]
+
+    def source( self, i):
+        """ The text of line i as shown : tabs expanded and, for ACME,
+        numbered from the first line ; for CA65, "address | hexa | code".
+        """
+        line = self._line( i).replace( b"\t", b" "*8)
+        if self.kind == "acme":
+            return "{: 6d}{}".format( i+1, line[6:].rstrip().decode( "utf-8", "replace"))
+
+        # Matched as parse_ca65 did (not stripped : the hexa column of a
+        # line without code is padded with spaces)
+        m = CA65_RE.match( line)
+        addr = self.addresses[i]
+        addr_txt = f"{addr:04X}" if addr > 0 else "   -"
+        return "{} | {} | {}".format( addr_txt, m.group( "hexa").decode( "utf-8", "replace"),
+                                      m.group( "code").rstrip().decode( "utf-8", "replace"))
+
+    def encode( self):
+        """ The listing as save_cache wants it """
+        columns = [self.addresses, self.sizes, self.cycles, self.labels, self.starts]
+        return (self.kind, self.path, [c.tobytes() for c in columns], self.label_names,
+                self.index.encode(), self.symbols.encode(), self.locations, self.default_pc)
+
+    @classmethod
+    def decode( cls, data):
+        kind, path, columns, label_names, index, symbols, locations, default_pc = data
+        listing = cls( kind, path)
+        for column, data in zip( [listing.addresses, listing.sizes, listing.cycles, listing.labels, listing.starts], columns):
+            column.frombytes( data)
+        listing.clear_cycle_marks()
+        for name in label_names:
+            listing.label_id( name)
+        listing.index.decode( index)
+        listing.symbols.decode( symbols)
+        listing.locations = [tuple( l) for l in locations]
+        listing.default_pc = default_pc
+        listing.map_text()
+        return listing
+
+
+class AddressIndex:
+    """
+    Address -> source line, in O(log n) : the lines with code or data
+    sorted by address, each one covering the addresses [start, end), and
+    the labels sorted by address, to find them by bisection.
+
+    A label alone on its line is at the address of the next line with
+    one (see SymbolIndex).
+    """
+
+    def __init__( self, listing):
+        self.listing = listing
+        self.starts = array( 'i')
+        self.ends = array( 'i')
+        self.lines = array( 'i')
+        self.label_addresses = array( 'i')
+        self.label_ids = array( 'i')
+
+    def build( self, located):
+        """ Index the listing's lines, located being the numbers of those
+        with an address (in their order).  The labels come from the
+        listing's symbols, which must be built.
+        """
+        listing = self.listing
+        addresses, sizes = listing.addresses, listing.sizes
+
+        # A report is usually sorted by address already, else sort the
+        # lines (those at the same address staying in their order).
+        coded = array( 'i', (i for i in located if sizes[i]))
+        starts = array( 'i', (addresses[i] for i in coded))
+        if any( a > b for a, b in zip( starts, starts[1:])):
+            order = sorted( range( len( coded)), key=starts.__getitem__)
+            coded = array( 'i', (coded[k] for k in order))
+            starts = array( 'i', (starts[k] for k in order))
+
+        ends = array( 'i', starts)
+        for k, i in enumerate( coded):
+            if sizes[i] == MORE_BYTES:
+                # Up to the next line (8 bytes shown and more : 9 at least)
+                after = bisect_right( starts, starts[k])
+                ends[k] = starts[after] if after < len( starts) else starts[k] + 9
+            else:
+                ends[k] += sizes[i]
+        self.starts, self.ends, self.lines = starts, ends, coded
+
+        symbols = listing.symbols
+        def_addresses, def_lines = symbols.def_addresses, symbols.def_lines
+        order = sorted( (k for k in range( len( def_addresses)) if def_addresses[k] != NO_ADDRESS),
+                        key=lambda k: (def_addresses[k], def_lines[k]))
+        self.label_addresses = array( 'i', (def_addresses[k] for k in order))
+        self.label_ids = array( 'i', (symbols.def_ids[k] for k in order))
+
+    def line( self, addr):
+        """ The number of the line with the code or data at addr, None if
+        there's none.
+        """
+        k = bisect_right( self.starts, addr) - 1
+        if k >= 0 and addr < self.ends[k]:
+            return self.lines[k]
+        return None
+
+    def label( self, addr):
+        """ (label, offset) : the closest label at or before addr and how
+        far addr is from it, (None, None) if there's none.
+        """
+        k = bisect_right( self.label_addresses, addr) - 1
+        if k < 0:
+            return None, None
+        return self.listing.label_names[self.label_ids[k]], addr - self.label_addresses[k]
+
+    def locate( self, addr):
+        """ (line number, label, offset from the label) of addr, all None
+        if it's not in the listing.
+        """
+        line = self.line( addr)
+        if line is None:
+            return None, None, None
+        return (line,) + self.label( addr)
+
+    def encode( self):
+        return [c.tobytes() for c in (self.starts, self.ends, self.lines, self.label_addresses, self.label_ids)]
+
+    def decode( self, data):
+        for column, data in zip( (self.starts, self.ends, self.lines, self.label_addresses, self.label_ids), data):
+            column.frombytes( data)
+
+
+class SymbolError(ValueError):
+    pass
+
+
+class SymbolIndex:
+    """
+    The labels by name.  Listing.name_ids finds a name exactly ; names
+    (sorted) finds them by prefix, for the completion.  A name may be
+    defined more than once (ACME's zones, CA65's cheap local labels...) :
+    the definitions (label, line, address) are sorted by label then line,
+    those of a label are found by bisection.
+
+    The address of a definition is the one of its line, or of the next
+    line with one if it's a label alone, NO_ADDRESS if there's none.
+    """
+
+    def __init__( self, listing):
+        self.listing = listing
+        self.def_ids = array( 'i')
+        self.def_lines = array( 'i')
+        self.def_addresses = array( 'i')
+        self.names = []
+
+    def build( self, located):
+        """ Index the labels, located being the numbers of the lines with
+        an address (in their order).
+        """
+        listing = self.listing
+        addresses = listing.addresses
+        definitions = []
+        for i, label in enumerate( listing.labels):
+            if label != NO_LABEL:
+                k = bisect_left( located, i)
+                definitions.append( (label, i, addresses[located[k]] if k < len( located) else NO_ADDRESS))
+        definitions.sort()
+        self.def_ids = array( 'i', (d[0] for d in definitions))
+        self.def_lines = array( 'i', (d[1] for d in definitions))
+        self.def_addresses = array( 'i', (d[2] for d in definitions))
+        self.names = sorted( listing.label_names)
+
+    def definitions( self, name):
+        """ [(line number, address or None)] : where name is defined, in
+        the order of the lines.
+        """
+        label = self.listing.name_ids.get( name)
+        if label is None:
+            return []
+        return [(self.def_lines[k], self.def_addresses[k] if self.def_addresses[k] != NO_ADDRESS else None)
+                for k in range( bisect_left( self.def_ids, label), bisect_right( self.def_ids, label))]
+
+    def complete( self, prefix):
+        """ The names starting with prefix, sorted """
+        names = self.names
+        k = bisect_left( names, prefix)
+        completions = []
+        while k < len( names) and names[k].startswith( prefix):
+            completions.append( names[k])
+            k += 1
+        return completions
+
+    def search( self, text):
+        """ The names text may stand for : itself if it's a name, else the
+        ones starting with it, else the ones containing it.
+        """
+        if text in self.listing.name_ids:
+            return [text]
+        return self.complete( text) or [name for name in self.names if text in name]
+
+    def lookup( self, text):
+        """ The only name text stands for (see search), else SymbolError """
+        names = self.search( text)
+        if not names:
+            raise SymbolError( f"No label {text}")
+        if len( names) > 1:
+            raise SymbolError( f"{text} could be {', '.join( names[:5])}" + ("..." if len( names) > 5 else ""))
+        return names[0]
+
+    def resolve( self, text):
+        """ (line number, address or None) : the definition of the label
+        text stands for, SymbolError if it's not a single one.
+        """
+        name = self.lookup( text)
+        definitions = self.definitions( name)
+        if len( definitions) > 1:
+            raise SymbolError( f"{name} is defined {len( definitions)} times, lines "
+                               + ", ".join( str( line + 1) for line, addr in definitions[:5])
+                               + ("..." if len( definitions) > 5 else ""))
+        return definitions[0]
+
+    def encode( self):
+        return [c.tobytes() for c in (self.def_ids, self.def_lines, self.def_addresses)]
+
+    def decode( self, data):
+        for column, data in zip( (self.def_ids, self.def_lines, self.def_addresses), data):
+            column.frombytes( data)
+        self.names = sorted( self.listing.label_names)
+
+
+def _chunks( text, skip):
+    """
+    (offset, chunk) : text (the report), from its line `skip` (0 based)
+    on, in chunks of about CHUNK_SIZE made of whole lines (each one
+    ending with a newline).
+    """
+    offset = 0
+    for _ in range( skip):
+        offset = text.find( b"\n", offset) + 1
+        if not offset:
+            return
+
+    while offset < len( text):
+        end = text.rfind( b"\n", offset, offset + CHUNK_SIZE) + 1
+        if end <= offset:
+            # A line longer than a chunk, or the last one without newline
+            end = text.find( b"\n", offset + CHUNK_SIZE) + 1 or len( text)
+        chunk = text[offset:end]
+        if not chunk.endswith( b"\n"):
+            chunk += b"\n"
+        yield offset, chunk
+        offset = end
+
+
+def _decode( name):
+    return name.decode( "utf-8", "replace")
+
+
+def parse_acme( fname="report.txt"):
+    """ Parse an ACME 0.96.4 report """
+    listing = Listing( "acme", os.path.abspath( fname))
+    listing.map_text()
+    addresses, cycles, labels, starts = listing.addresses, listing.cycles, listing.labels, listing.starts
+    sizes, locations = listing.sizes, listing.locations
+    # The opcodes as they're written in the report
+    opcode_cycles = {b"%02x" % opcode: c or 0 for opcode, c in enumerate( CPU().opcode_cycles)}
+
+    last_label = None
+    last_data_label = None
+    first_star = False
+
+    for offset, chunk in _chunks( listing.text, 2):
+        for m in ACME_RE.finditer( chunk):
+            equ, value, addr, hexa, opcode, more, label, data = m.groups()
+            starts.append( offset + m.start())
+
+            if addr:
+                addr = int( addr, 16)
+                addresses.append( addr)
+                sizes.append( MORE_BYTES if more else len( hexa) // 2)
+            else:
+                addr = None
+                addresses.append( NO_ADDRESS)
+                sizes.append( 0)
+
+            cycles.append( opcode_cycles[opcode] if opcode else 0)
+
+            if label:
+                last_label = _decode( label)
+                labels.append( listing.label_id( last_label))
+            else:
+                labels.append( NO_LABEL)
+
+            if data and last_data_label != last_label:
+                last_data_label = last_label
+                locations.append( (last_data_label, addr, DATA_WIDTH[data]) )
+
+            # Heuristic to find EQU's of zero page addresses
+            if equ:
+                if value.startswith( b'$'):
+                    value = int( value[1:], 16)
+                elif value.isdigit():
+                    value = int( value)
+                else:
+                    continue
+
+                if equ != b'*' and value < 256:
+                    locations.append( (_decode( equ), value, 1) )
+                elif not first_star:
+                    listing.default_pc = value
+                    first_star = True
+
+    listing.clear_cycle_marks()
+    listing.build_indexes()
+    return listing
+
+
+def read_segments( map_name):
+    """ segment name -> start address, from a ld65 map file """
+    segments = dict()
+    with open( map_name, "r") as fin:
+        lines = fin.readlines()
+
+    ndx = 0
+    while 'Segment list:' not in lines[ndx]:
+        ndx += 1
+
+    while ndx < len( lines):
+        line = lines[ndx].strip()
+        m = SEGMENT_RE.match( line)
+        if m:
+            segments[m.group( 1)] = int( m.group( 2), 16)
+        elif not line:
+            break
+        ndx += 1
+
+    return segments
+
+
+def parse_ca65( fname, map_name):
+    """ Parse a CA65 listing, with the ld65 map file to place the
+    segments.
+    """
+    segments = read_segments( map_name)
+    listing = Listing( "ca65", os.path.abspath( fname))
+    listing.map_text()
+    listing.default_pc = 0
+    addresses, cycles, labels, starts = listing.addresses, listing.cycles, listing.labels, listing.starts
+    sizes, locations = listing.sizes, listing.locations
+
+    seg_addr = 0
+    last_label = None
+    last_data_label = None
+
+    for offset, chunk in _chunks( listing.text, 4):
+        for m in CA65_RE.finditer( chunk):
+            start = offset + m.start()
+            addr, hexa, _, segment, label, data, tabbed = m.groups()
+            if tabbed:
+                # The hexa column is measured with the tabs expanded
+                m = CA65_RE.match( tabbed.replace( b"\t", b" "*8))
+                addr, hexa, _, segment, label, data, tabbed = m.groups()
+                if tabbed:
+                    continue
+
+            if segment:
+                seg_addr = segments.get( _decode( segment), seg_addr)
+
+            line_addr = int( addr, 16) + seg_addr
+            if line_addr and not listing.default_pc:
+                listing.default_pc = line_addr
+
+            hexa = hexa.split()
+            if hexa:
+                addresses.append( line_addr)
+            else:
+                line_addr = 0
+                addresses.append( NO_ADDRESS)
+            sizes.append( len( hexa))
+            cycles.append( 0)
+            starts.append( start)
+
+            if label:
+                last_label = _decode( label)
+                labels.append( listing.label_id( last_label))
+            else:
+                labels.append( NO_LABEL)
+
+            if data and last_data_label != last_label:
+                last_data_label = last_label
+                locations.append( (last_data_label, line_addr, DATA_WIDTH[data]) )
+
+    listing.clear_cycle_marks()
+    listing.build_indexes()
+    return listing
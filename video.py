@@ -0,0 +1,486 @@
+# -*- coding: utf-8 -*-
+"""
+Apple II video memory renderers (HGR, text and LORES).
+
+Everything here is table driven : the screen rows are gathered with
+precomputed addresses and the bytes are turned into pixels with
+bytes.translate, so there's no Python code running per pixel (nor per
+byte).
+
+The renderers take `memory`, anything that can be sliced by 6502
+address (for example cpu.mmu.blocks[0]['memory']).
+"""
+
+from PIL import Image
+
+APPLE_XRES = 280
+APPLE_YRES = 64*3
+HGR_BYTES_PER_ROW = 40
+
+
+def hgr_address( y, page=0x2000, format=0):
+    #assert page == 0x2000 or page == 0x4000, "I'll work only for legal pages"
+    assert 0 <= y < APPLE_YRES, "You're outside Apple's veritcal resolution"
+
+    if 0 <= y < 64:
+        ofs = 0
+    elif 64 <= y < 128:
+        ofs = 0x28
+    else:
+        ofs = 0x50
+
+    i = (y % 64) // 8
+    j = (y % 64) % 8
+
+    if format == 0:
+        return "${:X} + ${:X}".format( page + ofs + 0x80*i, 0x400*j)
+    elif format == 1:
+        return "${:X}".format( page + ofs + 0x80*i + 0x400*j)
+    else:
+        return page + ofs + 0x80*i + 0x400*j
+
+
+# Offset of each of the 192 rows in an HGR page
+HGR_ROWS = [hgr_address( y, 0, format=None) for y in range(APPLE_YRES)]
+
+# HGR_MONO_BITS[k] translates an HGR byte into its k-th pixel (0 or 255).
+# Bit 0 is the leftmost pixel, bit 7 (palette) is not displayed.
+HGR_MONO_BITS = [bytes( 255 if (b >> k) & 1 else 0 for b in range(256)) for k in range(7)]
+
+
+def hgr_rows( memory, page=0x2000, rows=HGR_ROWS):
+    """
+    The HGR rows, 40 bytes each, in display order, as one bytes object.
+    """
+    m = memoryview( memory)
+    return b"".join( [m[page+ofs:page+ofs+HGR_BYTES_PER_ROW] for ofs in rows])
+
+
+def render_hgr( memory, page=0x2000):
+    """
+    Render an HGR page in black and white. Returns a 280x192 bytearray,
+    one byte per pixel (0 or 255), rows top to bottom.
+    """
+    data = hgr_rows( memory, page)
+    pixels = bytearray( APPLE_XRES * APPLE_YRES)
+    for k in range(7):
+        pixels[k::7] = data.translate( HGR_MONO_BITS[k])
+    return pixels
+
+
+# Colour rendering.  We use the usual approximation of the NTSC artifacts :
+# two lit pixels side by side are white, a lone lit pixel is coloured
+# according to its column parity and to its byte's palette bit (bit 7) and
+# a dark pixel between two lit ones takes their colour.  So the colour of
+# a pixel depends on its context : itself, its left and right neighbours,
+# its column parity and its palette bit.  That's a 5 bits index, built for
+# all the pixels at once, with big integer arithmetic, then turned into
+# colours with bytes.translate.
+
+BLACK, WHITE, VIOLET, GREEN, BLUE, ORANGE = range(6)
+
+HGR_PALETTE = [
+    (0, 0, 0),
+    (255, 255, 255),
+    (255, 68, 253),
+    (20, 245, 60),
+    (20, 207, 253),
+    (255, 106, 60)]
+
+# Context bits of a pixel
+_ON, _LEFT, _RIGHT, _ODD, _PALETTE = 1, 2, 4, 8, 16
+
+# HGR_COLOUR_BITS[k] translates an HGR byte into the context of its k-th
+# pixel, as far as the byte is concerned (lit or not, palette bit).
+HGR_COLOUR_BITS = [bytes( ((b >> k) & 1) * _ON | (b >> 7) * _PALETTE for b in range(256)) for k in range(7)]
+
+
+def _hgr_colour( context):
+    if context & _ON:
+        if context & (_LEFT | _RIGHT):
+            return WHITE
+        odd = context & _ODD
+    elif context & _LEFT and context & _RIGHT:
+        odd = not context & _ODD  # the neighbours' parity
+    else:
+        return BLACK
+
+    if context & _PALETTE:
+        return ORANGE if odd else BLUE
+    else:
+        return GREEN if odd else VIOLET
+
+
+HGR_COLOUR_TABLE = bytes( [_hgr_colour( c) for c in range(32)] + [BLACK] * 224)
+
+# Little endian masks over a full page of pixels (so they work with fewer
+# rows too).  The pixels on the left (right) edge have no left (right)
+# neighbour.
+_HGR_LEFT_MASK = int.from_bytes( bytes( ([0] + [_ON] * (APPLE_XRES-1)) * APPLE_YRES), "little")
+_HGR_RIGHT_MASK = int.from_bytes( bytes( ([_ON] * (APPLE_XRES-1) + [0]) * APPLE_YRES), "little")
+_HGR_ODD_COLUMNS = int.from_bytes( bytes( [0, _ODD] * (APPLE_XRES // 2) * APPLE_YRES), "little")
+
+
+def hgr_colour_pixels( data):
+    """
+    Turn HGR rows (40 bytes each, see hgr_rows) into colour pixels,
+    one byte per pixel, an index in HGR_PALETTE.
+    """
+    n = len( data) * 7
+    pixels = bytearray( n)
+    for k in range(7):
+        pixels[k::7] = data.translate( HGR_COLOUR_BITS[k])
+
+    p = int.from_bytes( pixels, "little")
+    context = p | ((p << 8) & _HGR_LEFT_MASK) * _LEFT | ((p >> 8) & _HGR_RIGHT_MASK) * _RIGHT
+    context |= _HGR_ODD_COLUMNS & ((1 << (8*n)) - 1)
+
+    return bytearray( context.to_bytes( n, "little").translate( HGR_COLOUR_TABLE))
+
+
+def render_hgr_colour( memory, page=0x2000):
+    """
+    Render an HGR page in colour. Returns a 280x192 bytearray, one byte
+    per pixel (an index in HGR_PALETTE), rows top to bottom.
+    """
+    return hgr_colour_pixels( hgr_rows( memory, page))
+
+
+def pixels_image( pixels, colour=False, scale=1):
+    """
+    Turn rendered pixels into a PIL image.  colour is False for black and
+    white pixels (0/255), True (HGR_PALETTE) or a palette for indexed ones.
+    """
+    if colour:
+        palette = HGR_PALETTE if colour is True else colour
+        img = Image.frombytes( "P", (APPLE_XRES, APPLE_YRES), bytes( pixels))
+        img.putpalette( [c for rgb in palette for c in rgb])
+    else:
+        img = Image.frombytes( "L", (APPLE_XRES, APPLE_YRES), bytes( pixels))
+    if scale != 1:
+        img = img.resize( (APPLE_XRES*scale, APPLE_YRES*scale), Image.NEAREST)
+    return img
+
+
+def hgr_image( memory, page=0x2000, scale=1, colour=False):
+    """
+    Render an HGR page, in black and white or in colour, as a PIL image.
+    """
+    if colour:
+        return pixels_image( render_hgr_colour( memory, page), True, scale)
+    return pixels_image( render_hgr( memory, page), False, scale)
+
+
+# Row of each byte of an HGR page, APPLE_YRES for the bytes which are
+# not displayed (the "screen holes").
+HGR_ROW_OF = bytearray( [APPLE_YRES] * 0x2000)
+for y, ofs in enumerate( HGR_ROWS):
+    HGR_ROW_OF[ofs:ofs+HGR_BYTES_PER_ROW] = bytes( [y] * HGR_BYTES_PER_ROW)
+
+
+class HgrRenderer:
+    """
+    Keeps the last frame of an HGR page and, on each render, re-renders
+    only the rows written to since the previous one.  The writes are
+    reported by the MMU (see MMU.observeWrites), so there's no need to
+    compare the page with the previous frame.
+    """
+
+    def __init__( self, mmu, page=0x2000, memory=None, colour=False):
+        self.mmu = mmu
+        self.page = page
+        self.colour = colour
+        self.memory = memory if memory is not None else mmu.blocks[0]['memory']
+        self.pixels = bytearray( APPLE_XRES * APPLE_YRES)
+
+        # One byte per row + one for the screen holes
+        self.dirty_rows = bytearray( APPLE_YRES + 1)
+        self.invalidate()
+
+        for p in range( page >> 8, (page + 0x2000) >> 8):
+            mmu.observeWrites( p, self._written)
+
+    def close( self):
+        for p in range( self.page >> 8, (self.page + 0x2000) >> 8):
+            self.mmu.unobserveWrites( p, self._written)
+
+    def _written( self, addr, value):
+        self.dirty_rows[ HGR_ROW_OF[addr - self.page]] = 1
+
+    def invalidate( self):
+        """
+        Re-render everything next time (for example, after the memory was
+        changed behind the MMU's back, or reset).
+        """
+        self.dirty_rows[:] = b"\x01" * len( self.dirty_rows)
+
+    def render( self):
+        """
+        Update the frame (self.pixels, same format as render_hgr's or
+        render_hgr_colour's).  Returns the list of the rows that were re-rendered.
+        """
+        rows = [y for y in range( APPLE_YRES) if self.dirty_rows[y]]
+        self.dirty_rows[:] = bytes( len( self.dirty_rows))
+        if not rows:
+            return rows
+
+        data = hgr_rows( self.memory, self.page, [HGR_ROWS[y] for y in rows])
+        if self.colour:
+            strip = hgr_colour_pixels( data)
+        else:
+            strip = bytearray( len( data) * 7)
+            for k in range(7):
+                strip[k::7] = data.translate( HGR_MONO_BITS[k])
+
+        for i, y in enumerate( rows):
+            self.pixels[y*APPLE_XRES:(y+1)*APPLE_XRES] = strip[i*APPLE_XRES:(i+1)*APPLE_XRES]
+
+        return rows
+
+    def image( self, scale=1):
+        return pixels_image( self.pixels, self.colour, scale)
+
+
+class HgrViewer:
+    """
+    A window showing an HGR page live.  Call refresh() whenever you want
+    it updated (it's cheap when nothing was drawn).  Needs tkinter.
+    """
+
+    def __init__( self, mmu, page=0x2000, scale=2, memory=None, colour=False):
+        import tkinter
+        from PIL import ImageTk
+
+        self.root = tkinter.Tk()
+        self.renderer = HgrRenderer( mmu, page, memory, colour)
+        self.scale = scale
+
+        self.root.title( f"HGR ${page:04X}")
+        self.root.protocol( "WM_DELETE_WINDOW", self.close)
+        self.photo = ImageTk.PhotoImage( self.renderer.image( scale))
+        self.label = tkinter.Label( self.root, image=self.photo)
+        self.label.pack()
+        self.closed = False
+        self.refresh()
+
+    def refresh( self):
+        if self.closed:
+            return
+        if self.renderer.render():
+            self.photo.paste( self.renderer.image( self.scale))
+        self.root.update()
+
+    def close( self):
+        if not self.closed:
+            self.closed = True
+            self.renderer.close()
+            self.root.destroy()
+
+
+# Text and LORES.  Both use the 24 rows of 40 bytes of the text pages
+# ($400 and $800), with the same interleaving as HGR's, 8 times smaller.
+
+TEXT_COLUMNS, TEXT_ROWS_COUNT = 40, 24
+
+
+def text_address( y, page=0x400, format=0):
+    assert 0 <= y < TEXT_ROWS_COUNT, "You're outside Apple's text vertical resolution"
+
+    ofs = page + 0x80*(y % 8) + 0x28*(y // 8)
+    if format == 0 or format == 1:
+        return "${:X}".format( ofs)
+    else:
+        return ofs
+
+
+# Offset of each of the 24 rows in a text (or LORES) page
+TEXT_ROWS = [text_address( y, 0, format=None) for y in range(TEXT_ROWS_COUNT)]
+
+
+def text_rows( memory, page=0x400):
+    """
+    The text rows, 40 bytes each, in display order, as one bytes object.
+    """
+    return hgr_rows( memory, page, TEXT_ROWS)
+
+
+# The character generator (64 characters, 5x7 dots, from $00 to $3F :
+# @A..Z[\]^_ then space to ?).
+FONT = [
+    ".###. #...# #.#.# #.### #.##. #.... .####",  # @
+    "..#.. .#.#. #...# #...# ##### #...# #...#",
+    "####. #...# #...# ####. #...# #...# ####.",
+    ".###. #...# #.... #.... #.... #...# .###.",
+    "####. #...# #...# #...# #...# #...# ####.",
+    "##### #.... #.... ####. #.... #.... #####",
+    "##### #.... #.... ####. #.... #.... #....",
+    ".#### #.... #.... #.### #...# #...# .####",
+    "#...# #...# #...# ##### #...# #...# #...#",  # H
+    ".###. ..#.. ..#.. ..#.. ..#.. ..#.. .###.",
+    "....# ....# ....# ....# ....# #...# .###.",
+    "#...# #..#. #.#.. ##... #.#.. #..#. #...#",
+    "#.... #.... #.... #.... #.... #.... #####",
+    "#...# ##.## #.#.# #.#.# #...# #...# #...#",
+    "#...# #...# ##..# #.#.# #..## #...# #...#",
+    ".###. #...# #...# #...# #...# #...# .###.",
+    "####. #...# #...# ####. #.... #.... #....",  # P
+    ".###. #...# #...# #...# #.#.# #..#. .##.#",
+    "####. #...# #...# ####. #.#.. #..#. #...#",
+    ".###. #...# #.... .###. ....# #...# .###.",
+    "##### ..#.. ..#.. ..#.. ..#.. ..#.. ..#..",
+    "#...# #...# #...# #...# #...# #...# .###.",
+    "#...# #...# #...# #...# #...# .#.#. ..#..",
+    "#...# #...# #...# #.#.# #.#.# ##.## #...#",
+    "#...# #...# .#.#. ..#.. .#.#. #...# #...#",  # X
+    "#...# #...# .#.#. ..#.. ..#.. ..#.. ..#..",
+    "##### ....# ...#. ..#.. .#... #.... #####",
+    "##### ##... ##... ##... ##... ##... #####",
+    "..... #.... .#... ..#.. ...#. ....# .....",
+    "##### ...## ...## ...## ...## ...## #####",
+    "..... ..... ..#.. .#.#. #...# ..... .....",
+    "..... ..... ..... ..... ..... ..... #####",
+    "..... ..... ..... ..... ..... ..... .....",  # space
+    "..#.. ..#.. ..#.. ..#.. ..#.. ..... ..#..",
+    ".#.#. .#.#. .#.#. ..... ..... ..... .....",
+    ".#.#. .#.#. ##### .#.#. ##### .#.#. .#.#.",
+    "..#.. .#### #.#.. .###. ..#.# ####. ..#..",
+    "##... ##..# ...#. ..#.. .#... #..## ...##",
+    ".#... #.#.. #.#.. .#... #.#.# #..#. .##.#",
+    "..#.. ..#.. ..#.. ..... ..... ..... .....",
+    "..#.. .#... #.... #.... #.... .#... ..#..",  # (
+    "..#.. ...#. ....# ....# ....# ...#. ..#..",
+    "..#.. #.#.# .###. ..#.. .###. #.#.# ..#..",
+    "..... ..#.. ..#.. ##### ..#.. ..#.. .....",
+    "..... ..... ..... ..... ..#.. ..#.. .#...",
+    "..... ..... ..... ##### ..... ..... .....",
+    "..... ..... ..... ..... ..... ..... ..#..",
+    "..... ....# ...#. ..#.. .#... #.... .....",
+    ".###. #...# #..## #.#.# ##..# #...# .###.",  # 0
+    "..#.. .##.. ..#.. ..#.. ..#.. ..#.. .###.",
+    ".###. #...# ....# ..##. .#... #.... #####",
+    "##### ....# ...#. ..##. ....# #...# .###.",
+    "...#. ..##. .#.#. #..#. ##### ...#. ...#.",
+    "##### #.... ####. ....# ....# #...# .###.",
+    "..### .#... #.... ####. #...# #...# .###.",
+    "##### ....# ...#. ..#.. .#... .#... .#...",
+    ".###. #...# #...# .###. #...# #...# .###.",  # 8
+    ".###. #...# #...# .#### ....# ...#. ###..",
+    "..... ..... ..#.. ..... ..#.. ..... .....",
+    "..... ..... ..#.. ..... ..#.. ..#.. .#...",
+    "...#. ..#.. .#... #.... .#... ..#.. ...#.",
+    "..... ..... ##### ..... ##### ..... .....",
+    ".#... ..#.. ...#. ....# ...#. ..#.. .#...",
+    ".###. #...# ...#. ..#.. ..#.. ..... ..#..",
+]
+
+
+def _glyph_line( code, line):
+    """
+    The dots of a line of a character (7 dots, bit 0 is the leftmost, as
+    in HGR).  Characters $00-$7F are displayed in inverse (we don't
+    flash), $80-$FF normally.
+    """
+    if line < 7:
+        row = FONT[code & 0x3F].split()[line]
+        dots = sum( 1 << (1+i) for i, c in enumerate( row) if c == "#")
+    else:
+        dots = 0
+    return dots if code & 0x80 else dots ^ 0x7F
+
+
+# TEXT_GLYPH_LINES[k] translates a screen code into the dots of the k-th
+# line of its character.
+TEXT_GLYPH_LINES = [bytes( _glyph_line( code, k) for code in range(256)) for k in range(8)]
+
+# Screen code to ASCII (inverse and flashing characters as normal ones)
+TEXT_ASCII = bytes( 0x40 + (c & 0x1F) if c & 0x3F < 0x20 else c & 0x3F for c in range(256))
+
+
+def render_text( memory, page=0x400):
+    """
+    The text page as 24 strings of 40 characters (it's cheap enough to be
+    called on each step).
+    """
+    data = text_rows( memory, page).translate( TEXT_ASCII).decode( "ascii")
+    return [data[i:i+TEXT_COLUMNS] for i in range( 0, len( data), TEXT_COLUMNS)]
+
+
+def render_text_pixels( memory, page=0x400):
+    """
+    Render a text page. Returns a 280x192 bytearray, one byte per pixel
+    (0 or 255), like render_hgr.
+    """
+    data = text_rows( memory, page)
+    lines = [data.translate( TEXT_GLYPH_LINES[k]) for k in range(8)]
+
+    # The dots, HGR style : 8 lines of 40 bytes per text row
+    dots = bytearray( len( data) * 8)
+    for y in range( TEXT_ROWS_COUNT):
+        for k in range(8):
+            dots[(y*8+k)*TEXT_COLUMNS:(y*8+k+1)*TEXT_COLUMNS] = lines[k][y*TEXT_COLUMNS:(y+1)*TEXT_COLUMNS]
+
+    dots = bytes( dots)
+    pixels = bytearray( APPLE_XRES * APPLE_YRES)
+    for k in range(7):
+        pixels[k::7] = dots.translate( HGR_MONO_BITS[k])
+    return pixels
+
+
+LORES_PALETTE = [
+    (0, 0, 0),        # black
+    (227, 30, 96),    # magenta
+    (96, 78, 189),    # dark blue
+    (255, 68, 253),   # purple
+    (0, 163, 96),     # dark green
+    (156, 156, 156),  # grey
+    (20, 207, 253),   # medium blue
+    (208, 195, 255),  # light blue
+    (96, 114, 3),     # brown
+    (255, 106, 60),   # orange
+    (156, 156, 156),  # grey
+    (255, 160, 208),  # pink
+    (20, 245, 60),    # light green
+    (208, 221, 141),  # yellow
+    (114, 255, 208),  # aquamarine
+    (255, 255, 255)]  # white
+
+# A LORES byte is two blocks, the low nibble is the top one.
+LORES_TOP = bytes( b & 0xF for b in range(256))
+LORES_BOTTOM = bytes( b >> 4 for b in range(256))
+
+
+def render_lores( memory, page=0x400):
+    """
+    Render a LORES page (40x48 blocks of 7x4 pixels). Returns a 280x192
+    bytearray, one byte per pixel (an index in LORES_PALETTE).
+    """
+    data = text_rows( memory, page)
+
+    # Each block is 7 pixels wide
+    halves = []
+    for table in (LORES_TOP, LORES_BOTTOM):
+        colours = data.translate( table)
+        row = bytearray( len( data) * 7)
+        for k in range(7):
+            row[k::7] = colours
+        halves.append( row)
+
+    pixels = bytearray( APPLE_XRES * APPLE_YRES)
+    for y in range( APPLE_YRES):
+        ofs = (y // 8) * APPLE_XRES
+        pixels[y*APPLE_XRES:(y+1)*APPLE_XRES] = halves[(y // 4) % 2][ofs:ofs+APPLE_XRES]
+    return pixels
+
+
+def text_image( memory, page=0x400, scale=1):
+    """
+    Render a text page as a PIL image.
+    """
+    return pixels_image( render_text_pixels( memory, page), False, scale)
+
+
+def lores_image( memory, page=0x400, scale=1):
+    """
+    Render a LORES page as a PIL image.
+    """
+    return pixels_image( render_lores( memory, page), LORES_PALETTE, scale)